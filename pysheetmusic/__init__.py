@@ -1 +1,19 @@
-from . import viewer, parse, render, sprite, tab, player, layout
+import importlib
+
+SUBMODULES = (
+    'viewer', 'parse', 'render', 'sprite', 'tab', 'player', 'output', 'clock',
+    'layout', 'spatial', 'fingering', 'atlas', 'export', 'raster', 'sheet',
+    'display', 'music', 'utils')
+
+
+def __getattr__(name):
+    # Submodules are imported when first used, so that e.g. export and raster,
+    # and their worker processes, do not load the GL modules of viewer and
+    # render or the MIDI modules of player.
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
@@ -0,0 +1,206 @@
+"""
+Glyph atlases: many small glyph images packed into one image, so that they
+can be drawn from one texture.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFont
+import numpy as np
+
+
+def get_cache_dir():
+    " return: The user cache directory of the package, which may not exist. "
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pysheetmusic')
+
+
+def get_cache_path(path):
+    " return: The path of the cached pixels of the image at `path`. "
+    path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(get_cache_dir(), '{}-{}.npy'.format(name, digest))
+
+
+def load_pixels(path):
+    """
+    Decode the image at `path` into an (h, w, 4) RGBA uint8 array. The array
+    is cached in a `.npy` file of `get_cache_dir`, which later loads memory
+    map instead of decoding the image again.
+    """
+    cachePath = get_cache_path(path)
+    try:
+        if os.path.getmtime(cachePath) >= os.path.getmtime(path):
+            return np.load(cachePath, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    pixels = np.asarray(PIL.Image.open(path).convert('RGBA'))
+    try:
+        save_atomic(cachePath, pixels)
+    except OSError:
+        # The cache is optional, e.g. the home directory may be read only.
+        pass
+    return pixels
+
+
+def save_atomic(path, array):
+    """
+    Save `array` to the `.npy` file `path` through a temporary file, so that
+    other processes never load a partly written file.
+    """
+    dir = os.path.dirname(path)
+    os.makedirs(dir, exist_ok=True)
+    fd, tempPath = tempfile.mkstemp(suffix='.npy', dir=dir)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, array)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.unlink(tempPath)
+        raise
+
+
+class TemplateAtlas:
+    """
+    The glyph templates, an image with a json file of the rectangle and the
+    center of each glyph. Use `get_template_atlas` to share one per process.
+
+    rects: name -> (x, y, w, h) in the image.
+    centers: name -> (cx, cy) relative to the rect.
+    pixels: (h, w, 4) RGBA array, see `load_pixels`. Only loaded when used,
+        as the layouts need the json alone.
+    size: (w, h) of the image.
+    mipLevels: The number of levels saved by tools/packer.py, the full size
+        one included, see `get_mip_pixels`.
+    """
+
+    def __init__(self, dir, name):
+        self.path = os.path.join(dir, name + '.png')
+        with open(os.path.join(dir, name + '.json')) as file:
+            config = json.load(file)
+        self.rects = config['rects']
+        self.centers = config['centers']
+        self.mipLevels = config.get('mipLevels', 1)
+        self._pixels = None
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = load_pixels(self.path)
+        return self._pixels
+
+    @property
+    def size(self):
+        h, w, _ = self.pixels.shape
+        return w, h
+
+    def get_mip_pixels(self, level):
+        " return: The pixels of mip `level`, each level half the size of the last. "
+        if level == 0:
+            return self.pixels
+        base = os.path.splitext(self.path)[0]
+        return load_pixels('{}.mip{}.png'.format(base, level))
+
+    def get_image(self):
+        " return: A PIL image of the pixels, without decoding the png. "
+        return PIL.Image.fromarray(np.ascontiguousarray(self.pixels), 'RGBA')
+
+
+_templateAtlases = {}
+
+def get_template_atlas(dir=None, name='templates'):
+    " return: The TemplateAtlas of `dir`, default to the package templates. "
+    if dir is None:
+        dir = os.path.dirname(__file__)
+    key = (os.path.abspath(dir), name)
+    try:
+        return _templateAtlases[key]
+    except KeyError:
+        atlas = _templateAtlases[key] = TemplateAtlas(dir, name)
+        return atlas
+
+
+class TextAtlas:
+    """
+    The characters of a font rasterized once into one image.
+
+    chars: The sorted characters in the atlas.
+    image: A PIL RGBA image, black with the glyph coverage as alpha.
+    rects: (nChars, 4) int array of (x, y, w, h) of each glyph in `image`.
+    boxes: (nChars, 4) int array of (x1, y1, x2, y2), the glyph box relative to
+        the pen position at the top of the line, with y pointing down.
+    advances: (nChars,) the advance width of each character.
+
+    All lengths are in pixels, with the font size being PIXEL_SIZE.
+    """
+    PIXEL_SIZE = 48
+    WIDTH = 1024
+    # Space between glyphs, so that they do not bleed into each other.
+    PADDING = 2
+
+    def __init__(self, chars, fontPath=None):
+        """
+        fontPath: A TrueType font file. Default to the font of PIL.
+        """
+        if fontPath is None:
+            font = PIL.ImageFont.load_default(self.PIXEL_SIZE)
+        else:
+            font = PIL.ImageFont.truetype(fontPath, self.PIXEL_SIZE)
+        self.fontPath = fontPath
+        self.chars = sorted(set(chars))
+        self.charIds = {ch: i for i, ch in enumerate(self.chars)}
+        n = len(self.chars)
+        self.boxes = np.array(
+            [font.getbbox(ch) for ch in self.chars], dtype=int).reshape(n, 4)
+        self.advances = np.array([font.getlength(ch) for ch in self.chars])
+        self.rects = self.pack(self.boxes[:, 2:4] - self.boxes[:, 0:2])
+        self.image = self.draw(font)
+
+    def pack(self, sizes):
+        " Put the glyphs in rows, the highest first. "
+        p = self.PADDING
+        rects = np.zeros((len(sizes), 4), dtype=int)
+        x = y = rowHeight = p
+        for i in np.argsort(-sizes[:, 1], kind='stable'):
+            w, h = sizes[i]
+            if x + w + p > self.WIDTH:
+                x = p
+                y += rowHeight + p
+                rowHeight = 0
+            rects[i] = x, y, w, h
+            x += w + p
+            rowHeight = max(rowHeight, h)
+        self.height = y + rowHeight + p
+        return rects
+
+    def draw(self, font):
+        alpha = PIL.Image.new('L', (self.WIDTH, self.height), 0)
+        draw = PIL.ImageDraw.Draw(alpha)
+        for ch, (x, y, _, _), (x1, y1, _, _) in zip(self.chars, self.rects, self.boxes):
+            draw.text((x - x1, y - y1), ch, fill=255, font=font)
+        black = PIL.Image.new('L', alpha.size, 0)
+        return PIL.Image.merge('RGBA', (black, black, black, alpha))
+
+    def has_chars(self, chars):
+        charIds = self.charIds
+        return all(ch in charIds for ch in chars)
+
+
+# The characters of every text atlas, so that most sheets share one atlas.
+BASE_CHARS = ''.join(map(chr, range(32, 127)))
+
+_textAtlases = {}
+
+def get_text_atlas(chars):
+    " return: The TextAtlas of BASE_CHARS and `chars`, made once for each set. "
+    key = frozenset(chars) | frozenset(BASE_CHARS)
+    try:
+        return _textAtlases[key]
+    except KeyError:
+        atlas = _textAtlases[key] = TextAtlas(key)
+        return atlas
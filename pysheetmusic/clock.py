@@ -0,0 +1,153 @@
+"""
+The clocks the player is timed by: the real time, or a virtual time that
+only moves when told to, for tests.
+"""
+from threading import Condition, current_thread
+from time import sleep, perf_counter
+
+
+def get_system_time():
+    " return: Seconds of a monotonic clock. "
+    return perf_counter()
+
+# How long before a deadline `sleep_until` stops sleeping and spins, as
+# sleep() may wake up late by about the scheduler quantum.
+SPIN_TIME = 0.002
+
+def sleep_until(deadline):
+    " Wait until `get_system_time()` reaches `deadline`. "
+    while True:
+        remaining = deadline - get_system_time()
+        if remaining <= 0:
+            return
+        if remaining > SPIN_TIME:
+            sleep(remaining - SPIN_TIME)
+
+
+class Clock:
+    """
+    The real time.
+
+    The threads timed by a clock block through `wait` only, and are woken by
+    `notify`.
+    """
+
+    def time(self):
+        return get_system_time()
+
+    def wait(self, cond, deadline=None):
+        """
+        Wait on `cond`, which is held, until notified or for a while before
+        `deadline`. Close to the deadline it yields, so that the caller
+        spins until the deadline while `cond` can be notified.
+        """
+        if deadline is None:
+            cond.wait()
+            return
+        remaining = deadline - self.time()
+        if remaining > 0:
+            cond.wait(remaining - SPIN_TIME if remaining > SPIN_TIME else 0)
+
+    def notify(self, cond):
+        " Notify `cond`, which is held. "
+        cond.notify_all()
+
+    def attach(self, thread):
+        " Time `thread` by this clock, before it starts. "
+        pass
+
+    def detach(self):
+        " Stop timing the current thread, before it ends. "
+        pass
+
+
+class VirtualClock(Clock):
+    """
+    A time that only moves by `advance`, which runs the attached threads up
+    to the new time as fast as they can. What they do is the same each run,
+    as time does not pass while they work.
+    """
+
+    def __init__(self, time=0.):
+        self.now = time
+        self._lock = Condition()
+        self._threads = set()
+        # thread -> [cond, deadline, woken] of the threads in `wait`.
+        self._sleepers = {}
+
+    def time(self):
+        return self.now
+
+    def wait(self, cond, deadline=None):
+        thread = current_thread()
+        with self._lock:
+            if deadline is not None and deadline <= self.now:
+                return
+            self._sleepers[thread] = [cond, deadline, False]
+            self._lock.notify_all()
+        try:
+            cond.wait()
+        finally:
+            with self._lock:
+                del self._sleepers[thread]
+                self._lock.notify_all()
+
+    def notify(self, cond):
+        with self._lock:
+            for sleeper in self._sleepers.values():
+                if sleeper[0] is cond:
+                    sleeper[2] = True
+        cond.notify_all()
+
+    def attach(self, thread):
+        with self._lock:
+            self._threads.add(thread)
+
+    def detach(self):
+        with self._lock:
+            self._threads.discard(current_thread())
+            self._lock.notify_all()
+
+    def _is_idle(self):
+        " return: If all the attached threads wait for a later time or a notify. "
+        for thread in self._threads:
+            sleeper = self._sleepers.get(thread)
+            if sleeper is None or sleeper[2] or \
+                    (sleeper[1] is not None and sleeper[1] <= self.now):
+                return False
+        return True
+
+    def advance(self, dt):
+        """
+        Move the time `dt` seconds forward, stopping at each deadline on the
+        way, and return when the attached threads are waiting again.
+        """
+        end = self.now + dt
+        while True:
+            with self._lock:
+                self._lock.wait_for(self._is_idle)
+                deadlines = [
+                    deadline for _, deadline, _ in self._sleepers.values()
+                    if deadline is not None and deadline <= end]
+                if not deadlines:
+                    self.now = end
+                    return
+                self.now = max(self.now, min(deadlines))
+                conds = []
+                for sleeper in self._sleepers.values():
+                    if sleeper[1] is not None and sleeper[1] <= self.now:
+                        sleeper[2] = True
+                        conds.append(sleeper[0])
+            for cond in conds:
+                with cond:
+                    cond.notify_all()
+
+    def run(self, step=1.):
+        " Advance until no attached thread waits for a time, e.g. all ended. "
+        while True:
+            with self._lock:
+                self._lock.wait_for(self._is_idle)
+                if not any(self._sleepers[thread][1] is not None
+                        for thread in self._threads):
+                    return
+            self.advance(step)
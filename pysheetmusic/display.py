@@ -0,0 +1,242 @@
+"""
+Display lists: what a layout draws, as compact arrays of primitives.
+
+A display list is made once from the sprites of a layout, see
+`layout.Layout.make_display_list`, and read by the backends: the GL renders,
+the exporters and hit testing. Its binary form can be saved, memory mapped or
+sent to another process without laying out the sheet again.
+"""
+import mmap
+import struct
+from collections import namedtuple
+import numpy as np
+from . import sprite
+
+# The sprites of a display list that are in no group.
+NO_GROUP = -1
+NO_PLAY_TIME = (-1., -1.)
+ALIGNS = ('left', 'center', 'right')
+
+# Positions are in tenths, the same as the sprites.
+DTYPES = {
+    'groups': np.dtype([('number', '<i4')]),
+    'lines': np.dtype([
+        ('start', '<f4', 2), ('end', '<f4', 2), ('width', '<f4'),
+        ('playTime', '<f4', 2), ('group', '<i4')]),
+    'ledgers': np.dtype([
+        ('pos', '<f4', 2), ('step', '<f4'), ('count', '<i4'), ('group', '<i4')]),
+    'beams': np.dtype([
+        ('start', '<f4', 2), ('end', '<f4', 2), ('height', '<f4'), ('group', '<i4')]),
+    # `glyph` indexes into `DisplayList.glyphNames`, `pos` is the glyph center.
+    'glyphs': np.dtype([
+        ('pos', '<f4', 2), ('playTime', '<f4', 2), ('glyph', '<i4'), ('group', '<i4')]),
+    # `pos` is (x, y) of the text box, with y pointing down as in `sprite.Text`.
+    # The text is text[start:start + length] of the utf-8 `DisplayList.text`.
+    'texts': np.dtype([
+        ('pos', '<f4', 2), ('width', '<f4'), ('fontSize', '<f4'),
+        ('start', '<u4'), ('length', '<u4'), ('align', '<i4'), ('group', '<i4')]),
+}
+
+# A text of a display list, with the attributes of `sprite.Text` that the
+# backends read.
+TextRun = namedtuple('TextRun', 'x y width fontSize align text group')
+
+
+class DisplayList:
+    """
+    box: (x1, y1, x2, y2), the area drawn, y pointing up.
+    glyphNames: The names of the template glyphs.
+    text: The utf-8 bytes of all texts.
+    groups, lines, ledgers, beams, glyphs, texts: Structured arrays, see
+        DTYPES. Each primitive has the index of its group, or NO_GROUP.
+    groupKeys: The key of each group, the measures if made by a layout.
+        Default to the group numbers, e.g. when loaded from bytes.
+    """
+    MAGIC = b'PSMDL'
+    VERSION = 1
+    SECTIONS = ('groups', 'lines', 'ledgers', 'beams', 'glyphs', 'texts')
+    # magic, version, box, then the byte size of the glyph names, the text and
+    # the item count of each section.
+    HEADER = struct.Struct('<5sB2x4d2Q6Q')
+    ALIGN = 8
+
+    def __init__(self, box, glyphNames, text, arrays, groupKeys=None):
+        self.box = tuple(box)
+        self.glyphNames = list(glyphNames)
+        self.text = bytes(text)
+        for name in self.SECTIONS:
+            setattr(self, name, arrays[name])
+        if groupKeys is None:
+            groupKeys = [int(n) for n in self.groups['number']]
+        self.groupKeys = groupKeys
+
+    @classmethod
+    def from_sprite_groups(cls, groups, loose, box):
+        """
+        groups: A list of (key, sprites), see `Layout.get_sprite_groups`.
+        loose: The sprites in no group.
+        """
+        rows = {name: [] for name in cls.SECTIONS[1:]}
+        glyphIds = {}
+        text = bytearray()
+
+        def add(sp, group):
+            playTime = tuple(sp.playTime or NO_PLAY_TIME)
+            if isinstance(sp, sprite.Line):
+                rows['lines'].append((sp.start, sp.end, sp.width, playTime, group))
+            elif isinstance(sp, sprite.Ledger):
+                rows['ledgers'].append((sp.pos, sp.step, sp.count, group))
+            elif isinstance(sp, sprite.Beam):
+                rows['beams'].append((sp.start, sp.end, sp.height, group))
+            elif isinstance(sp, sprite.Texture):
+                glyph = glyphIds.setdefault(sp.name, len(glyphIds))
+                rows['glyphs'].append((sp.pos, playTime, glyph, group))
+            elif isinstance(sp, sprite.Text):
+                data = (sp.text or '').encode('utf-8')
+                align = getattr(sp, 'align', 'left')
+                rows['texts'].append((
+                    (sp.x, sp.y), getattr(sp, 'width', 0) or 0, sp.fontSize,
+                    len(text), len(data),
+                    ALIGNS.index(align) if align in ALIGNS else 0, group))
+                text.extend(data)
+
+        keys = []
+        for i, (key, sprites) in enumerate(groups):
+            keys.append(key)
+            for sp in sprites:
+                add(sp, i)
+        for sp in loose:
+            add(sp, NO_GROUP)
+        arrays = {name: np.array(r, dtype=DTYPES[name]) for name, r in rows.items()}
+        arrays['groups'] = np.array(
+            [(getattr(key, 'number', i),) for i, key in enumerate(keys)],
+            dtype=DTYPES['groups'])
+        return cls(box, sorted(glyphIds, key=glyphIds.get), text, arrays, keys)
+
+    def _padded(self, data):
+        return data + b'\0' * (-len(data) % self.ALIGN)
+
+    def to_bytes(self):
+        names = '\n'.join(self.glyphNames).encode('utf-8')
+        header = self.HEADER.pack(
+            self.MAGIC, self.VERSION, *self.box, len(names), len(self.text),
+            *(len(getattr(self, name)) for name in self.SECTIONS))
+        parts = [header, self._padded(names), self._padded(self.text)]
+        parts.extend(self._padded(getattr(self, name).tobytes())
+            for name in self.SECTIONS)
+        return b''.join(parts)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """
+        Read a display list from the bytes of `to_bytes`. The arrays are views
+        of `buffer`, which may be memory mapped.
+        """
+        header = cls.HEADER.unpack_from(buffer)
+        magic, version = header[0:2]
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('Not a display list of version {}'.format(cls.VERSION))
+        box = header[2:6]
+        namesSize, textSize = header[6:8]
+        counts = header[8:]
+        offset = cls.HEADER.size
+        padded = lambda n: n + (-n % cls.ALIGN)
+        names = bytes(buffer[offset:offset + namesSize]).decode('utf-8')
+        offset += padded(namesSize)
+        text = bytes(buffer[offset:offset + textSize])
+        offset += padded(textSize)
+        arrays = {}
+        for name, count in zip(cls.SECTIONS, counts):
+            dtype = DTYPES[name]
+            if count:
+                arrays[name] = np.frombuffer(buffer, dtype, count, offset)
+            else:
+                arrays[name] = np.zeros(0, dtype)
+            offset += padded(count * dtype.itemsize)
+        return cls(box, names.split('\n') if names else [], text, arrays)
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        " Memory map the display list saved at `path`. "
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(buffer)
+
+    def get_group_key(self, group):
+        return self.groupKeys[group]
+
+    def get_text_runs(self):
+        " return: A TextRun for each text. "
+        text = self.text
+        return [
+            TextRun(float(x), float(y), float(width), float(size), ALIGNS[align],
+                text[start:start + length].decode('utf-8'), int(group))
+            for (x, y), width, size, start, length, align, group in self.texts.tolist()]
+
+    def get_glyph_metrics(self):
+        " return: (len(glyphNames), 4) array of (cx, cy, w, h) of each glyph. "
+        return np.array([sprite.Texture.get_config(name) for name in self.glyphNames],
+            dtype=float).reshape(-1, 4)
+
+    def get_glyph_boxes(self):
+        " return: (n, 4) boxes of the glyphs, see `spatial.texture_box`. "
+        cx, cy, w, h = self.get_glyph_metrics()[self.glyphs['glyph']].T
+        x, y = self.glyphs['pos'].astype(float).T
+        return np.stack([x - cx, y - (h - cy), x - cx + w, y + cy], axis=1)
+
+    def iter_ledger_lines(self):
+        " Yield (x1, y1, x2, y2, width, group) of each line of the ledgers. "
+        w = sprite.Ledger.WIDTH / 2
+        for (x, y), step, count, group in self.ledgers.tolist():
+            for i in range(count):
+                y1 = y + i * step
+                yield x - w, y1, x + w, y1, sprite.Ledger.THICK, group
+
+    def get_group_boxes(self):
+        """
+        return: (len(groups), 4) boxes around the lines, beams and glyphs of
+            each group. The boxes of empty groups are (inf, inf, -inf, -inf).
+        """
+        boxes = np.empty((len(self.groups), 4))
+        boxes[:, :2] = np.inf
+        boxes[:, 2:] = -np.inf
+        parts = [(self.get_glyph_boxes(), self.glyphs['group'])]
+        for items in (self.lines, self.beams):
+            start = items['start'].astype(float)
+            end = items['end'].astype(float)
+            parts.append((np.concatenate(
+                [np.minimum(start, end), np.maximum(start, end)], axis=1),
+                items['group']))
+        # Beams reach `height` above their edge.
+        beamBoxes = parts[-1][0]
+        height = self.beams['height']
+        beamBoxes[:, 1] += np.minimum(height, 0)
+        beamBoxes[:, 3] += np.maximum(height, 0)
+        for itemBoxes, groups in parts:
+            grouped = groups >= 0
+            groups = groups[grouped]
+            itemBoxes = itemBoxes[grouped]
+            np.minimum.at(boxes[:, 0], groups, itemBoxes[:, 0])
+            np.minimum.at(boxes[:, 1], groups, itemBoxes[:, 1])
+            np.maximum.at(boxes[:, 2], groups, itemBoxes[:, 2])
+            np.maximum.at(boxes[:, 3], groups, itemBoxes[:, 3])
+        return boxes
+
+    def make_index(self):
+        """
+        return: A `spatial.SpatialIndex` of the groups, as
+            (PickKind.MEASURE, key), and the glyphs, as (PickKind.GLYPH, i).
+        """
+        from .spatial import SpatialIndex, PickKind
+        index = SpatialIndex()
+        for key, box in zip(self.groupKeys, self.get_group_boxes().tolist()):
+            if box[0] <= box[2]:
+                index.add(box, (PickKind.MEASURE, key))
+        for i, box in enumerate(self.get_glyph_boxes().tolist()):
+            index.add(box, (PickKind.GLYPH, i))
+        index.build()
+        return index
@@ -0,0 +1,321 @@
+"""
+Export laid out sheets to SVG or PDF without a GL context.
+
+The display list of each page is turned into plain primitives in the
+calling process, then the pages are written by a pool of processes. Glyphs are
+written once as shared symbols: an image in the SVG <defs>, or an image
+XObject of the PDF, which each placed glyph refers to.
+"""
+import io
+import zlib
+import base64
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape, quoteattr
+import numpy as np
+import PIL.Image
+import PIL.ImageFont
+from . import sprite
+from .atlas import get_template_atlas, TextAtlas
+from .layout import PagesLayout
+
+
+class PageItems:
+    """
+    The primitives of one page, in tenths with y pointing up.
+
+    box: (x1, y1, x2, y2), the area of the page.
+    lines: (x1, y1, x2, y2, width) of each line.
+    beams: (x1, y1, x2, y2, height) of each beam, a parallelogram with
+        vertical sides.
+    glyphs: (name, x1, y1, x2, y2) of each template glyph.
+    texts: (x, baseline, fontSize, text) of each text.
+    """
+
+    def __init__(self, box):
+        self.box = box
+        self.lines = []
+        self.beams = []
+        self.glyphs = []
+        self.texts = []
+
+    @classmethod
+    def from_display_list(cls, dl):
+        " dl: A `display.DisplayList`. "
+        items = cls(dl.box)
+        lines = dl.lines
+        items.lines = np.concatenate([
+            lines['start'], lines['end'], lines['width'][:, None]], axis=1).tolist()
+        items.lines.extend(line[:5] for line in dl.iter_ledger_lines())
+        beams = dl.beams
+        items.beams = np.concatenate([
+            beams['start'], beams['end'], beams['height'][:, None]], axis=1).tolist()
+        names = dl.glyphNames
+        items.glyphs = [(names[glyph],) + tuple(box) for glyph, box in zip(
+            dl.glyphs['glyph'].tolist(), dl.get_glyph_boxes().tolist())]
+        items.texts = [get_text_origin(run) + (run.fontSize, run.text)
+            for run in dl.get_text_runs() if run.text]
+        return items
+
+
+@lru_cache()
+def get_font():
+    return PIL.ImageFont.load_default(TextAtlas.PIXEL_SIZE)
+
+
+def get_text_origin(sp):
+    """
+    return: (x, baseline) of a Text sprite or a `display.TextRun`, aligned in its box the same way
+        as `render.TextGlyphRender` does.
+    """
+    font = get_font()
+    k = sp.fontSize / TextAtlas.PIXEL_SIZE
+    x = sp.x
+    width = getattr(sp, 'width', 0)
+    align = getattr(sp, 'align', 'left')
+    length = font.getlength(sp.text) * k
+    if width and align == 'center':
+        x += (width - length) / 2
+    elif width and align == 'right':
+        x += width - length
+    ascent, _ = font.getmetrics()
+    # Text boxes have y pointing down, see `sprite.Text.put`.
+    return x, -sp.y - ascent * k
+
+
+def get_pages(layout):
+    " return: A PageItems for each page of `layout`. "
+    if isinstance(layout, PagesLayout):
+        lists = [layout.make_display_list(i) for i in range(len(layout.sheet.pages))]
+    else:
+        lists = [layout.make_display_list()]
+    return [PageItems.from_display_list(dl) for dl in lists]
+
+
+@lru_cache(maxsize=None)
+def get_glyph_image(name):
+    " return: The PIL RGBA image of template glyph `name`, without its margin. "
+    atlas = get_template_atlas()
+    x, y, w, h = atlas.rects[name]
+    m = sprite.Texture.MARGIN
+    pixels = atlas.pixels[y + m:y + h - m, x + m:x + w - m]
+    return PIL.Image.fromarray(pixels.copy(), 'RGBA')
+
+
+def fmt(v):
+    s = '{:.2f}'.format(v).rstrip('0').rstrip('.')
+    return '0' if s == '-0' else s
+
+
+def write_svg_page(items, path, mm):
+    """
+    Write `items` to the SVG file `path`.
+    mm: Millimeters per tenth.
+    """
+    x0, y0, x1, y1 = items.box
+    flipY = lambda y: fmt(y1 - y)
+    with open(path, 'w', encoding='utf-8') as file:
+        write = file.write
+        write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        write('<svg xmlns="http://www.w3.org/2000/svg" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'width="{}mm" height="{}mm" viewBox="0 0 {} {}">\n'.format(
+                fmt((x1 - x0) * mm), fmt((y1 - y0) * mm),
+                fmt(x1 - x0), fmt(y1 - y0)))
+        write('<defs>\n')
+        for name in sorted({g[0] for g in items.glyphs}):
+            image = get_glyph_image(name)
+            data = io.BytesIO()
+            image.save(data, 'PNG')
+            k = sprite.Texture.TEXTURE_TO_TENTHS
+            write('<image id={} width="{}" height="{}" xlink:href="data:image/png;'
+                'base64,{}"/>\n'.format(
+                    quoteattr('g-' + name), fmt(image.size[0] * k),
+                    fmt(image.size[1] * k),
+                    base64.b64encode(data.getvalue()).decode('ascii')))
+        write('</defs>\n')
+        write('<g transform="translate({},0)">\n'.format(fmt(-x0)))
+        byWidth = {}
+        for x1_, y1_, x2_, y2_, width in items.lines:
+            byWidth.setdefault(width, []).append('M{} {}L{} {}'.format(
+                fmt(x1_), flipY(y1_), fmt(x2_), flipY(y2_)))
+        for width, paths in sorted(byWidth.items()):
+            write('<path stroke="#000" fill="none" stroke-width="{}" d="{}"/>\n'
+                .format(fmt(width), ''.join(paths)))
+        if items.beams:
+            paths = ['M{0} {1}L{2} {3}L{2} {4}L{0} {5}Z'.format(
+                fmt(x1_), flipY(y1_), fmt(x2_), flipY(y2_),
+                flipY(y2_ + h), flipY(y1_ + h))
+                for x1_, y1_, x2_, y2_, h in items.beams]
+            write('<path fill="#000" d="{}"/>\n'.format(''.join(paths)))
+        for name, gx1, gy1, gx2, gy2 in items.glyphs:
+            write('<use xlink:href={} x="{}" y="{}"/>\n'.format(
+                quoteattr('#g-' + name), fmt(gx1), flipY(gy2)))
+        for x, y, size, text in items.texts:
+            write('<text x="{}" y="{}" font-size="{}" font-family="sans-serif">'
+                '{}</text>\n'.format(fmt(x), flipY(y), fmt(size), escape(text)))
+        write('</g>\n</svg>\n')
+    return path
+
+
+def make_pdf_content(items):
+    """
+    return: (content, glyphNames). `content` is the deflated content stream
+        of a page in tenths, which draws glyph `glyphNames[i]` as /G{i}.
+    """
+    x0, y0, _, _ = items.box
+    ops = []
+    add = ops.append
+    add('0 g 0 G')
+    byWidth = {}
+    for line in items.lines:
+        byWidth.setdefault(line[4], []).append(line)
+    for width, lines in sorted(byWidth.items()):
+        add('{} w'.format(fmt(width)))
+        for x1, y1, x2, y2, _ in lines:
+            add('{} {} m {} {} l'.format(
+                fmt(x1 - x0), fmt(y1 - y0), fmt(x2 - x0), fmt(y2 - y0)))
+        add('S')
+    for x1, y1, x2, y2, h in items.beams:
+        x1 -= x0
+        x2 -= x0
+        y1 -= y0
+        y2 -= y0
+        add('{0} {1} m {2} {3} l {2} {4} l {0} {5} l h'.format(
+            fmt(x1), fmt(y1), fmt(x2), fmt(y2), fmt(y2 + h), fmt(y1 + h)))
+    if items.beams:
+        add('f')
+    names = sorted({g[0] for g in items.glyphs})
+    ids = {name: i for i, name in enumerate(names)}
+    for name, gx1, gy1, gx2, gy2 in items.glyphs:
+        add('q {} 0 0 {} {} {} cm /G{} Do Q'.format(
+            fmt(gx2 - gx1), fmt(gy2 - gy1), fmt(gx1 - x0), fmt(gy1 - y0),
+            ids[name]))
+    for x, y, size, text in items.texts:
+        text = text.encode('cp1252', 'replace').decode('latin-1')
+        text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        add('BT /F1 {} Tf {} {} Td ({}) Tj ET'.format(
+            fmt(size), fmt(x - x0), fmt(y - y0), text))
+    content = '\n'.join(ops).encode('latin-1')
+    return zlib.compress(content), names
+
+
+class PDFWriter:
+    " Write PDF objects to a file and keep the offsets for the xref table. "
+
+    def __init__(self, file):
+        self.file = file
+        self.offsets = []
+        file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def reserve(self):
+        " return: The number of a new object, written later by `write`. "
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def write(self, id, dict, stream=None):
+        self.offsets[id - 1] = self.file.tell()
+        if stream is not None:
+            dict = dict + ' /Length {}'.format(len(stream))
+        self.file.write('{} 0 obj\n<<{}>>\n'.format(id, dict).encode('latin-1'))
+        if stream is not None:
+            self.file.write(b'stream\n' + stream + b'\nendstream\n')
+        self.file.write(b'endobj\n')
+
+    def close(self, root):
+        start = self.file.tell()
+        lines = ['xref', '0 {}'.format(len(self.offsets) + 1), '0000000000 65535 f ']
+        lines.extend('{:010d} 00000 n '.format(o) for o in self.offsets)
+        lines.append('trailer\n<</Size {} /Root {} 0 R>>'.format(
+            len(self.offsets) + 1, root))
+        lines.append('startxref\n{}\n%%EOF\n'.format(start))
+        self.file.write('\n'.join(lines).encode('latin-1'))
+
+
+def write_pdf(pages, contents, path, mm):
+    """
+    Write one PDF document with the pages, sharing the glyph images.
+    contents: The `make_pdf_content` result of each page.
+    """
+    scale = mm / 25.4 * 72
+    with open(path, 'wb') as file:
+        pdf = PDFWriter(file)
+        catalog = pdf.reserve()
+        pagesId = pdf.reserve()
+        font = pdf.reserve()
+        pdf.write(font, '/Type /Font /Subtype /Type1 /BaseFont /Helvetica'
+            ' /Encoding /WinAnsiEncoding')
+        images = {}
+        for name in sorted({name for _, names in contents for name in names}):
+            image = get_glyph_image(name)
+            w, h = image.size
+            mask = pdf.reserve()
+            pdf.write(mask, '/Type /XObject /Subtype /Image /Width {} /Height {}'
+                ' /ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode'
+                .format(w, h), zlib.compress(image.getchannel('A').tobytes()))
+            images[name] = pdf.reserve()
+            pdf.write(images[name], '/Type /XObject /Subtype /Image /Width {}'
+                ' /Height {} /ColorSpace /DeviceRGB /BitsPerComponent 8'
+                ' /Filter /FlateDecode /SMask {} 0 R'.format(w, h, mask),
+                zlib.compress(image.convert('RGB').tobytes()))
+        # The contents of the pages are in tenths, scaled to points by this
+        # stream before each of them.
+        scaleStream = pdf.reserve()
+        pdf.write(scaleStream, '',
+            '{} 0 0 {} 0 0 cm\n'.format(scale, scale).encode('latin-1'))
+        kids = []
+        for items, (content, names) in zip(pages, contents):
+            x0, y0, x1, y1 = items.box
+            contentId = pdf.reserve()
+            pdf.write(contentId, '/Filter /FlateDecode', content)
+            xobjects = ' '.join('/G{} {} 0 R'.format(i, images[name])
+                for i, name in enumerate(names))
+            page = pdf.reserve()
+            pdf.write(page, '/Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}]'
+                ' /Contents [{} 0 R {} 0 R] /Resources <</Font <</F1 {} 0 R>>'
+                ' /XObject <<{}>>>>'.format(
+                    pagesId, fmt((x1 - x0) * scale), fmt((y1 - y0) * scale),
+                    scaleStream, contentId, font, xobjects))
+            kids.append(page)
+        pdf.write(pagesId, '/Type /Pages /Kids [{}] /Count {}'.format(
+            ' '.join('{} 0 R'.format(k) for k in kids), len(kids)))
+        pdf.write(catalog, '/Type /Catalog /Pages {} 0 R'.format(pagesId))
+        pdf.close(catalog)
+    return path
+
+
+def get_millimeters(layout):
+    scaling = layout.sheet.scaling
+    return scaling.mm / scaling.tenths
+
+
+def map_pages(func, args, processes):
+    " Call `func` on each of `args` in a pool of `processes` processes. "
+    if processes == 1 or len(args) <= 1:
+        return [func(*a) for a in args]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(func, *zip(*args)))
+
+
+def export_svg(layout, path, processes=None):
+    """
+    Write each page of `layout` to an SVG file.
+    path: The file path, formatted with the page number from 1, like
+        'sheet-{page}.svg'.
+    processes: The number of processes, default to the number of CPUs.
+    return: The paths written.
+    """
+    mm = get_millimeters(layout)
+    pages = get_pages(layout)
+    args = [(items, path.format(page=i + 1), mm) for i, items in enumerate(pages)]
+    return map_pages(write_svg_page, args, processes)
+
+
+def export_pdf(layout, path, processes=None):
+    """
+    Write all the pages of `layout` into the PDF file `path`. The page
+    contents are made in parallel, see `export_svg`.
+    """
+    pages = get_pages(layout)
+    contents = map_pages(make_pdf_content, [(items,) for items in pages], processes)
+    return write_pdf(pages, contents, path, get_millimeters(layout))
@@ -0,0 +1,211 @@
+"""
+Choose strings, frets and fingers for guitar music.
+
+Each group of notes played together is a chord. A state of a chord is one way
+to play it: a string for every note and the fret where the index finger lies
+(the hand position). The states of consecutive chords are connected by the
+cost of moving the hand, and the cheapest path through all chords is found
+with dynamic programming (Viterbi).
+"""
+import numpy as np
+
+# Pitch levels of the open strings, from string 1 to string 6.
+STANDARD_TUNING = (64, 59, 55, 50, 45, 40)
+
+INF = float('inf')
+
+
+class ChordStates:
+    """
+    All the ways to play one chord.
+
+    strings, frets, fingers: (nStates, nNotes) int arrays. String 0 means the
+        note can not be played.
+    hand: (nStates,) the hand position.
+    fretted: (nStates,) whether any note is pressed. The hand position of an
+        open chord does not matter.
+    cost: (nStates,) the cost of the chord shape itself.
+    """
+
+    def __init__(self, strings, frets, fingers, hand, fretted, cost):
+        self.strings = strings
+        self.frets = frets
+        self.fingers = fingers
+        self.hand = hand
+        self.fretted = fretted
+        self.cost = cost
+
+    def __len__(self):
+        return len(self.cost)
+
+
+class FingeringEngine:
+    """
+    chords: A list of pitch level sequences, in playing order. Pitches in one
+        chord should be distinct.
+
+    After `solve`, `choices[i]` is the chosen state of chord i, see `get`.
+    """
+    N_FRETS = 19
+    N_FINGERS = 4
+    # The hand can stretch to this many frets beyond its four fingers.
+    MAX_STRETCH = 1
+
+    SHIFT_COST = 1.
+    # Paid once for any change of hand position.
+    SHIFT_PENALTY = 2.
+    STRETCH_COST = 3.
+    # Per fret of hand position, prefer the lower positions.
+    POSITION_COST = .2
+    # Open strings need no finger.
+    OPEN_STRING_COST = -.5
+
+    def __init__(self, chords, tuning=STANDARD_TUNING):
+        self.tuning = np.array(tuning)
+        self.chords = [tuple(chord) for chord in chords]
+        cache = {}
+        self.states = []
+        for chord in self.chords:
+            if chord not in cache:
+                cache[chord] = self.make_states(chord)
+            self.states.append(cache[chord])
+        n = len(self.chords)
+        self.pins = {}
+        self._acc = [None] * n
+        self._back = [None] * n
+        self.choices = [None] * n
+        self._solved = 0
+
+    def make_states(self, pitches):
+        tuning = self.tuning
+        m = len(pitches)
+        if m == 0:
+            zeros = np.zeros((1, 0), dtype=int)
+            return ChordStates(
+                zeros, zeros, zeros, np.zeros(1), np.zeros(1, dtype=bool),
+                np.zeros(1))
+        # Candidate strings of each note.
+        options = []
+        for pitch in pitches:
+            frets = pitch - tuning
+            strings = np.nonzero((frets >= 0) & (frets <= self.N_FRETS))[0] + 1
+            options.append(strings if len(strings) else np.array([0]))
+        grids = np.meshgrid(*options, indexing='ij')
+        strings = np.stack([g.ravel() for g in grids], axis=1)
+        # One note per string.
+        s = np.sort(strings, axis=1)
+        strings = strings[~((s[:, 1:] == s[:, :-1]) & (s[:, 1:] > 0)).any(axis=1)]
+        if not len(strings):
+            strings = np.zeros((1, m), dtype=int)
+        played = strings > 0
+        frets = np.where(played, np.array(pitches) - tuning[strings - 1], 0)
+        pressed = frets > 0
+        fretted = pressed.any(axis=1)
+        low = np.where(pressed, frets, INF).min(axis=1)
+        high = np.where(pressed, frets, -INF).max(axis=1)
+        low[~fretted] = high[~fretted] = 0
+        span = high - low
+        maxSpan = self.N_FINGERS - 1 + self.MAX_STRETCH
+        ok = span <= maxSpan
+        if ok.any():
+            strings, frets, pressed, fretted, low, high = (
+                a[ok] for a in (strings, frets, pressed, fretted, low, high))
+        # Every hand position that covers the pressed frets.
+        offsets = np.arange(self.N_FINGERS)
+        hand = low[:, None] - offsets[None, :]
+        valid = (hand >= np.maximum(1, high - (self.N_FINGERS - 1))[:, None]) \
+            | (offsets[None, :] == 0)
+        valid[~fretted, 1:] = False
+        rows, cols = np.nonzero(valid)
+        hand = hand[rows, cols]
+        strings, frets, pressed, fretted, high = (
+            a[rows] for a in (strings, frets, pressed, fretted, high))
+        fingers = np.where(
+            pressed, np.clip(frets - hand[:, None] + 1, 1, self.N_FINGERS), 0)\
+            .astype(int)
+        # A finger can press one fret only, so a stretch beyond the fourth
+        # finger must not fall on a fret the fourth finger already presses.
+        both = pressed[:, :, None] & pressed[:, None, :]
+        clash = (both & (fingers[:, :, None] == fingers[:, None, :])
+            & (frets[:, :, None] != frets[:, None, :])).any(axis=(1, 2))
+        if not clash.all():
+            keep = ~clash
+            strings, frets, pressed, fretted, high, hand, fingers = (
+                a[keep] for a in (strings, frets, pressed, fretted, high, hand, fingers))
+        stretch = np.maximum(0, high - hand - (self.N_FINGERS - 1))
+        nOpen = ((strings > 0) & ~pressed).sum(axis=1)
+        cost = self.POSITION_COST * hand * fretted \
+            + self.STRETCH_COST * stretch \
+            + self.OPEN_STRING_COST * nOpen
+        return ChordStates(strings, frets, fingers, hand, fretted, cost)
+
+    def transition(self, a, b):
+        " return: (len(a), len(b)) costs of moving from states `a` to states `b`. "
+        d = np.abs(a.hand[:, None] - b.hand[None, :])
+        both = a.fretted[:, None] & b.fretted[None, :]
+        return np.where(both, self.SHIFT_COST * d + self.SHIFT_PENALTY * (d > 0), 0)
+
+    def _chord_cost(self, i):
+        states = self.states[i]
+        cost = states.cost
+        for slot, string in self.pins.get(i, {}).items():
+            cost = np.where(states.strings[:, slot] == string, cost, INF)
+        return cost
+
+    def solve(self):
+        """
+        Find the cheapest fingering of all chords. Only the chords after the
+        earliest change since the last call are recomputed.
+        return: The indexes of the chords whose choices changed.
+        """
+        n = len(self.states)
+        states = self.states
+        acc = self._acc
+        back = self._back
+        for i in range(self._solved, n):
+            cost = self._chord_cost(i)
+            if i == 0:
+                acc[i] = cost
+                continue
+            total = acc[i - 1][:, None] + self.transition(states[i - 1], states[i])
+            b = back[i] = total.argmin(axis=0)
+            acc[i] = total[b, np.arange(len(b))] + cost
+        self._solved = n
+        changed = []
+        if n == 0:
+            return changed
+        k = int(acc[-1].argmin())
+        for i in range(n - 1, -1, -1):
+            if self.choices[i] != k:
+                self.choices[i] = k
+                changed.append(i)
+            if i > 0:
+                k = int(back[i][k])
+        changed.reverse()
+        return changed
+
+    def pin(self, chordId, slot, string):
+        """
+        Force note `slot` of chord `chordId` onto `string`, or release the pin if
+        `string` is None. Call `solve` to update the choices.
+        Raise ValueError if the note can not be played on `string`.
+        """
+        states = self.states[chordId]
+        pins = self.pins.setdefault(chordId, {})
+        if string is None:
+            pins.pop(slot, None)
+        elif not (states.strings[:, slot] == string).any():
+            raise ValueError('Pitch {} can not be played on string {}'.format(
+                self.chords[chordId][slot], string))
+        else:
+            pins[slot] = string
+        self._solved = min(self._solved, chordId)
+
+    def get(self, chordId):
+        """
+        return: (strings, frets, fingers) of the chosen state of chord
+            `chordId`, each has one element for every note.
+        """
+        states = self.states[chordId]
+        k = self.choices[chordId]
+        return states.strings[k], states.frets[k], states.fingers[k]
@@ -1,23 +1,128 @@
+from collections import defaultdict
 from .tab import TabMeasure
+from .spatial import make_measures_index
+from .sprite import Line, StaffLine
+from .display import DisplayList
+
+# Staff lines closer than this are joined.
+STAFF_LINE_JOIN_GAP = .5
+
+
+def merge_staff_lines(sprites):
+    """
+    Replace the placed staff lines of adjacent measures with one line for each
+    run of touching segments at the same height, usually one for each staff
+    line of a system. The StaffLine sprites themselves are left untouched.
+    return: A new list of sprites.
+    """
+    result = []
+    rows = defaultdict(list)
+    for sp in sprites:
+        if isinstance(sp, StaffLine):
+            x1, x2 = sorted((sp.start[0], sp.end[0]))
+            rows[round(sp.start[1], 3), sp.width].append((x1, x2, sp.start[1]))
+        else:
+            result.append(sp)
+    for (_, width), segments in rows.items():
+        segments.sort()
+        x1, x2, y = segments[0]
+        for x3, x4, _ in segments[1:]:
+            if x3 > x2 + STAFF_LINE_JOIN_GAP:
+                result.append(Line((x1, y), (x2, y), width))
+                x1 = x3
+            x2 = max(x2, x4)
+        result.append(Line((x1, y), (x2, y), width))
+    return result
 
 class Layout:
+    reflowable = False
+
     def __init__(self, sheet):
         self.sheet = sheet
         self.sprites = []
         self.size = (0, 0)
         self.defaultViewPoint = (0, 0)
+        # A SpatialIndex over what is shown, see `spatial.make_measures_index`.
+        self.index = None
 
     def layout(self):
         pass
-    
+
+    def reflow(self, width):
+        """
+        Fit the layout into `width`.
+        return: True if the sprites are moved.
+        """
+        return False
+
+    def iter_measures(self):
+        " Iterate the measures shown by the layout. "
+        return self.sheet.iter_measures()
+
+    def get_measure_sprites(self, measure):
+        """
+        return: The sprites of `measure` that are drawn by themselves. Staff
+            lines are not, see `merge_staff_lines`.
+        """
+        return [sp for sp in measure.sprites if not isinstance(sp, StaffLine)]
+
+    def get_sprite_groups(self):
+        """
+        return: (groups, loose). `groups` is a list of (measure, sprites) for
+            every shown measure, and `loose` holds the other sprites, like the
+            merged staff lines, system headers and credits.
+        """
+        return self._group_sprites(self.iter_measures(), self.sprites)
+
+    def _group_sprites(self, measures, sprites):
+        groups = [(m, self.get_measure_sprites(m)) for m in measures]
+        grouped = {id(sp) for _, sps in groups for sp in sps}
+        loose = [sp for sp in sprites if id(sp) not in grouped]
+        return groups, loose
+
+    def get_box(self):
+        " return: The box (x1, y1, x2, y2) of the layout, growing down from y = 0. "
+        w, h = self.size
+        return (0, -h, w, 0)
+
+    def make_display_list(self):
+        " return: A `display.DisplayList` of the shown sprites, grouped by measure. "
+        groups, loose = self.get_sprite_groups()
+        return DisplayList.from_sprite_groups(groups, loose, self.get_box())
+
+    def replace_sprites(self, old, new):
+        " Replace sprites `old` with `new`, e.g. after a measure is edited. "
+        oldIds = {id(sp) for sp in old}
+        self.sprites[:] = [sp for sp in self.sprites if id(sp) not in oldIds]
+        self.sprites.extend(new)
+
+    def update_index(self):
+        " Index the shown measures again, after their sprites are edited. "
+        if self.index is not None:
+            self.index = make_measures_index(self.iter_measures())
+
 
 class PagesLayout(Layout):
+    """
+    Put the measures on the pages of the sheet, one page shown at a time.
+
+    nPages: Only lay out this many pages from the first, e.g. for a
+        thumbnail. The other pages are left empty.
+    """
+    def __init__(self, sheet, nPages=None):
+        super().__init__(sheet)
+        self.nPages = nPages
+
     def layout(self):
         sheet = self.sheet
-        for page in sheet.pages:
+        pages = sheet.pages[:self.nPages]
+        pageIds = set(map(id, pages))
+        for page in pages:
             page.add_border()
         for measure in sheet.iter_measures():
             page = measure.page
+            if id(page) not in pageIds:
+                break
             measure.layout_objects()
             if measure.isNewPage:
                 measure.y = (page.size[1] - page.margins.top 
@@ -34,15 +139,41 @@ class PagesLayout(Layout):
                 sprite.put((measure.x, measure.y))
                 measure.page.add_sprite(sprite)
 
+        for page in pages:
+            page.sprites = merge_staff_lines(page.sprites)
+        self.indexes = [
+            make_measures_index(page.measures if id(page) in pageIds else [])
+            for page in sheet.pages]
         self.switch_page(0)
 
     def switch_page(self, pageId):
         self.pageId = pageId
         page = self.sheet.pages[pageId]
         self.sprites = page.sprites
+        self.index = self.indexes[pageId]
         self.size = page.size
         self.defaultViewPoint = (page.size[0] / 2, page.size[1] / 2)
 
+    def iter_measures(self):
+        return iter(self.sheet.pages[self.pageId].measures)
+
+    def update_index(self):
+        super().update_index()
+        self.indexes[self.pageId] = self.index
+
+    def get_box(self):
+        w, h = self.size
+        return (0, 0, w, h)
+
+    def make_display_list(self, pageId=None):
+        " pageId: The page to list, default to the shown one. "
+        if pageId is None:
+            pageId = self.pageId
+        page = self.sheet.pages[pageId]
+        groups, loose = self._group_sprites(page.measures, page.sprites)
+        w, h = page.size
+        return DisplayList.from_sprite_groups(groups, loose, (0, 0, w, h))
+
     def next_page(self):
         self.switch_page((self.pageId + 1) % len(self.sheet.pages))
 
@@ -51,7 +182,38 @@ class PagesLayout(Layout):
 
 
 class LinearLayout(Layout):
+    """
+    Put all the measures in one long page.
+
+    If `width` is given, the system breaks of the file are ignored. The measures
+    are laid out once, then `reflow` breaks them into systems that fit `width`,
+    and can be called again whenever the width changes.
+    """
+    # Used when the file gives no distance between systems.
+    SYSTEM_DISTANCE = 100
+    # Minimal gap between the lowest object of a system and the highest object
+    # of the next one.
+    SYSTEM_GAP = 20
+    # Cost of an overfull system, per tenth squared.
+    OVERFULL_PENALTY = 1000
+
+    def __init__(self, sheet, width=None):
+        super().__init__(sheet)
+        self.width = width
+        self.measures = []
+        self._headers = {}
+        self._placed = {}
+        # The first measures of the systems, when reflowable.
+        self.systemStarts = set()
+
+    @property
+    def reflowable(self):
+        return self.width is not None
+
     def layout(self):
+        if self.reflowable:
+            self.layout_reflow()
+            return
         sheet = self.sheet
         y = 0
         width = 0
@@ -78,10 +240,148 @@ class LinearLayout(Layout):
             for sprite in measure.sprites:
                 sprite.put((measure.x, measure.y))
                 self.sprites.append(sprite)
+        self.sprites = merge_staff_lines(self.sprites)
         self.size = (width, height)
+        self.index = make_measures_index(sheet.iter_measures())
+
+    def layout_reflow(self):
+        sheet = self.sheet
+        self.measures = measures = list(sheet.iter_measures())
+        if not measures:
+            return
+        first = measures[0]
+        self.systemDistance = max(m.systemDistance for m in measures) \
+            or self.SYSTEM_DISTANCE
+        margins = sheet.pages[0].margins
+        self.top = margins.top + first.topSystemDistance
+        systemMargins = first.systemMargins
+        self.left = margins.left + (systemMargins.left if systemMargins else 0)
+        self.right = margins.right + (systemMargins.right if systemMargins else 0)
+        for measure in measures:
+            # System headers are made by `reflow`, so the measures themselves
+            # are laid out without clefs and keys. The breaks of the score
+            # are kept for the other layouts.
+            breaks = measure.isNewSystem, measure.isNewPage
+            measure.isNewSystem = measure.isNewPage = False
+            measure.layout_objects()
+            measure.isNewSystem, measure.isNewPage = breaks
+        width = self.width
+        self.width = None
+        self.reflow(width)
+
+    def reflow(self, width):
+        if width == self.width or not self.measures:
+            return False
+        self.width = width
+        self.place_systems(self.break_systems(width))
+        return True
+
+    def iter_measures(self):
+        if self.reflowable:
+            return iter(self.measures)
+        return self.sheet.iter_measures()
+
+    def get_header(self, measure):
+        " return: (sprites, width) of the header when `measure` starts a system. "
+        try:
+            return self._headers[measure]
+        except KeyError:
+            header = self._headers[measure] = measure.make_header()
+            return header
+
+    def break_systems(self, width):
+        """
+        Find the system breaks that minimize the sum of squared spaces left at
+        the right of each system, except the last one.
+        return: A list of systems. Each system is a list of measures.
+        """
+        measures = self.measures
+        n = len(measures)
+        avail = width - self.left - self.right
+        # ends[i]: The right of measure i - 1 in a system starting at measure 0.
+        ends = [0.] * (n + 1)
+        for i, measure in enumerate(measures):
+            ends[i + 1] = ends[i] + measure.measureDistance + measure.width
+        INF = float('inf')
+        costs = [0.] + [INF] * n
+        starts = [0] * (n + 1)
+        for i in range(n):
+            if costs[i] == INF:
+                continue
+            measure = measures[i]
+            x0 = ends[i] + measure.measureDistance - self.get_header(measure)[1]
+            for j in range(i + 1, n + 1):
+                space = avail - (ends[j] - x0)
+                if space >= 0:
+                    cost = 0 if j == n else space * space
+                elif j == i + 1:
+                    cost = self.OVERFULL_PENALTY * space * space
+                else:
+                    break
+                if costs[i] + cost < costs[j]:
+                    costs[j] = costs[i] + cost
+                    starts[j] = i
+        systems = []
+        j = n
+        while j > 0:
+            i = starts[j]
+            systems.append(measures[i:j])
+            j = i
+        systems.reverse()
+        return systems
+
+    def place_systems(self, systems):
+        placed = self._placed
+        self.systemStarts = {system[0] for system in systems}
+        self.sprites = sprites = []
+        y = - self.top
+        prevBottom = None
+        width = 0
+        for system in systems:
+            first = system[0]
+            top = max(m.topY for m in system)
+            if prevBottom is None:
+                y -= first.height
+            else:
+                y -= first.height + max(
+                    self.systemDistance,
+                    top - first.height - prevBottom + self.SYSTEM_GAP)
+            prevBottom = min(m.bottomY for m in system)
+            headerSprites, x = self.get_header(first)
+            x += self.left
+            for sp in headerSprites:
+                sp.unput(placed.get(id(sp), (0, 0)))
+                sp.put((self.left, y))
+                placed[id(sp)] = (self.left, y)
+            sprites.extend(headerSprites)
+            for measure in system:
+                if measure is not first:
+                    x += measure.measureDistance
+                measure.x = x
+                measure.y = y
+                pos0 = placed.get(id(measure), (0, 0))
+                if pos0 != (x, y):
+                    for sp in measure.sprites:
+                        sp.unput(pos0)
+                        sp.put((x, y))
+                    placed[id(measure)] = (x, y)
+                sprites.extend(measure.sprites)
+                x += measure.width
+            width = max(width, x + self.right)
+        self.sprites = merge_staff_lines(sprites)
+        self.index = make_measures_index(self.measures)
+        page = self.sheet.pages[0]
+        self.size = (max(width, self.width), - y - prevBottom + 100)
+        self.defaultViewPoint = (self.size[0] / 2, -page.size[1] / 2)
 
 
 class LinearTabLayout(Layout):
+    def get_measure_sprites(self, measure):
+        sprites = super().get_measure_sprites(measure)
+        sprites.extend(
+            sp for sp in measure.tab.sprites if not isinstance(sp, StaffLine))
+        return sprites
+
     def layout(self):
         sheet = self.sheet
         y = 0
@@ -131,6 +431,8 @@ class LinearTabLayout(Layout):
 
         height = - y + 100
 
+        self.sprites = merge_staff_lines(self.sprites)
         page = sheet.pages[0]
         self.defaultViewPoint = (page.size[0] / 2, -page.size[1] / 2)
         self.size = (width, height)
+        self.index = make_measures_index(sheet.iter_measures())
@@ -0,0 +1,189 @@
+"""
+Where the player sends its MIDI messages.
+
+The player writes the messages of each scheduler tick in one call to
+`Output.write`, as a list of (data, time): `data` is [status, data1, data2]
+and `time` when it should sound, in seconds of the player clock.
+"""
+import struct
+
+
+class Output:
+    """
+    latency: Milliseconds. The player writes messages this much before they
+        are due, and the output sends them at their time, see
+        `Player._run`. With 0 they are written when due.
+    """
+    latency = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, messages, now):
+        """
+        Send or queue `messages`. The base output drops them.
+        messages: A list of ([status, data1, data2], time).
+        now: The time of the player clock.
+        """
+        pass
+
+    def abort(self, now):
+        " Drop the messages written that are due after `now`. "
+        pass
+
+
+class NullOutput(Output):
+    " Drop all messages, e.g. to play with no MIDI device. "
+
+
+class RecordingOutput(Output):
+    """
+    Keep the messages, for tests.
+
+    messages: A list of (time, data) of the messages kept.
+    writes: The number of calls to `write`.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.messages = []
+        self.writes = 0
+        self.isOpen = False
+
+    def open(self):
+        self.isOpen = True
+
+    def close(self):
+        self.isOpen = False
+
+    def write(self, messages, now):
+        assert self.isOpen
+        self.writes += 1
+        self.messages.extend((time, list(data)) for data, time in messages)
+
+    def abort(self, now):
+        self.messages = [(time, data) for time, data in self.messages if time <= now]
+
+    def get_notes(self):
+        """
+        return: A list of (start, end, pitch, channel) of the notes kept, in
+            the order they end.
+        """
+        starts = {}
+        notes = []
+        for time, data in sorted(self.messages, key=lambda m: m[0]):
+            kind, channel = data[0] & 0xf0, data[0] & 0xf
+            if kind == 0x90 and data[2] > 0:
+                starts[data[1], channel] = time
+            elif kind in (0x80, 0x90) and (data[1], channel) in starts:
+                notes.append((starts.pop((data[1], channel)), time, data[1], channel))
+        return notes
+
+
+class MidiFileOutput(RecordingOutput):
+    """
+    Save the messages to a standard MIDI file when closed.
+    """
+    # Ticks per quarter note, at the default tempo of 120 quarter notes a
+    # minute.
+    DIVISION = 480
+    TICKS_PER_SECOND = DIVISION * 2
+
+    def __init__(self, path, latency=0):
+        super().__init__(latency)
+        self.path = path
+
+    def open(self):
+        super().open()
+        self.messages = []
+
+    def close(self):
+        if not self.isOpen:
+            return
+        super().close()
+        with open(self.path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    def to_bytes(self):
+        messages = sorted(self.messages, key=lambda m: m[0])
+        start = messages[0][0] if messages else 0
+        track = bytearray()
+        lastTick = 0
+        for time, data in messages:
+            tick = max(lastTick, int(round((time - start) * self.TICKS_PER_SECOND)))
+            track += self._varlen(tick - lastTick) + bytes(data)
+            lastTick = tick
+        track += b'\x00\xff\x2f\x00'
+        return b''.join([
+            b'MThd', struct.pack('>IHHH', 6, 0, 1, self.DIVISION),
+            b'MTrk', struct.pack('>I', len(track)), bytes(track)])
+
+    @staticmethod
+    def _varlen(n):
+        data = [n & 0x7f]
+        n >>= 7
+        while n:
+            data.append(0x80 | (n & 0x7f))
+            n >>= 7
+        return bytes(reversed(data))
+
+
+class PygameOutput(Output):
+    """
+    A MIDI device through pygame.midi, which is set up when first opened.
+    """
+    # The most messages of one pygame.midi.Output.write.
+    MAX_WRITE = 1024
+
+    def __init__(self, deviceId=None, latency=0):
+        """
+        deviceId: Default to a synthesizer if any, see `get_device_id`.
+        """
+        self.deviceId = deviceId
+        self.latency = latency
+        self.output = None
+
+    @staticmethod
+    def get_device_id():
+        import pygame.midi as midi
+        for id in range(midi.get_count()):
+            interface, name, input, output, open = midi.get_device_info(id)
+            if not output:
+                continue
+            name = name.decode('utf-8').lower()
+            if name.find('synth') != -1:
+                return id
+        return midi.get_default_output_id()
+
+    def open(self):
+        import pygame.midi as midi
+        midi.init()
+        deviceId = self.deviceId
+        if deviceId is None:
+            deviceId = self.get_device_id()
+        self.output = midi.Output(deviceId, self.latency)
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+    def write(self, messages, now):
+        import pygame.midi as midi
+        # Timestamps are of the PortMidi clock, and are sent `latency` later.
+        base = midi.time() - now * 1000 - self.latency
+        for i in range(0, len(messages), self.MAX_WRITE):
+            self.output.write([
+                [data, int(base + time * 1000)]
+                for data, time in messages[i:i + self.MAX_WRITE]])
+
+    def abort(self, now):
+        # PortMidi can only drop all of its queue, after which the output
+        # has to be opened again.
+        if self.output and self.latency:
+            self.output.abort()
+            self.close()
+            self.open()
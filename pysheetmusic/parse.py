@@ -5,12 +5,10 @@ import os
 from contextlib import contextmanager
 from fractions import Fraction
 
-from raygllib.utils import timeit
-from raygllib import ui
 
 from . import sheet as S
 from . import sprite
-from .utils import monad, find_one
+from .utils import monad, find_one, timeit
 
 
 class FormatError(Exception):
@@ -75,6 +73,7 @@ class MusicXMLParser:
                 page.add_sprite(sprite.CreditWords(textNode))
 
         context.sheet.flatten_measures()
+        context.sheet.set_score_times()
         context.sheet.totalTime = sum(measure.get_actual_time(measure.timeLength)
             for measure in context.sheet.measureSeq)
         # print([measure.number for measure in context.sheet.measureSeq])
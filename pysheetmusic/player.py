@@ -1,17 +1,8 @@
-import pygame.midi as midi
-from threading import Thread, RLock
-from fractions import Fraction
-from collections import namedtuple
-from time import sleep
-from time import time as sys_time
-
-from raygllib import ui
-
-midi.init()
-
-def get_system_time():
-    return Fraction(int(sys_time() * 1000), 1000)
-
+from threading import Thread, RLock, Condition
+from collections import deque
+import numpy as np
+from .output import PygameOutput
+from .clock import Clock, get_system_time, sleep_until
 
 class PlayerState:
     PLAYING = 'playing'
@@ -23,154 +14,556 @@ class EventType:
     NOTE_ON = 1
     TEMPO = 2
 
-NoteEvent = namedtuple('NoteEvent', 'time type note')
+# `measure` indexes into `Timeline.measures`. `duration` is the length of the
+# note of a NOTE_ON event, 0 for the other events.
+EVENT_DTYPE = np.dtype([
+    ('time', '<f8'), ('type', 'u1'), ('pitch', 'u1'), ('velocity', 'u1'),
+    ('channel', 'u1'), ('measure', '<i4'), ('duration', '<f8')])
+
+
+class Timeline:
+    """
+    The events of playing a sheet, sorted by time then type, in a structured
+    array of EVENT_DTYPE with the time in seconds.
+
+    `build` fills `events` a few measures at a time, so that the player can
+    start as soon as the first measures are done, see `wait`.
+
+    measures: The `measureSeq` of the sheet.
+    measureTimes: The time each of `measures` starts.
+    events: The array of all the events, valid up to `count`.
+    maxDuration: The longest note of the events built.
+    """
+    FIRST_CHUNK = 4
+    CHUNK = 64
+    VELOCITY = 127
+    CHANNEL = 1
+
+    def __init__(self, sheet):
+        self.measures = measures = sheet.measureSeq
+        lengths = {}
+        counts = {}
+        for measure in measures:
+            if id(measure) not in lengths:
+                lengths[id(measure)] = float(measure.get_actual_time(measure.timeLength))
+                counts[id(measure)] = sum(1 for _ in measure.iter_pitched_notes())
+        self.measureTimes = np.concatenate([[0], np.cumsum(
+            [lengths[id(measure)] for measure in measures])])[:-1]
+        self._notes = {}
+        nNotes = sum(counts[id(measure)] for measure in measures)
+        self.events = np.zeros(2 * nNotes, EVENT_DTYPE)
+        self.count = 0
+        self.maxDuration = 0.
+        self.done = False
+        self._cancelled = False
+        self._cond = Condition()
+
+    def _get_notes(self, measure):
+        " return: (starts, ends, pitches) of the notes of `measure`, relative to it. "
+        try:
+            return self._notes[id(measure)]
+        except KeyError:
+            pass
+        A = measure.get_actual_time
+        notes = list(measure.iter_pitched_notes())
+        result = self._notes[id(measure)] = (
+            np.array([float(A(n.timeStart)) for n in notes], dtype=float),
+            np.array([float(A(n.timeStart + n.duration)) for n in notes], dtype=float),
+            np.clip([n.pitchLevel for n in notes], 0, 127).astype(np.uint8))
+        return result
+
+    def _make_events(self, i, j):
+        " return: The unsorted events of measures i to j. "
+        notes = [self._get_notes(measure) for measure in self.measures[i:j]]
+        counts = [len(starts) for starts, _, _ in notes]
+        offsets = np.repeat(self.measureTimes[i:j], counts)
+        n = sum(counts)
+        events = np.empty(2 * n, EVENT_DTYPE)
+        if n:
+            starts, ends, pitches = (np.concatenate(a) for a in zip(*notes))
+            events['time'][:n] = offsets + starts
+            events['time'][n:] = offsets + ends
+            events['duration'][:n] = ends - starts
+            events['pitch'] = np.tile(pitches, 2)
+            events['measure'] = np.tile(np.repeat(np.arange(i, j), counts), 2)
+        events['type'][:n] = EventType.NOTE_ON
+        events['type'][n:] = EventType.NOTE_OFF
+        events['duration'][n:] = 0
+        events['velocity'] = self.VELOCITY
+        events['channel'] = self.CHANNEL
+        return events
+
+    def build(self):
+        # Notes may end after the measures of a chunk, so the events from
+        # the start of the next chunk wait to be sorted with it.
+        pending = np.zeros(0, EVENT_DTYPE)
+        n = len(self.measures)
+        i = 0
+        chunk = self.FIRST_CHUNK
+        while i < n and not self._cancelled:
+            j = min(i + chunk, n)
+            events = np.concatenate([pending, self._make_events(i, j)])
+            events = events[np.lexsort((events['type'], events['time']))]
+            if j < n:
+                split = np.searchsorted(events['time'], self.measureTimes[j])
+            else:
+                split = len(events)
+            self._append(events[:split])
+            pending = events[split:]
+            i = j
+            chunk = self.CHUNK
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def start(self):
+        " Build in a background thread. "
+        thread = Thread(target=self.build)
+        thread.daemon = True
+        thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _append(self, events):
+        with self._cond:
+            self.events[self.count:self.count + len(events)] = events
+            self.count += len(events)
+            if len(events):
+                self.maxDuration = max(self.maxDuration, float(events['duration'].max()))
+            self._cond.notify_all()
+
+    def wait(self, i):
+        """
+        Wait until event `i` is built.
+        return: False if there is no event `i`.
+        """
+        with self._cond:
+            while self.count <= i and not self.done:
+                self._cond.wait()
+            return i < self.count
+
+    def find(self, time):
+        """
+        Wait until the events before `time` are built.
+        return: The index of the first event at or after `time`.
+        """
+        with self._cond:
+            while not self.done and (
+                    self.count == 0 or self.events['time'][self.count - 1] < time):
+                self._cond.wait()
+            return int(np.searchsorted(self.events['time'][:self.count], time))
+
+    def get_sounding(self, time, end=None):
+        """
+        end: `find(time)`, if known.
+        return: The indexes of the NOTE_ON events of the notes that start
+            before `time` and end after it.
+        """
+        if end is None:
+            end = self.find(time)
+        events = self.events
+        start = int(np.searchsorted(events['time'][:end], time - self.maxDuration))
+        events = events[start:end]
+        return start + np.flatnonzero(
+            (events['type'] == EventType.NOTE_ON)
+            & (events['time'] + events['duration'] > time))
+
+    def get_measure_index(self, time):
+        " return: The index of the measure played at `time`. "
+        return max(0, int(np.searchsorted(self.measureTimes, time, 'right')) - 1)
+
+    def find_measure(self, measure):
+        " return: The indexes of `measures` where `measure` is played, once for each pass. "
+        return [i for i, m in enumerate(self.measures) if m is measure]
+
+
+def make_timeline(sheet):
+    " return: The Timeline of `sheet`, built. "
+    timeline = Timeline(sheet)
+    timeline.build()
+    return timeline
+
+
+class TimingStats:
+    """
+    How late the events were sent, in seconds.
+
+    count, mean, max: Of all the events since `reset`.
+    p99Jitter: The 99th percentile of the distance of the lateness from its
+        mean, over the last SAMPLES events.
+    """
+    SAMPLES = 4096
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def add(self, lateness):
+        self.count += 1
+        self.total += lateness
+        self.max = max(self.max, lateness)
+        self.samples.append(lateness)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    @property
+    def p99Jitter(self):
+        if not self.samples:
+            return 0.
+        samples = np.array(self.samples)
+        return float(np.percentile(np.abs(samples - samples.mean()), 99))
+
+    def __repr__(self):
+        return '<TimingStats n={} mean={:.3f}ms max={:.3f}ms p99 jitter={:.3f}ms>'.format(
+            self.count, self.mean * 1000, self.max * 1000, self.p99Jitter * 1000)
 
 
 class Player:
     INST_NYLON_GUITAR = 24
     INST_STEEL_GUITAR = 25
 
-    def __init__(self):
+    # The most events written at once.
+    MAX_BATCH = 1024
+
+    def __init__(self, output=None, clock=None):
+        """
+        output: An `output.Output`, default to a PygameOutput.
+        clock: A `clock.Clock`, default to the real time.
+        """
         self.sheet = None
+        self.output = output if output is not None else PygameOutput()
+        self.clock = clock if clock is not None else Clock()
         self.speedScale = 1
         self.state = PlayerState.STOPPED
         self.stateLock = RLock()
+        # Notified on each change of state, time or speed, which wakes the
+        # thread up. `_version` counts the changes.
+        self._wakeup = Condition(self.stateLock)
+        self._version = 0
         self.thread = None
-        self.output = None
+        self.timeline = None
         self.outputLock = RLock()
         self.currentMeasure = None
         self.currentNotes = set()
+        self.stats = TimingStats()
         self._timeLock = RLock()
-        self._sync_time(0)
+        self._seeked = False
+        self._retimed = False
+        # Written events that have not sounded yet, see `_settle`.
+        self._pending = deque()
+        self._writtenNotes = set()
+        self._sync_time(0.)
 
     def __del__(self):
-        if self.output:
-            with self.outputLock:
-                self.output.close()
+        with self.outputLock:
+            self.output.close()
 
     def get_current_time(self):
+        " return: The time of the performance in seconds. "
         with self._timeLock:
             if self.state == PlayerState.PLAYING:
-                return self._syncedMusicTime + (get_system_time() - self._syncedSysTime)
+                return self._syncedMusicTime + \
+                    (self.clock.time() - self._syncedSysTime) * self.speedScale
             else:
                 return self._syncedMusicTime
 
-    @staticmethod
-    def get_midi_output_id():
-        for id in range(midi.get_count()):
-            interface, name, input, output, open = midi.get_device_info(id)
-            if not output:
-                continue
-            name = name.decode('utf-8').lower()
-            if name.find('synth') != -1:
-                return id
-        return midi.get_default_output_id()
+    def get_deadline(self, time):
+        " return: The system time to play music time `time`. "
+        with self._timeLock:
+            return self._syncedSysTime + (time - self._syncedMusicTime) / self.speedScale
+
+    def set_speed_scale(self, speedScale):
+        with self.stateLock, self._timeLock:
+            self._sync_time(self.get_current_time())
+            self.speedScale = speedScale
+            self._retimed = True
+            self._notify()
+
+    def _notify(self):
+        with self.stateLock:
+            self._version += 1
+            self.clock.notify(self._wakeup)
+
+    def _wait_until(self, deadline, version):
+        """
+        Wait until `deadline`, or until the state changes from `version`.
+        return: False if the state changed.
+        """
+        with self._wakeup:
+            while self._version == version:
+                if self.clock.time() >= deadline:
+                    return True
+                self.clock.wait(self._wakeup, deadline)
+            return False
+
+    def _open_output(self):
+        with self.outputLock:
+            self.output.open()
+            self._write([([0xc0 | 1, self.INST_NYLON_GUITAR], self.clock.time())])
 
     def play(self):
         if self.state is PlayerState.PLAYING:
             return
-        if not self.output:
-            self.output = midi.Output(self.get_midi_output_id())
-            self.output.set_instrument(self.INST_NYLON_GUITAR, 1)
-
-            noteEvents = []
-            sheet = self.sheet
-            for timeStart, timeEnd, note in sheet.iter_note_sequence():
-                # note on
-                noteEvents.append(NoteEvent(timeStart, EventType.NOTE_ON, note))
-                # note off
-                noteEvents.append(NoteEvent(timeEnd, EventType.NOTE_OFF, note))
-            noteEvents.sort(key=lambda x: x[:2])
-
-            self.thread = thread = Thread(target=self._run, args=(noteEvents,))
+        if self.state is PlayerState.STOPPED:
+            if self.thread:
+                self.thread.join()
+            self._open_output()
+            self.get_timeline()
+            self.stats.reset()
+            self._seeked = True
+            # Start from now, at the time of the last seek or 0.
+            self._sync_time(self._syncedMusicTime)
+            self.thread = thread = Thread(target=self._run, args=(self.timeline,))
             thread.daemon = True
             self.state = PlayerState.PLAYING
+            self.clock.attach(thread)
             thread.start()
         else:
-            self._sync_time(self.get_current_time())
-            self.state = PlayerState.PLAYING
+            with self.stateLock:
+                self._sync_time(self.get_current_time())
+                self.state = PlayerState.PLAYING
+                self._notify()
 
-    def _run(self, noteEvents):
-        p = 0
+    def get_timeline(self):
+        " return: The Timeline of the sheet, started building when first used. "
+        if self.timeline is None:
+            self.timeline = Timeline(self.sheet)
+            self.timeline.start()
+        return self.timeline
+
+    def _write(self, messages):
+        """
+        messages: A list of ([status, data1, data2], deadline).
+        """
+        if messages:
+            with self.outputLock:
+                self.output.write(messages, self.clock.time())
+
+    def _settle(self):
+        " Apply the pending events that have sounded by now. "
+        pending = self._pending
+        now = self.clock.time()
+        while pending and pending[0][0] <= now:
+            deadline, p, type, args, measure = pending.popleft()
+            if type == EventType.NOTE_ON:
+                self.currentNotes.add(args)
+                if measure is not self.currentMeasure:
+                    self.currentMeasure = measure
+            else:
+                self.currentNotes.discard(args)
+
+    def _revoke(self, p):
+        """
+        Take back the events written that have not sounded yet.
+        return: The index of the first event to write again, or `p`.
+        """
+        self._settle()
+        if self._pending:
+            with self.outputLock:
+                self.output.abort(self.clock.time())
+            p = self._pending[0][1]
+            self._pending.clear()
+        self._writtenNotes = set(self.currentNotes)
+        return p
+
+    def _release_notes(self, messages=()):
+        """
+        Stop the notes sounding, after `_revoke`.
+        messages: Written in the same batch after the note offs.
+        """
+        now = self.clock.time()
+        self._write([
+            ([0x80 | channel, pitch, velocity], now)
+            for pitch, velocity, channel in self.currentNotes] + list(messages))
+        self.currentNotes.clear()
+        self._writtenNotes.clear()
+
+    def _resume_at(self, timeline, time, p):
+        """
+        Release the held notes and strike the notes sounding at `time`.
+        p: `timeline.find(time)`, so that this does not wait for the timeline.
+        return: The index of the next event to play.
+        """
+        self._revoke(0)
+        events = timeline.events[timeline.get_sounding(time, p)]
+        now = self.clock.time()
+        notes = list(zip(*(events[k].tolist() for k in ('pitch', 'velocity', 'channel'))))
+        self._release_notes([
+            ([0x90 | channel, pitch, velocity], now)
+            for pitch, velocity, channel in notes])
+        self.currentNotes.update(notes)
+        self._writtenNotes.update(notes)
+        return p
+
+    def _write_batch(self, timeline, p):
+        """
+        Write the events from `p` due within `output.latency` from now.
+        return: The index of the next event.
+        """
+        now = self.clock.time()
+        lookahead = self.output.latency / 1000
         with self._timeLock:
-            time = Fraction(0)
-            self._sync_time(time)
-        output = self.output
-        notes = self.currentNotes
-        notes.clear()
-        self.currentMeasure = None
-        while p < len(noteEvents):
+            times = timeline.events['time'][p:min(timeline.count, p + self.MAX_BATCH)]
+            deadlines = self._syncedSysTime + (times - self._syncedMusicTime) / self.speedScale
+            # Events due within `lookahead` of a sync could not be written
+            # earlier than it.
+            synced = self._syncedSysTime
+        n = max(1, int(np.searchsorted(deadlines, now + lookahead, 'right')))
+        messages = []
+        written = self._writtenNotes
+        for i in range(p, p + n):
+            time, type, pitch, velocity, channel, measure, _ = timeline.events[i].tolist()
+            deadline = float(deadlines[i - p])
+            writeTime = max(deadline - lookahead, synced)
+            if writeTime <= now:
+                self.stats.add(now - writeTime)
+            args = pitch, velocity, channel
+            if type == EventType.NOTE_ON:
+                written.add(args)
+                messages.append(([0x90 | channel, pitch, velocity], deadline))
+            elif type == EventType.NOTE_OFF:
+                if args not in written:
+                    continue
+                written.discard(args)
+                messages.append(([0x80 | channel, pitch, velocity], deadline))
+            self._pending.append(
+                (deadline, i, type, args, timeline.measures[measure]))
+        self._write(messages)
+        return p + n
+
+    def _run(self, timeline):
+        try:
+            self._play(timeline)
+        finally:
+            self.clock.detach()
+
+    def _play(self, timeline):
+        """
+        Write the events of `timeline` to the output. Each batch is written
+        `output.latency` before its events are due and timestamped, so the
+        output sends them in time. With no latency, the events are written when
+        due.
+        """
+        p = 0
+        self.currentNotes.clear()
+        self._writtenNotes = set()
+        self._pending = deque()
+        while True:
             with self.stateLock:
                 if self.state is PlayerState.PAUSED:
-                    if notes:
-                        with self.outputLock:
-                            for note in notes:
-                                output.note_off(*args)
-                        notes.clear()
-                    sleep(0.02)
-                    continue
-                elif self.state is PlayerState.STOPPED:
-                    notes.clear()
+                    p = self._revoke(p)
+                    self._release_notes()
+                    while self.state is PlayerState.PAUSED:
+                        self.clock.wait(self._wakeup)
+                if self.state is PlayerState.STOPPED:
+                    self._revoke(p)
+                    self._release_notes()
                     self.currentMeasure = None
                     return
+                version = self._version
+                seekTime = self._syncedMusicTime if self._seeked else None
+                if seekTime is None and self._retimed:
+                    self._retimed = False
+                    p = self._revoke(p)
 
-            event = noteEvents[p]
-            deltaTime = event.time - time
-            if deltaTime > 0:
-                sleep(float(1 / self.speedScale * deltaTime))
-                with self._timeLock:
-                    time = event.time
-                    self._sync_time(time)
+            if seekTime is not None:
+                # The timeline may still be built up to the seek time, which
+                # is waited for without the lock, so that seek and the others
+                # do not block meanwhile.
+                end = timeline.find(seekTime)
+                with self.stateLock:
+                    if self._version == version:
+                        self._seeked = self._retimed = False
+                        p = self._resume_at(timeline, seekTime, end)
+                continue
 
-            pitch = event.note.pitch
-            level = event.note.pitchLevel
-            args = level, 127, 1
+            self._settle()
+            # The deadlines are from the clock of the last sync, rather than
+            # from the last event, so that the lateness does not add up.
+            if p < timeline.count or timeline.wait(p):
+                writeTime = self.get_deadline(timeline.events['time'][p]) \
+                    - self.output.latency / 1000
+            elif self._pending:
+                writeTime = None
+            else:
+                break
+            if self._pending and (writeTime is None or self._pending[0][0] < writeTime):
+                self._wait_until(self._pending[0][0], version)
+                continue
+            if not self._wait_until(writeTime, version):
+                continue
+            p = self._write_batch(timeline, p)
 
-            with self.outputLock:
-                if not self.output:
-                    break
-                # print('level', level, 'time', event.time, 'type', event.type)
-                if event.type == EventType.NOTE_ON:
-                    if event.note.measure is not self.currentMeasure:
-                        self.currentMeasure = event.note.measure
-                    output.note_on(*args)
-                    notes.add(args)
-                elif event.type == EventType.NOTE_OFF:
-                    if args in notes:
-                        output.note_off(*args)
-                        notes.discard(args)
-            p += 1
         self.currentMeasure = None
         with self.stateLock:
             self.state = PlayerState.STOPPED
+            self._sync_time(0.)
         with self.outputLock:
             self.output.close()
-            self.output = None
 
     def _sync_time(self, time):
         with self._timeLock:
-            self._syncedSysTime = get_system_time()
+            self._syncedSysTime = self.clock.time()
             self._syncedMusicTime = time
 
     def pause(self):
-        with self.stateLock:
+        with self.stateLock, self._timeLock:
+            self._sync_time(self.get_current_time())
             self.state = PlayerState.PAUSED
-        self._sync_time(self.get_current_time())
+            self._notify()
+
+    def seek(self, time):
+        """
+        Continue playing from `time` of the performance, or start from it if
+        stopped. The notes sounding at `time` are struck again.
+        """
+        timeline = self.get_timeline()
+        with self.stateLock:
+            self._sync_time(max(0., time))
+            self._seeked = True
+            if self.state is not PlayerState.STOPPED:
+                self.currentMeasure = timeline.measures[timeline.get_measure_index(time)]
+            self._notify()
+
+    def seek_measure(self, measure, passIndex=None):
+        """
+        Seek to the start of `measure`.
+        passIndex: Which time the measure is played, for measures in repeats.
+            Default to the pass closest to the current time.
+        """
+        timeline = self.get_timeline()
+        times = timeline.measureTimes[timeline.find_measure(measure)]
+        if not len(times):
+            raise ValueError('The measure is not played')
+        if passIndex is None:
+            passIndex = int(np.argmin(np.abs(times - self.get_current_time())))
+        self.seek(float(times[passIndex]))
 
     def stop(self):
         if self.state is PlayerState.STOPPED:
             return
         with self.stateLock:
             self.state = PlayerState.STOPPED
-        self._sync_time(self.get_current_time())
+            self._sync_time(0.)
+            self._notify()
         if self.thread and self.thread.is_alive():
             self.thread.join()
         with self.outputLock:
             self.output.close()
-            self.output = None
         self.currentMeasure = None
 
     def set_sheet(self, sheet):
         if self.state is not PlayerState.STOPPED:
             self.stop()
+        if self.timeline:
+            self.timeline.cancel()
+            self.timeline = None
         self.sheet = sheet
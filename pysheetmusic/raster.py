@@ -0,0 +1,221 @@
+"""
+Rasterize laid out pages on the CPU, e.g. for thumbnails of many sheets
+without a display.
+
+Lines and beams are cut into spans of pixels along columns or rows, drawn
+at SUPERSAMPLE times the resolution with difference arrays and averaged
+down. Glyphs are scaled from the templates once for each size and put at
+the final resolution.
+"""
+import os
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFont
+from .export import get_pages, get_millimeters, get_glyph_image
+
+SUPERSAMPLE = 3
+SHEET_EXTENSIONS = ('.mxl', '.xml', '.musicxml')
+
+
+@lru_cache(maxsize=256)
+def get_scaled_glyph(name, width, height):
+    " return: (height, width) float32 ink coverage of glyph `name`. "
+    image = get_glyph_image(name).getchannel('A')
+    image = image.resize((width, height), PIL.Image.BOX)
+    return np.asarray(image, dtype=np.float32) / 255
+
+
+@lru_cache(maxsize=32)
+def get_font(size):
+    return PIL.ImageFont.load_default(size)
+
+
+def get_spans(x1, x2, a1, a2, b1, b2):
+    """
+    Cut parallelograms with sides along the y axis into column spans.
+    Parallelogram i covers x1[i] <= x < x2[i], between the lines from
+    (x1, a1) to (x2, a2) and from (x1, b1) to (x2, b2).
+    return: (columns, tops, bottoms) int arrays, one element for each
+        column of each parallelogram, tops < bottoms.
+    """
+    c1 = np.ceil(x1 - .5).astype(int)
+    c2 = np.ceil(x2 - .5).astype(int)
+    counts = np.maximum(c2 - c1, 0)
+    total = counts.sum()
+    ids = np.repeat(np.arange(len(counts)), counts)
+    columns = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + c1[ids]
+    dx = np.where(x2 > x1, x2 - x1, 1)[ids]
+    t = (columns + .5 - x1[ids]) / dx
+    a = a1[ids] + (a2 - a1)[ids] * t
+    b = b1[ids] + (b2 - b1)[ids] * t
+    tops = np.floor(np.minimum(a, b) + .5).astype(int)
+    # Keep spans thinner than a pixel.
+    bottoms = np.maximum(np.floor(np.maximum(a, b) + .5).astype(int), tops + 1)
+    return columns, tops, bottoms
+
+
+def fill_spans(diff, columns, tops, bottoms):
+    " Add the spans to the difference array `diff` of shape (h + 1, w). "
+    h = diff.shape[0] - 1
+    w = diff.shape[1]
+    keep = (columns >= 0) & (columns < w) & (bottoms > 0) & (tops < h)
+    columns = columns[keep]
+    np.add.at(diff, (np.clip(tops[keep], 0, h), columns), 1)
+    np.add.at(diff, (np.clip(bottoms[keep], 0, h), columns), -1)
+
+
+def get_line_parallelograms(lines):
+    """
+    Split lines (x1, y1, x2, y2, width) in pixels into parallelograms for
+    `get_spans`: the flat lines along columns and the steep ones along rows,
+    with x and y swapped.
+    return: (flat, steep), each a tuple of (x1, x2, a1, a2, b1, b2).
+    """
+    x1, y1, x2, y2, width = lines.T
+    steep = np.abs(y2 - y1) > np.abs(x2 - x1)
+    result = []
+    for mask, (u1, v1, u2, v2) in (
+            (~steep, (x1, y1, x2, y2)), (steep, (y1, x1, y2, x2))):
+        u1, v1, u2, v2, w = (a[mask] for a in (u1, v1, u2, v2, width))
+        flip = u2 < u1
+        u1, u2 = np.where(flip, u2, u1), np.where(flip, u1, u2)
+        v1, v2 = np.where(flip, v2, v1), np.where(flip, v1, v2)
+        du = np.where(u2 > u1, u2 - u1, 1)
+        # Half of the thickness along the span.
+        half = w / 2 * np.hypot(1, (v2 - v1) / du)
+        result.append((u1, u2, v1 - half, v2 - half, v1 + half, v2 + half))
+    return result
+
+
+def rasterize(items, dpi, mm):
+    """
+    Draw a page black on white.
+    items: An `export.PageItems`.
+    mm: Millimeters per tenth.
+    return: A PIL image in mode L.
+    """
+    s = SUPERSAMPLE
+    k = dpi * mm / 25.4
+    x0, y0, x1, y1 = items.box
+    width = max(1, int(round((x1 - x0) * k)))
+    height = max(1, int(round((y1 - y0) * k)))
+    tox = lambda x: (x - x0) * k
+    toy = lambda y: (y1 - y) * k
+
+    columns = np.zeros((height * s + 1, width * s), dtype=np.int16)
+    rows = np.zeros((width * s + 1, height * s), dtype=np.int16)
+    parallelograms = ([], [])
+    if items.lines:
+        lines = np.array(items.lines, dtype=float)
+        lines[:, [0, 2]] = tox(lines[:, [0, 2]])
+        lines[:, [1, 3]] = toy(lines[:, [1, 3]])
+        lines[:, 4] *= k
+        flat, steep = get_line_parallelograms(lines * s)
+        parallelograms[0].append(flat)
+        parallelograms[1].append(steep)
+    if items.beams:
+        bx1, by1, bx2, by2, bh = np.array(items.beams, dtype=float).T * k * s
+        bx1 -= x0 * k * s
+        bx2 -= x0 * k * s
+        by1 = y1 * k * s - by1
+        by2 = y1 * k * s - by2
+        flip = bx2 < bx1
+        bx1, bx2 = np.where(flip, bx2, bx1), np.where(flip, bx1, bx2)
+        by1, by2 = np.where(flip, by2, by1), np.where(flip, by1, by2)
+        parallelograms[0].append((bx1, bx2, by1, by2, by1 - bh, by2 - bh))
+    for diff, shapes in zip((columns, rows), parallelograms):
+        for shape in shapes:
+            fill_spans(diff, *get_spans(*shape))
+    ink = np.cumsum(columns, axis=0, out=columns)[:-1] > 0
+    ink |= (np.cumsum(rows, axis=0, out=rows)[:-1] > 0).T
+    # Average each s x s block, one axis at a time.
+    ink = ink.view(np.uint8).reshape(height, s, width * s).sum(axis=1, dtype=np.uint8)
+    ink = ink.reshape(height, width, s).sum(axis=2, dtype=np.float32) / (s * s)
+
+    for name, gx1, gy1, gx2, gy2 in items.glyphs:
+        px = int(round(tox(gx1)))
+        py = int(round(toy(gy2)))
+        w = max(1, int(round((gx2 - gx1) * k)))
+        h = max(1, int(round((gy2 - gy1) * k)))
+        glyph = get_scaled_glyph(name, w, h)
+        ax1, ay1 = max(px, 0), max(py, 0)
+        ax2, ay2 = min(px + w, width), min(py + h, height)
+        if ax1 < ax2 and ay1 < ay2:
+            target = ink[ay1:ay2, ax1:ax2]
+            np.maximum(target, glyph[ay1 - py:ay2 - py, ax1 - px:ax2 - px], out=target)
+
+    image = PIL.Image.fromarray((255 - ink * 255).round().astype(np.uint8), 'L')
+    if items.texts:
+        draw = PIL.ImageDraw.Draw(image)
+        for x, y, size, text in items.texts:
+            pixels = int(round(size * k))
+            if pixels > 0:
+                draw.text((tox(x), toy(y)), text, fill=0, font=get_font(pixels),
+                    anchor='ls')
+    return image
+
+
+def make_thumbnail(path, output, dpi=50, page=0):
+    """
+    Parse the sheet at `path`, lay out its pages and save page `page` as a
+    PNG image at `output`.
+    return: `output`.
+    raise: OSError, parse.FormatError or parse.ValidateError if the sheet can
+        not be read.
+    """
+    from .parse import MusicXMLParser
+    from .layout import PagesLayout
+    sheet = MusicXMLParser().parse(path)
+    layout = PagesLayout(sheet, nPages=page + 1)
+    layout.layout()
+    items = get_pages(layout)[page]
+    rasterize(items, dpi, get_millimeters(layout)).save(output)
+    return output
+
+
+def _try_make_thumbnail(path, output, dpi):
+    """
+    return: (`output`, None), or (None, message) if the sheet can not be
+        read, see `make_thumbnail`. Other errors are bugs and propagate.
+    """
+    from .parse import FormatError, ValidateError
+    try:
+        return make_thumbnail(path, output, dpi), None
+    except (OSError, FormatError, ValidateError) as e:
+        # The message only, as the error may hold objects that can not be
+        # sent back from a worker process.
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def make_thumbnails(dirPath, outDir, dpi=50, processes=None):
+    """
+    Save a thumbnail of the first page of each sheet in `dirPath` to
+    `outDir`, by a pool of `processes` processes.
+    return: A list of (sheet path, thumbnail path, error), with the path None
+        and the error message of the sheets that can not be read.
+    """
+    paths = sorted(
+        os.path.join(dirPath, name) for name in os.listdir(dirPath)
+        if name.lower().endswith(SHEET_EXTENSIONS))
+    outputs = [
+        os.path.join(outDir, os.path.splitext(os.path.basename(p))[0] + '.png')
+        for p in paths]
+    os.makedirs(outDir, exist_ok=True)
+    dpis = [dpi] * len(paths)
+    with ProcessPoolExecutor(processes) as pool:
+        results = list(pool.map(_try_make_thumbnail, paths, outputs, dpis, chunksize=4))
+    return [(path,) + result for path, result in zip(paths, results)]
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print('raster.py {sheet directory} {output directory} [dpi]')
+    else:
+        dpi = float(sys.argv[3]) if len(sys.argv) > 3 else 50
+        for path, output, error in make_thumbnails(sys.argv[1], sys.argv[2], dpi):
+            if error:
+                print('failed: {}: {}'.format(path, error))
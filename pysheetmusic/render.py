@@ -1,16 +1,22 @@
-import PIL.Image
 import raygllib.gllib as gl
 import raygllib.ui as ui
 import os
-import json
+import ctypes
+import weakref
+import pyglet
 import numpy as np
 from . import sprite
+from .atlas import get_text_atlas, get_template_atlas
 
 
 def get_resouce_path(*subPaths):
     return os.path.join(os.path.dirname(__file__), *subPaths)
 
 DEFAULT_COLOR = np.array((0., 0., 0., 1.), dtype=gl.GLfloat)
+# The color of sounding notes during playback.
+HIGHLIGHT_COLOR = np.array((.85, .2, .1, 1.), dtype=gl.GLfloat)
+# The play time of sprites that are never highlighted, see `Sprite.playTime`.
+NO_PLAY_TIME = (-1., -1.)
 
 def make_matrix(scaling, viewPortSize, viewPoint, scale):
     k = scaling.mm / scaling.tenths * scale
@@ -25,11 +31,479 @@ def make_matrix(scaling, viewPortSize, viewPoint, scale):
     ], dtype=gl.GLfloat)
 
 
+def make_quad_indices(nQuads):
+    " return: Indices of two triangles for every 4 vertices. "
+    quad = np.array([0, 1, 2, 2, 1, 3], dtype=np.uint32)
+    starts = np.arange(0, 4 * nQuads, 4, dtype=np.uint32)
+    return (starts[:, None] + quad[None, :]).ravel()
+
+
+class QuadIndexBuffer:
+    """
+    An element array buffer for drawing quads, shared by all the quads of a
+    render. It only grows, so rebuilding vertices rarely touches it.
+    """
+    def __init__(self):
+        self.glId = None
+        self.capacity = 0
+
+    def reserve(self, nQuads):
+        if nQuads <= self.capacity:
+            return
+        capacity = max(nQuads, 2 * self.capacity, 256)
+        indices = make_quad_indices(capacity)
+        if self.glId is None:
+            self.glId = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.glId)
+        gl.glBufferData(
+            gl.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, gl.GL_STATIC_DRAW)
+        self.capacity = capacity
+
+    def draw(self, nQuads, first=0):
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.glId)
+        offset = 6 * first * np.dtype(np.uint32).itemsize
+        gl.glDrawElements(
+            gl.GL_TRIANGLES, 6 * nQuads, gl.GL_UNSIGNED_INT, ctypes.c_void_p(offset))
+
+    def free(self):
+        if self.glId is not None:
+            gl.glDeleteBuffers(1, [self.glId])
+        self.glId = None
+        self.capacity = 0
+
+
+class TextureRegistry:
+    """
+    GL textures shared by all the renders of a GL context, or of the contexts
+    sharing objects with it, so that each new canvas does not upload the same
+    atlas again.
+    """
+    def __init__(self):
+        self._textures = weakref.WeakKeyDictionary()
+        # Used when there is no current pyglet context.
+        self._default = {}
+
+    def get(self, key, make):
+        """
+        return: The texture of `key` in the current context, made by `make()`
+            if there is none yet.
+        """
+        context = pyglet.gl.current_context
+        if context is None:
+            textures = self._default
+        else:
+            space = getattr(context, 'object_space', context)
+            textures = self._textures.setdefault(space, {})
+        try:
+            return textures[key]
+        except KeyError:
+            texture = textures[key] = make()
+            return texture
+
+
+TEXTURES = TextureRegistry()
+
+
+class FrameCache:
+    """
+    An offscreen framebuffer holding the last frame drawn into a viewport, so
+    that a frame with nothing changed is copied by `blit` instead of drawn.
+
+    The framebuffer covers the window up to the top right of the viewport, so
+    drawing into it needs no change of the viewport. On a multisampled window
+    the frame is drawn into a framebuffer with as many samples, and resolved
+    into the cache, whose single sample is copied to each sample of the window.
+    """
+    def __init__(self):
+        self.fbo = None
+        self.colorBuffer = None
+        self.msaaFbo = None
+        self.msaaBuffer = None
+        self.size = (0, 0)
+        self.samples = 0
+        self.viewport = None
+        self._target = 0
+
+    def _reserve(self, width, height, samples):
+        if (width, height) != self.size:
+            if self.fbo is None:
+                self.fbo = gl.glGenFramebuffers(1)
+                self.colorBuffer = gl.glGenRenderbuffers(1)
+            self._attach(self.fbo, self.colorBuffer, width, height, 0)
+        if samples and ((width, height) != self.size or samples != self.samples):
+            if self.msaaFbo is None:
+                self.msaaFbo = gl.glGenFramebuffers(1)
+                self.msaaBuffer = gl.glGenRenderbuffers(1)
+            self._attach(self.msaaFbo, self.msaaBuffer, width, height, samples)
+        self.size = (width, height)
+        self.samples = samples
+
+    @staticmethod
+    def _attach(fbo, colorBuffer, width, height, samples):
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, colorBuffer)
+        if samples:
+            gl.glRenderbufferStorageMultisample(
+                gl.GL_RENDERBUFFER, samples, gl.GL_RGBA8, width, height)
+        else:
+            gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_RGBA8, width, height)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, fbo)
+        gl.glFramebufferRenderbuffer(
+            gl.GL_DRAW_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0,
+            gl.GL_RENDERBUFFER, colorBuffer)
+
+    def begin(self):
+        """
+        Redirect drawing into the cache, or into its multisampled framebuffer.
+        Call `end` after drawing.
+        """
+        samples = int(gl.glGetIntegerv(gl.GL_SAMPLES))
+        self._target = gl.glGetIntegerv(gl.GL_DRAW_FRAMEBUFFER_BINDING)
+        self.viewport = x, y, w, h = tuple(int(v) for v in gl.glGetIntegerv(gl.GL_VIEWPORT))
+        self._reserve(x + w, y + h, samples)
+        gl.glBindFramebuffer(
+            gl.GL_DRAW_FRAMEBUFFER, self.msaaFbo if samples else self.fbo)
+
+    def end(self):
+        if self.samples:
+            # Resolve the samples into the cache.
+            x, y, w, h = self.viewport
+            gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.msaaFbo)
+            gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self.fbo)
+            gl.glBlitFramebuffer(
+                x, y, x + w, y + h, x, y, x + w, y + h,
+                gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self._target)
+        self.blit()
+
+    def valid(self):
+        " return: Whether the cache holds a frame of the current viewport. "
+        return self.viewport is not None and self.viewport == tuple(
+            int(v) for v in gl.glGetIntegerv(gl.GL_VIEWPORT))
+
+    def blit(self):
+        " Copy the cached frame to the current draw framebuffer. "
+        x, y, w, h = self.viewport
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.fbo)
+        gl.glBlitFramebuffer(
+            x, y, x + w, y + h, x, y, x + w, y + h,
+            gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self._target)
+
+    def free(self):
+        for fbo, colorBuffer in (
+                (self.fbo, self.colorBuffer), (self.msaaFbo, self.msaaBuffer)):
+            if fbo is not None:
+                gl.glDeleteFramebuffers(1, [fbo])
+                gl.glDeleteRenderbuffers(1, [colorBuffer])
+        self.fbo = self.colorBuffer = self.msaaFbo = self.msaaBuffer = None
+        self.size = (0, 0)
+        self.samples = 0
+        self.viewport = None
+        self.viewport = None
+
+
+class VertexKind:
+    " How a float column of the items is stored in a vertex buffer. "
+    FLOAT = 'float'
+    # Half float, for widths and heights.
+    HALF = 'half'
+    # Unsigned short normalized to [0, 1], for texture coordinates.
+    UNORM = 'unorm'
+    # Short integer of `positionUnit`, relative to the origin of the tile,
+    # for (x, y) pairs of coordinates.
+    POSITION = 'position'
+
+    # kind -> (dtype, GL type, normalized)
+    TYPES = {
+        FLOAT: (np.float32, gl.GL_FLOAT, gl.GL_FALSE),
+        HALF: (np.float16, gl.GL_HALF_FLOAT, gl.GL_FALSE),
+        UNORM: (np.uint16, gl.GL_UNSIGNED_SHORT, gl.GL_TRUE),
+        POSITION: (np.int16, gl.GL_SHORT, gl.GL_FALSE),
+    }
+
+
+class VertexFormat:
+    """
+    The compact layout of the vertices of a render. Items are made as float
+    columns, and each attribute takes the next `size` columns, stored as its
+    kind in `dtype`. The shaders decode positions as
+    `origin + value * positionUnit`.
+
+    attributes: A list of (name, size, kind), see VertexKind.
+    """
+    # Attributes start at multiples of this many bytes.
+    ALIGNMENT = 4
+    POSITION_RANGE = np.iinfo(np.int16).max
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.nColumns = sum(size for _, size, _ in attributes)
+        names, formats, offsets = [], [], []
+        offset = 0
+        for name, size, kind in attributes:
+            dtype = np.dtype((VertexKind.TYPES[kind][0], (size,)))
+            names.append(name)
+            formats.append(dtype)
+            offsets.append(offset)
+            offset += -(-dtype.itemsize // self.ALIGNMENT) * self.ALIGNMENT
+        self.dtype = np.dtype({
+            'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': offset})
+
+    def get_program_attributes(self):
+        return [(name, size, VertexKind.TYPES[kind][1])
+            for name, size, kind in self.attributes]
+
+    def _iter_columns(self, rows):
+        col = 0
+        for name, size, kind in self.attributes:
+            yield name, kind, rows[:, col:col + size]
+            col += size
+
+    def move_positions(self, rows, offsets):
+        " return: `rows` with (n, 2) `offsets` added to the positions. "
+        rows = rows.copy()
+        col = 0
+        for _, size, kind in self.attributes:
+            if kind == VertexKind.POSITION:
+                cols = rows[:, col:col + size].reshape(len(rows), -1, 2)
+                cols += offsets[:, None, :]
+                rows[:, col:col + size] = cols.reshape(len(rows), size)
+            col += size
+        return rows
+
+    def get_extents(self, rows, origins):
+        """
+        rows: (n, nColumns) float array.
+        origins: (n, 2) the tile origin of each row.
+        return: (n,) the largest distance along x or y of a position of each
+            row from its origin.
+        """
+        extents = np.zeros(len(rows))
+        for _, kind, cols in self._iter_columns(rows):
+            if kind == VertexKind.POSITION and len(cols):
+                rel = cols.reshape(len(cols), -1, 2) - origins[:, None, :]
+                np.maximum(extents, np.abs(rel).max(axis=(1, 2)), out=extents)
+        return extents
+
+    def get_unit(self, extent, unit):
+        """
+        return: The smallest power of two multiple of `unit` that can store
+            positions `extent` away from their origin.
+        """
+        while extent / unit > self.POSITION_RANGE:
+            unit *= 2
+        return unit
+
+    def fit_unit(self, rows, origins, unit):
+        " return: `get_unit` of all the positions of `rows`, see `get_extents`. "
+        return self.get_unit(self.get_extents(rows, origins).max(initial=0), unit)
+
+    def encode(self, rows, origins, units):
+        """
+        rows, origins: See `get_extents`. `origins` may also be one (x, y).
+        units: The unit of the positions, one for all rows or (n,).
+        return: A structured array of `dtype`, or None if some position is out
+            of range at its unit.
+        """
+        data = np.zeros(len(rows), dtype=self.dtype)
+        origins = np.asarray(origins, dtype=float).reshape(-1, 1, 2)
+        units = np.asarray(units, dtype=float).reshape(-1, 1, 1)
+        for name, kind, cols in self._iter_columns(rows):
+            if kind == VertexKind.POSITION:
+                rel = (cols.reshape(len(cols), -1, 2) - origins) / units
+                rel = np.round(rel).reshape(cols.shape)
+                if len(rel) and np.abs(rel).max() > self.POSITION_RANGE:
+                    return None
+                data[name] = rel
+            elif kind == VertexKind.UNORM:
+                data[name] = np.round(np.clip(cols, 0, 1) * np.iinfo(np.uint16).max)
+            else:
+                data[name] = cols
+        return data
+
+    def bind(self, locs):
+        " Point the attributes of locations `locs` to the bound array buffer. "
+        stride = self.dtype.itemsize
+        for (name, size, kind), loc in zip(self.attributes, locs):
+            _, glType, normalized = VertexKind.TYPES[kind]
+            gl.glEnableVertexAttribArray(loc)
+            gl.glVertexAttribPointer(
+                loc, size, glType, normalized, stride,
+                ctypes.c_void_p(self.dtype.fields[name][1]))
+
+
+class VertexBytesBuffer:
+    " An array buffer holding a structured array, see `VertexFormat`. "
+
+    def __init__(self, data=None, usage=None):
+        self.glId = gl.glGenBuffers(1)
+        self.usage = gl.GL_STATIC_DRAW if usage is None else usage
+        self.count = 0
+        if data is not None:
+            self.set_data(data)
+
+    def __len__(self):
+        return self.count
+
+    def set_data(self, data):
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.glId)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, data.nbytes, data, self.usage)
+        self.count = len(data)
+
+    def free(self):
+        if self.glId is not None:
+            gl.glDeleteBuffers(1, [self.glId])
+        self.glId = None
+
+
+def union_box(boxes):
+    " return: The bounding box of (n, 4) `boxes`. "
+    return np.concatenate([boxes[:, 0:2].min(axis=0), boxes[:, 2:4].max(axis=0)])
+
+
+class Tiles:
+    """
+    Tiles of TILE_WIDTH x TILE_HEIGHT over the items of a render buffer. An
+    item is a sprite, or a group of sprites kept together in the buffer, and
+    belongs to the tile of its center. The items are sorted by tile, so each
+    tile is a range of the buffer with a bounding box, and a view only draws
+    the tiles it intersects.
+
+    sizes: (n,) the number of slots of each item in the buffer.
+    order: The permutation that sorts the items by tile.
+    firsts: (n,) the first slot of each item in the sorted buffer.
+    ranges: (nTiles, 2) array of (first, count) of slots.
+    tileBoxes: (nTiles, 4) bounding boxes of the items of the tiles.
+    origins: (nTiles, 2) the bottom left of the tiles. Vertex positions are
+        stored relative to them, see `VertexFormat`.
+    units: (nTiles,) the position unit of each tile, set by the render, so
+        that the precision of a tile does not depend on the others.
+    """
+    TILE_WIDTH = 2000
+    TILE_HEIGHT = 500
+
+    def __init__(self, boxes, sizes=None):
+        """
+        boxes: (n, 4) array of (x1, y1, x2, y2) of each item.
+        sizes: Default to 1 for every item.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        n = len(boxes)
+        self.sizes = sizes = np.ones(n, dtype=int) if sizes is None \
+            else np.asarray(sizes, dtype=int).reshape(n)
+        columns = np.floor((boxes[:, 0] + boxes[:, 2]) / (2 * self.TILE_WIDTH))
+        bands = np.floor((boxes[:, 1] + boxes[:, 3]) / (2 * self.TILE_HEIGHT))
+        self.order = order = np.lexsort((columns, bands))
+        boxes = boxes[order]
+        sortedSizes = sizes[order]
+        sortedFirsts = np.cumsum(sortedSizes) - sortedSizes
+        self.firsts = np.empty(n, dtype=int)
+        self.firsts[order] = sortedFirsts
+        keys, starts, counts = np.unique(
+            np.stack([bands[order], columns[order]], axis=1),
+            axis=0, return_index=True, return_counts=True)
+        self.origins = keys[:, ::-1] * (self.TILE_WIDTH, self.TILE_HEIGHT)
+        self.units = np.ones(len(keys))
+        self.tileOf = np.empty(n, dtype=int)
+        self.tileOf[order] = np.repeat(np.arange(len(starts)), counts)
+        if n:
+            self.ranges = np.stack([
+                sortedFirsts[starts], np.add.reduceat(sortedSizes, starts),
+            ], axis=1)
+            self.tileBoxes = np.stack([
+                np.minimum.reduceat(boxes[:, 0], starts),
+                np.minimum.reduceat(boxes[:, 1], starts),
+                np.maximum.reduceat(boxes[:, 2], starts),
+                np.maximum.reduceat(boxes[:, 3], starts),
+            ], axis=1)
+        else:
+            self.ranges = np.zeros((0, 2), dtype=int)
+            self.tileBoxes = np.zeros((0, 4))
+
+    def get_slot_order(self):
+        " return: The permutation of slots that sorts a buffer of items by band. "
+        sizes = self.sizes
+        origFirsts = np.cumsum(sizes) - sizes
+        order = self.order
+        shift = np.repeat(origFirsts[order] - self.firsts[order], sizes[order])
+        return shift + np.arange(len(shift))
+
+    def get_slot_tiles(self):
+        " return: (nSlots,) the tile of each slot of the sorted buffer. "
+        return np.repeat(np.arange(len(self.ranges)), self.ranges[:, 1])
+
+    def expand(self, i, box):
+        " Grow the box of the tile of item `i` to contain `box`. "
+        b = self.tileBoxes[self.tileOf[i]]
+        b[0:2] = np.minimum(b[0:2], box[0:2])
+        b[2:4] = np.maximum(b[2:4], box[2:4])
+
+    def visible_tiles(self, rect):
+        """
+        rect: (x1, y1, x2, y2) of the view, or None for everything.
+        return: The indexes of the tiles that intersect `rect`.
+        """
+        if rect is None:
+            return np.arange(len(self.ranges))
+        x1, y1, x2, y2 = rect
+        b = self.tileBoxes
+        visible = (b[:, 0] <= x2) & (b[:, 2] >= x1) & (b[:, 1] <= y2) & (b[:, 3] >= y1)
+        return np.nonzero(visible)[0]
+
+    def visible_ranges(self, rect):
+        """
+        rect: (x1, y1, x2, y2) of the view, or None for everything.
+        return: A list of (first, count), with adjacent ranges joined.
+        """
+        ranges = self.ranges[self.visible_tiles(rect)]
+        result = []
+        for first, count in ranges.tolist():
+            if result and result[-1][0] + result[-1][1] == first:
+                result[-1][1] += count
+            else:
+                result.append([first, count])
+        return result
+
+
 class Render(gl.Program):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """
+    A render keeps one vertex buffer of items, one item for each sprite. Each
+    item takes VERTICES_PER_ITEM rows of the buffer, and each row holds all
+    the attributes of a vertex, in the order of ATTRIBUTES. Rows are made as
+    floats and stored compactly, see `VertexFormat`.
+
+    The sprites of a group, usually a measure, lie in one range of the buffer
+    with GROUP_SLACK extra room, so an edited group can be rewritten in place
+    by `update_group`.
+    """
+    GROUP_SLACK = .25
+    # (name, size, kind) of the attributes, see `VertexFormat`.
+    ATTRIBUTES = []
+    VERTICES_PER_ITEM = 1
+    # The finest step of stored positions, in tenths.
+    POSITION_UNIT = 1 / 8
+
+    def __init__(self, shaders):
+        self.vertexFormat = VertexFormat(self.ATTRIBUTES)
+        super().__init__(shaders, self.vertexFormat.get_program_attributes())
+        self.rowSize = self.vertexFormat.nColumns
+        self.itemSize = self.rowSize * self.VERTICES_PER_ITEM
+        # The origin and unit of positions when the buffer is not tiled.
+        self.origin = (0, 0)
+        self.positionUnit = self.POSITION_UNIT
+        self._attribLocs = None
         self.matrix = np.eye(4, dtype=gl.GLfloat)
         self.color = DEFAULT_COLOR
+        self.highlightColor = HIGHLIGHT_COLOR
+        # The score time of playback. Sprites whose play time contains it are
+        # highlighted by the shaders, see `Sprite.playTime`.
+        self.time = -1.
+        # The visible sheet area (x1, y1, x2, y2). None means all.
+        self.viewRect = None
+        self.buffer = None
+        self.tiles = None
+        # key -> index of the group in `tiles`
+        self.groupIds = {}
 
     def enable_blending(self):
         gl.glEnable(gl.GL_BLEND)
@@ -39,71 +513,301 @@ class Render(gl.Program):
         gl.glUniform4fv(self.get_uniform_loc('color'), 1, self.color)
         gl.glUniformMatrix3fv(self.get_uniform_loc('matrix'), 1, gl.GL_TRUE, self.matrix)
 
+    def set_time_uniforms(self):
+        gl.glUniform1f(self.get_uniform_loc('time'), self.time)
+        gl.glUniform4fv(self.get_uniform_loc('highlightColor'), 1, self.highlightColor)
+
+    def set_interleaved_buffer(self, buffer):
+        " Bind all the attributes to `buffer`. "
+        if self._attribLocs is None:
+            self._attribLocs = [gl.glGetAttribLocation(self.glId, name)
+                for name, _, _ in self.ATTRIBUTES]
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, buffer.glId)
+        self.vertexFormat.bind(self._attribLocs)
+
+    def make_items(self, sprites):
+        " return: (len(sprites), itemSize) array. "
+        pass
+
+    def get_boxes(self, items):
+        " return: (n, 4) bounding boxes of `items`. "
+        pass
+
+    def make_empty_items(self, n):
+        """
+        return: (n, itemSize) items that draw nothing. Their positions are
+            relative to the origin of their tile.
+        """
+        return np.zeros((n, self.itemSize), dtype=gl.GLfloat)
+
+    def _pad(self, items, capacity):
+        return np.concatenate([items, self.make_empty_items(capacity - len(items))])
+
+    def make_display_items(self, dl):
+        """
+        dl: A `display.DisplayList`.
+        return: (groups, items), the items of the primitives of `dl` that this
+            render draws, and the group of each item.
+        """
+        return np.zeros(0, dtype=int), self.make_empty_items(0)
+
     def make_buffer(self, sprites):
+        self.make_buffer_groups([], sprites)
+
+    def make_buffer_display(self, dl):
+        " Make the buffer from a display list, keeping its groups. "
+        groups, items = self.make_display_items(dl)
+        grouped = groups >= 0
+        order = np.argsort(groups[grouped], kind='stable')
+        ids, starts = np.unique(groups[grouped][order], return_index=True)
+        parts = np.split(items[grouped][order], starts[1:])
+        self.make_buffer_items(
+            [(dl.get_group_key(g), part) for g, part in zip(ids.tolist(), parts)],
+            items[~grouped])
+
+    def make_buffer_groups(self, groups, loose=()):
+        """
+        groups: A list of (key, sprites).
+        loose: The sprites not in any group.
+        """
+        self.make_buffer_items(
+            [(key, self.make_items(sps)) for key, sps in groups if sps],
+            self.make_items(list(loose)))
+
+    def make_buffer_items(self, groups, loose):
+        """
+        groups: A list of (key, items).
+        loose: (n, itemSize) items not in any group.
+        """
+        parts = []
+        padding = []
+        boxes = []
+        sizes = []
+        self.groupIds = {}
+        for key, items in groups:
+            if not len(items):
+                continue
+            capacity = len(items) + int(np.ceil(len(items) * self.GROUP_SLACK))
+            self.groupIds[key] = len(sizes)
+            parts.append(self._pad(items, capacity))
+            padding.append(np.arange(capacity) >= len(items))
+            boxes.append(union_box(self.get_boxes(items)))
+            sizes.append(capacity)
+        parts.append(loose)
+        padding.append(np.zeros(len(loose), dtype=bool))
+        boxes = np.concatenate([np.reshape(boxes, (-1, 4)), self.get_boxes(loose)])
+        sizes.extend([1] * len(loose))
+        tiles = Tiles(boxes, sizes)
+        slotOrder = tiles.get_slot_order()
+        items = np.concatenate(parts)[slotOrder]
+        self.free_buffers()
+        self.tiles = tiles
+        if len(items):
+            n = self.VERTICES_PER_ITEM
+            rows = items.reshape(-1, self.rowSize)
+            rowTiles = np.repeat(tiles.get_slot_tiles(), n)
+            origins = tiles.origins[rowTiles]
+            padding = np.repeat(np.concatenate(padding)[slotOrder], n)
+            fmt = self.vertexFormat
+            rows[padding] = fmt.move_positions(rows[padding], origins[padding])
+            extents = np.zeros(len(tiles.ranges))
+            np.maximum.at(extents, rowTiles, fmt.get_extents(rows, origins))
+            tiles.units = np.array(
+                [fmt.get_unit(extent, self.POSITION_UNIT) for extent in extents.tolist()])
+            self.upload(fmt.encode(rows, origins, tiles.units[rowTiles]))
+
+    def upload(self, data):
+        " data: A structured array of `vertexFormat`. "
+        self.buffer = VertexBytesBuffer(data)
+
+    def update_group(self, key, sprites):
+        """
+        Rewrite the range of group `key` with `sprites` through glBufferSubData.
+        return: False if the group does not have enough room, then the buffer
+            has to be made again.
+        """
+        items = self.make_items(sprites)
+        i = self.groupIds.get(key)
+        if i is None:
+            return not len(items)
+        tiles = self.tiles
+        capacity = tiles.sizes[i]
+        if len(items) > capacity:
+            return False
+        origin = tiles.origins[tiles.tileOf[i]]
+        unit = tiles.units[tiles.tileOf[i]]
+        fmt = self.vertexFormat
+        empty = self.make_empty_items(capacity - len(items)).reshape(-1, self.rowSize)
+        rows = np.concatenate([
+            items.reshape(-1, self.rowSize),
+            fmt.move_positions(empty, np.tile(origin, (len(empty), 1))),
+        ])
+        data = fmt.encode(rows, origin, unit)
+        if data is None:
+            return False
+        offset = int(tiles.firsts[i]) * self.VERTICES_PER_ITEM * data.itemsize
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer.glId)
+        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, offset, data.nbytes, data)
+        if len(items):
+            self.tiles.expand(i, union_box(self.get_boxes(items)))
+        return True
+
+    def draw_range(self, first, count):
+        " Draw `count` items from item `first`. "
         pass
 
+    def set_origin(self, origin, unit):
+        " Set how the vertex shaders decode positions. "
+        gl.glUniform2f(self.get_uniform_loc('origin'), *origin)
+        gl.glUniform1f(self.get_uniform_loc('positionUnit'), unit)
+
+    def draw_visible(self):
+        tiles = self.tiles
+        if tiles is None:
+            self.set_origin(self.origin, self.positionUnit)
+            self.draw_range(0, len(self.buffer))
+            return
+        for i in tiles.visible_tiles(self.viewRect):
+            first, count = tiles.ranges[i]
+            self.set_origin(tiles.origins[i], tiles.units[i])
+            self.draw_range(int(first), int(count))
+
     def render(self):
         pass
 
     def free_buffers(self):
-        pass
+        if self.buffer:
+            self.buffer.free()
+        self.buffer = None
 
 
 class TextureRender(Render):
+    # 4 corners per glyph.
+    ATTRIBUTES = [
+        ('xy', 2, VertexKind.POSITION),
+        ('texCoord', 2, VertexKind.UNORM),
+        ('playTime', 2, VertexKind.FLOAT),
+    ]
+    VERTICES_PER_ITEM = 4
+
     def __init__(self):
         super().__init__([
             (get_resouce_path('shaders', 'texture.v.glsl'), gl.GL_VERTEX_SHADER),
             (get_resouce_path('shaders', 'texture.f.glsl'), gl.GL_FRAGMENT_SHADER),
-        ], [
-            ('xyuv', 4, gl.GL_FLOAT),
         ])
-        self.buffer = None
+        self.indexBuffer = QuadIndexBuffer()
         self.textureUnit = gl.TextureUnit(0)
-        self.load_templates(os.path.dirname(__file__), 'templates')
+        self.load_glyphs()
         self.color = np.array((1, 1, 1, 1), dtype=gl.GLfloat)
 
+    def load_glyphs(self):
+        self.load_templates(os.path.dirname(__file__), 'templates')
+
     def load_templates(self, dir, name):
-        image = PIL.Image.open(os.path.join(dir, name + '.png'))
-        self.textureSize = image.size
-        self.texture = gl.Texture2D(image)
-        config = json.load(open(os.path.join(dir, name + '.json')))
-        self.rects = config['rects']
-        self.centers = config['centers']
+        atlas = get_template_atlas(dir, name)
+        self.textureSize = atlas.size
+        self.texture = TEXTURES.get(atlas.path, lambda: self.make_texture(atlas))
+        self.rects = atlas.rects
+        self.centers = atlas.centers
+        self.glyphNames = sorted(self.rects)
+        self.glyphIds = {name: i for i, name in enumerate(self.glyphNames)}
+        self.glyphQuads = self.make_glyph_quads()
 
-    def make_buffer(self, sprites):
-        # (x, y, u, v)
-        buffer = np.zeros((len(sprites) * 6, 4), dtype=gl.GLfloat)
-        centers = self.centers
-        rects = self.rects
-        i = 0
+    @staticmethod
+    def make_texture(atlas):
+        " Upload `atlas` with its mip levels, which a zoomed out sheet samples. "
+        texture = gl.Texture2D(atlas.get_image())
+        if atlas.mipLevels > 1:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, texture.glId)
+            for level in range(1, atlas.mipLevels):
+                pixels = np.ascontiguousarray(atlas.get_mip_pixels(level))
+                h, w, _ = pixels.shape
+                gl.glTexImage2D(gl.GL_TEXTURE_2D, level, gl.GL_RGBA8, w, h, 0,
+                    gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, pixels)
+            gl.glTexParameteri(
+                gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAX_LEVEL, atlas.mipLevels - 1)
+            gl.glTexParameteri(
+                gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        return texture
+
+    def make_glyph_quads(self):
+        """
+        return: (nGlyphs, 4, 4) array. The (x, y, u, v) of the 4 corners of each
+            glyph, with (x, y) relative to the glyph center.
+        """
         k = sprite.Texture.TEXTURE_TO_TENTHS
-        for sp in sprites:
-            cx, cy = centers[sp.name]
-            u1, v1, tw, th = rects[sp.name]
-            x, y = sp.pos
-            x1 = x - k * cx
-            y1 = y - k * (th - cy)
-            x2 = x + k * (tw - cx)
-            y2 = y + k * cy
-            buffer[(i, i + 2, i + 3), 0] = x1
-            buffer[(i, i + 1, i + 4), 1] = y1
-            buffer[(i + 1, i + 4, i + 5), 0] = x2
-            buffer[(i + 2, i + 3, i + 5), 1] = y2
-            u2 = u1 + tw
-            v2 = v1 + th
-            buffer[(i, i + 2, i + 3), 2] = u1
-            buffer[(i + 2, i + 3, i + 5), 3] = v1
-            buffer[(i + 1, i + 4, i + 5), 2] = u2
-            buffer[(i, i + 1, i + 4), 3] = v2
-            i += 6
-        buffer[:, (2, 3)] /= self.textureSize
-        self.free_buffers()
-        self.buffer = gl.VertexBuffer(buffer)
+        centers = np.array([self.centers[n] for n in self.glyphNames], dtype=float)
+        rects = np.array([self.rects[n] for n in self.glyphNames], dtype=float)
+        cx, cy = centers.T
+        u1, v1, tw, th = rects.T
+        x1 = -k * cx
+        y1 = -k * (th - cy)
+        x2 = k * (tw - cx)
+        y2 = k * cy
+        tw1, th1 = self.textureSize
+        u1, u2 = u1 / tw1, (u1 + tw) / tw1
+        v1, v2 = v1 / th1, (v1 + th) / th1
+        # Corner order matches make_quad_indices.
+        return np.stack([
+            np.stack([x1, y1, u1, v2], axis=1),
+            np.stack([x2, y1, u2, v2], axis=1),
+            np.stack([x1, y2, u1, v1], axis=1),
+            np.stack([x2, y2, u2, v1], axis=1),
+        ], axis=1).astype(gl.GLfloat)
 
-    def free_buffers(self):
-        if self.buffer:
-            self.buffer.free()
-        self.buffer = None
+    def make_items(self, sprites):
+        n = len(sprites)
+        glyphIds = self.glyphIds
+        ids = np.fromiter((glyphIds[sp.name] for sp in sprites), dtype=np.intp, count=n)
+        positions = np.array([sp.pos for sp in sprites], dtype=gl.GLfloat).reshape(n, 2)
+        playTimes = np.array([sp.playTime or NO_PLAY_TIME for sp in sprites],
+            dtype=gl.GLfloat).reshape(n, 2)
+        return self.make_items_arrays(ids, positions, playTimes)
+
+    def make_display_items(self, dl):
+        glyphs = dl.glyphs
+        glyphIds = np.array([self.glyphIds[name] for name in dl.glyphNames], dtype=np.intp)
+        items = self.make_items_arrays(
+            glyphIds[glyphs['glyph']] if len(glyphs) else np.zeros(0, dtype=np.intp),
+            glyphs['pos'].astype(gl.GLfloat), glyphs['playTime'].astype(gl.GLfloat))
+        return glyphs['group'], items
+
+    def make_items_arrays(self, ids, positions, playTimes=None, quads=None):
+        """
+        ids: (n,) glyph ids, indexes into `glyphNames`.
+        positions: (n, 2) glyph centers.
+        playTimes: (n, 2) (onset, offset) of the glyphs. Default to never
+            highlighted.
+        quads: (n, 4, 4) the glyph quads to use instead of `glyphQuads[ids]`.
+        """
+        n = len(ids)
+        items = np.empty((n, self.VERTICES_PER_ITEM, self.rowSize), dtype=gl.GLfloat)
+        items[:, :, 0:4] = self.glyphQuads[ids] if quads is None else quads
+        items[:, :, 0:2] += positions[:, None, :]
+        items[:, :, 4:6] = NO_PLAY_TIME if playTimes is None else playTimes[:, None, :]
+        return items.reshape(n, self.itemSize)
+
+    def make_buffer_arrays(self, ids, positions, playTimes=None):
+        self.make_buffer_items([], self.make_items_arrays(ids, positions, playTimes))
+
+    def get_boxes(self, items):
+        vertices = items.reshape(len(items), self.VERTICES_PER_ITEM, self.rowSize)
+        xs = vertices[:, :, 0]
+        ys = vertices[:, :, 1]
+        return np.stack(
+            [xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)], axis=1)
+
+    def upload(self, data):
+        self.indexBuffer.reserve(len(data) // self.VERTICES_PER_ITEM)
+        super().upload(data)
+
+    def draw_range(self, first, count):
+        self.indexBuffer.draw(count, first)
+
+    def free(self):
+        self.indexBuffer.free()
+        super().free()
 
     def render(self):
         if self.buffer:
@@ -113,49 +817,145 @@ class TextureRender(Render):
             gl.glActiveTexture(self.textureUnit.glenum)
             gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture.glId)
             gl.glUniform1i(self.get_uniform_loc('textureSampler'), self.textureUnit.id)
+            self.set_time_uniforms()
+
+            self.set_interleaved_buffer(self.buffer)
+            self.draw_visible()
+
+
+class InterleavedRender(Render):
+    " A render that draws one point per sprite, expanded by a geometry shader. "
+
+    @staticmethod
+    def get_row(sp):
+        pass
+
+    def make_items(self, sprites):
+        rows = np.array([self.get_row(sp) for sp in sprites], dtype=gl.GLfloat)
+        return rows.reshape(len(sprites), self.rowSize)
 
-            self.set_buffer('xyuv', self.buffer)
-            super().draw(gl.GL_TRIANGLES, len(self.buffer))
+    def make_buffer_arrays(self, rows):
+        " rows: (n, rowSize) array. "
+        self.make_buffer_items([], rows)
+
+    def set_uniforms(self):
+        pass
+
+    def draw_range(self, first, count):
+        gl.glDrawArrays(gl.GL_POINTS, first, count)
+
+    def render(self):
+        if self.buffer:
+            self.enable_blending()
+            self.set_default_uniforms()
+            self.set_uniforms()
+            self.set_interleaved_buffer(self.buffer)
+            self.draw_visible()
 
 
-class LineRender(Render):
+class LineRender(InterleavedRender):
+    ATTRIBUTES = [
+        ('line', 4, VertexKind.POSITION),
+        ('width', 1, VertexKind.HALF),
+        ('playTime', 2, VertexKind.FLOAT),
+    ]
+
     def __init__(self):
         super().__init__([
             (get_resouce_path('shaders', 'line.v.glsl'), gl.GL_VERTEX_SHADER),
             # (get_resouce_path('shaders', 'line-round.g.glsl'), gl.GL_GEOMETRY_SHADER),
             (get_resouce_path('shaders', 'line.g.glsl'), gl.GL_GEOMETRY_SHADER),
+            (get_resouce_path('shaders', 'color.f.glsl'), gl.GL_FRAGMENT_SHADER),
+        ])
+
+    @staticmethod
+    def get_row(line):
+        (x1, y1), (x2, y2) = line.start, line.end
+        return (x1, y1, x2, y2, line.width) + tuple(line.playTime or NO_PLAY_TIME)
+
+    def make_display_items(self, dl):
+        lines = dl.lines
+        rows = np.concatenate([
+            lines['start'], lines['end'], lines['width'][:, None], lines['playTime'],
+        ], axis=1).astype(gl.GLfloat)
+        return lines['group'], rows
+
+    def make_empty_items(self, n):
+        # A line of zero width.
+        return np.tile(np.array(
+            (0, 0, 1, 0, 0) + NO_PLAY_TIME, dtype=gl.GLfloat), (n, 1))
+
+    def set_uniforms(self):
+        self.set_time_uniforms()
+
+    def get_boxes(self, rows):
+        r = rows[:, 4:5] / 2
+        return np.concatenate([
+            np.minimum(rows[:, 0:2], rows[:, 2:4]) - r,
+            np.maximum(rows[:, 0:2], rows[:, 2:4]) + r,
+        ], axis=1)
+
+
+class BlobRender(LineRender):
+    """
+    Draw note heads as short thick lines, for the views where the glyphs are
+    too small to be seen, see `viewer.SheetCanvas.DETAIL_TIERS`.
+    """
+    renderType = 'blob'
+
+    @staticmethod
+    def get_row(head):
+        x, y = head.pos
+        w, h = head.size
+        return (x - w / 2, y, x + w / 2, y, h) + tuple(head.playTime or NO_PLAY_TIME)
+
+    def make_display_items(self, dl):
+        glyphs = dl.glyphs[(dl.glyphs['playTime'] != NO_PLAY_TIME).any(axis=1)]
+        _, _, w, h = dl.get_glyph_metrics()[glyphs['glyph']].T
+        x, y = glyphs['pos'].T
+        rows = np.stack([x - w / 2, y, x + w / 2, y, h], axis=1)
+        rows = np.concatenate([rows, glyphs['playTime']], axis=1).astype(gl.GLfloat)
+        return glyphs['group'], rows
+
+
+class LedgerRender(InterleavedRender):
+    # (x, y) and (count, step).
+    ATTRIBUTES = [
+        ('pos', 2, VertexKind.POSITION),
+        ('countStep', 2, VertexKind.HALF),
+    ]
+
+    def __init__(self):
+        super().__init__([
+            (get_resouce_path('shaders', 'ledger.v.glsl'), gl.GL_VERTEX_SHADER),
+            (get_resouce_path('shaders', 'ledger.g.glsl'), gl.GL_GEOMETRY_SHADER),
             (get_resouce_path('shaders', 'line.f.glsl'), gl.GL_FRAGMENT_SHADER),
-        ], [
-            ('line', 4, gl.GL_FLOAT),
-            ('width', 1, gl.GL_FLOAT),
         ])
-        self.lineBuffer = None
-        self.widthBuffer = None
-
-    def make_buffer(self, lines):
-        buffer = np.zeros((len(lines), 5), dtype=gl.GLfloat)
-        for i, line in enumerate(lines):
-            buffer[i, (0, 1)] = line.start
-            buffer[i, (2, 3)] = line.end
-            buffer[i, 4] = line.width
-        self.free_buffers()
-        self.lineBuffer = gl.VertexBuffer(buffer[:, :4])
-        self.widthBuffer = gl.VertexBuffer(buffer[:, 4])
+        self.size = np.array(
+            (sprite.Ledger.WIDTH, sprite.Ledger.THICK), dtype=gl.GLfloat)
 
-    def free_buffers(self):
-        if self.lineBuffer:
-            self.lineBuffer.free()
-        if self.widthBuffer:
-            self.widthBuffer.free()
-        self.lineBuffer = self.widthBuffer = None
+    @staticmethod
+    def get_row(ledger):
+        x, y = ledger.pos
+        return x, y, ledger.count, ledger.step
 
-    def render(self):
-        if self.lineBuffer and self.widthBuffer:
-            self.enable_blending()
-            self.set_default_uniforms()
-            self.set_buffer('line', self.lineBuffer)
-            self.set_buffer('width', self.widthBuffer)
-            super().draw(gl.GL_POINTS, len(self.lineBuffer))
+    def make_display_items(self, dl):
+        ledgers = dl.ledgers
+        rows = np.concatenate([
+            ledgers['pos'], ledgers['count'][:, None], ledgers['step'][:, None],
+        ], axis=1).astype(gl.GLfloat)
+        return ledgers['group'], rows
+
+    def get_boxes(self, rows):
+        w, t = self.size / 2
+        x, y, count, step = rows.T
+        y2 = y + (count - 1) * step
+        return np.stack([
+            x - w, np.minimum(y, y2) - t, x + w, np.maximum(y, y2) + t,
+        ], axis=1)
+
+    def set_uniforms(self):
+        gl.glUniform2fv(self.get_uniform_loc('size'), 1, self.size)
 
 
 class IndicatorRender(LineRender):
@@ -164,15 +964,17 @@ class IndicatorRender(LineRender):
     def __init__(self):
         super().__init__()
         self.color = self.MEASURE_INDICATOR_COLOR
-        self.lineBuffer = gl.DynamicVertexBuffer()
-        self.widthBuffer = gl.DynamicVertexBuffer()
+        self.buffer = VertexBytesBuffer(usage=gl.GL_DYNAMIC_DRAW)
         self.measure = None
 
     def set_measure(self, measure):
         self.measure = measure
         self.update_buffer()
 
-    def make_buffer(self, *args):
+    def make_buffer_groups(self, *args):
+        pass
+
+    def make_buffer_display(self, dl):
         pass
 
     def free_buffers(self):
@@ -182,14 +984,18 @@ class IndicatorRender(LineRender):
         measure = self.measure
         if not measure:
             return
-        buffer = np.zeros((1, 5), dtype=gl.GLfloat)
         # x1, y1, x2, y2, width
         y = measure.y + (measure.bottomY + measure.topY)/ 2
-        buffer[0, 0:2] = measure.x, y
-        buffer[0, 2:4] = measure.x + measure.width, y
-        buffer[0, 4] = measure.topY - measure.bottomY
-        self.lineBuffer.set_data(buffer[:, 0:4])
-        self.widthBuffer.set_data(buffer[:, 4])
+        buffer = np.array([(
+            measure.x, y, measure.x + measure.width, y,
+            measure.topY - measure.bottomY,
+        ) + NO_PLAY_TIME], dtype=gl.GLfloat)
+        # Positions are relative to the measure, as the sheet may be large.
+        self.origin = (measure.x, y)
+        origins = np.array([self.origin])
+        fmt = self.vertexFormat
+        self.positionUnit = fmt.fit_unit(buffer, origins, self.POSITION_UNIT)
+        self.buffer.set_data(fmt.encode(buffer, origins, self.positionUnit))
 
     def render(self):
         if not self.measure:
@@ -197,68 +1003,147 @@ class IndicatorRender(LineRender):
         super().render()
 
 
-class BeamRender(Render):
+class BeamRender(InterleavedRender):
+    ATTRIBUTES = [
+        ('line', 4, VertexKind.POSITION),
+        ('height', 1, VertexKind.HALF),
+    ]
+
     def __init__(self):
         super().__init__([
             (get_resouce_path('shaders', 'beam.v.glsl'), gl.GL_VERTEX_SHADER),
             (get_resouce_path('shaders', 'beam.g.glsl'), gl.GL_GEOMETRY_SHADER),
             (get_resouce_path('shaders', 'beam.f.glsl'), gl.GL_FRAGMENT_SHADER),
-        ], [
-            ('line', 4, gl.GL_FLOAT),
-            ('height', 1, gl.GL_FLOAT),
         ])
-        self.lineBuffer = None
-        self.heightBuffer = None
-
-    def make_buffer(self, beams):
-        buffer = np.zeros((len(beams), 5), dtype=gl.GLfloat)
-        for i, beam in enumerate(beams):
-            buffer[i, (0, 1)] = beam.start
-            buffer[i, (2, 3)] = beam.end
-            buffer[i, 4] = beam.height
-        self.free_buffers()
-        self.lineBuffer = gl.VertexBuffer(buffer[:, :4])
-        self.heightBuffer = gl.VertexBuffer(buffer[:, 4])
 
-    def free_buffers(self):
-        if self.lineBuffer:
-            self.lineBuffer.free()
-        if self.heightBuffer:
-            self.heightBuffer.free()
-        self.lineBuffer = self.heightBuffer = None
+    @staticmethod
+    def get_row(beam):
+        (x1, y1), (x2, y2) = beam.start, beam.end
+        return x1, y1, x2, y2, beam.height
 
-    def render(self):
-        if self.lineBuffer and self.heightBuffer:
-            self.enable_blending()
-            self.set_default_uniforms()
-            self.set_buffer('line', self.lineBuffer)
-            self.set_buffer('height', self.heightBuffer)
-            self.draw(gl.GL_POINTS, len(self.lineBuffer))
+    def make_display_items(self, dl):
+        beams = dl.beams
+        rows = np.concatenate([
+            beams['start'], beams['end'], beams['height'][:, None],
+        ], axis=1).astype(gl.GLfloat)
+        return beams['group'], rows
 
+    def make_empty_items(self, n):
+        # A beam of zero height.
+        return np.tile(np.array([0, 0, 1, 0, 0], dtype=gl.GLfloat), (n, 1))
 
-class TextRender(ui.render.FontRender):
-    def __init__(self):
-        super().__init__()
-        self._textboxes = []
+    def get_boxes(self, rows):
+        h = rows[:, 4]
+        ys = rows[:, (1, 3)]
+        return np.stack([
+            np.minimum(rows[:, 0], rows[:, 2]),
+            np.minimum(ys.min(axis=1), ys.min(axis=1) + h),
+            np.maximum(rows[:, 0], rows[:, 2]),
+            np.maximum(ys.max(axis=1), ys.max(axis=1) + h),
+        ], axis=1)
 
-    def make_buffer(self, textSps):
-        self._textboxes = list(textSps)
 
-    @property
-    def matrix(self):
-        return self._matrix
+class TextGlyphRender(TextureRender):
+    """
+    Draw text sprites as glyph quads of a TextAtlas, in one draw call like the
+    other textures. Each character is an item of the buffer.
 
-    @matrix.setter
-    def matrix(self, matrix):
-        mat4 = np.eye(4, dtype=gl.GLfloat)
-        mat4[0:2, 0:2] = matrix[0:2, 0:2]
-        mat4[1, :] *= -1
-        mat4[3, 3] = matrix[2, 2]
-        mat4[0:2, 3] = matrix[0:2, 2]
-        self._matrix = mat4
+    The atlas and its texture are shared, see `atlas.get_text_atlas`, and are
+    changed with the whole buffer when a new character shows up.
+    """
 
-    def render(self):
-        self.draw_textboxs(self._textboxes)
+    def load_glyphs(self):
+        self.atlas = None
+        self.texture = None
+        self.glyphIds = {}
+        self.glyphQuads = np.zeros((0, 4, 4), dtype=gl.GLfloat)
 
-    def free_buffers(self):
-        pass
+    def reserve_chars(self, chars):
+        chars = set(chars)
+        atlas = self.atlas
+        if atlas is not None:
+            if atlas.has_chars(chars):
+                return
+            chars.update(atlas.chars)
+        self.atlas = atlas = get_text_atlas(chars)
+        # Shared by the canvases with the same characters, like the templates.
+        self.texture = TEXTURES.get(
+            ('text', tuple(atlas.chars)), lambda: gl.Texture2D(atlas.image))
+        self.textureSize = atlas.image.size
+        self.glyphIds = atlas.charIds
+        self.glyphQuads = self.make_glyph_quads()
+
+    def make_glyph_quads(self):
+        " return: (nChars, 4, 4) array, see `TextureRender.make_glyph_quads`. "
+        atlas = self.atlas
+        x1, y1, x2, y2 = atlas.boxes.T.astype(float)
+        u, v, w, h = atlas.rects.T.astype(float)
+        tw, th = self.textureSize
+        u1, u2 = u / tw, (u + w) / tw
+        v1, v2 = v / th, (v + h) / th
+        # The atlas has y pointing down.
+        return np.stack([
+            np.stack([x1, -y2, u1, v2], axis=1),
+            np.stack([x2, -y2, u2, v2], axis=1),
+            np.stack([x1, -y1, u1, v1], axis=1),
+            np.stack([x2, -y1, u2, v1], axis=1),
+        ], axis=1).astype(gl.GLfloat)
+
+    def make_items(self, textSps):
+        """
+        Lay the characters of each text in a line from the top left of the
+        text box, aligned in the box width if the text has one.
+        """
+        atlas = self.atlas
+        glyphIds = self.glyphIds
+        ids = []
+        origins = []
+        scales = []
+        for sp in textSps:
+            chIds = np.array([glyphIds[ch] for ch in sp.text], dtype=np.intp)
+            k = sp.fontSize / atlas.PIXEL_SIZE
+            advances = atlas.advances[chIds] * k
+            x = sp.x
+            width = getattr(sp, 'width', 0)
+            align = getattr(sp, 'align', 'left')
+            if width and align == 'center':
+                x += (width - advances.sum()) / 2
+            elif width and align == 'right':
+                x += width - advances.sum()
+            pens = np.empty((len(chIds), 2))
+            pens[:, 0] = x + np.cumsum(advances) - advances
+            # Text boxes have y pointing down, see `sprite.Text.put`.
+            pens[:, 1] = -sp.y
+            ids.append(chIds)
+            origins.append(pens)
+            scales.append(np.full(len(chIds), k))
+        if not ids:
+            return np.zeros((0, self.itemSize), dtype=gl.GLfloat)
+        ids = np.concatenate(ids)
+        quads = self.glyphQuads[ids]
+        quads[:, :, 0:2] *= np.concatenate(scales)[:, None, None]
+        return self.make_items_arrays(ids, np.concatenate(origins), quads=quads)
+
+    def make_buffer_groups(self, groups, loose=()):
+        loose = list(loose)
+        self.reserve_chars(
+            ch for sps in [loose] + [sps for _, sps in groups]
+            for sp in sps for ch in sp.text)
+        super().make_buffer_groups(groups, loose)
+
+    def make_display_items(self, dl):
+        runs = dl.get_text_runs()
+        groups = np.repeat(
+            np.array([run.group for run in runs], dtype=int),
+            [len(run.text) for run in runs])
+        return groups, self.make_items(runs)
+
+    def make_buffer_display(self, dl):
+        self.reserve_chars(dl.text.decode('utf-8'))
+        super().make_buffer_display(dl)
+
+    def update_group(self, key, textSps):
+        if self.atlas is None or not self.atlas.has_chars(
+                ch for sp in textSps for ch in sp.text):
+            return False
+        return super().update_group(key, textSps)
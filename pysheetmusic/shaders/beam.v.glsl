@@ -1,10 +1,13 @@
 # version 330 core
+uniform vec2 origin;
+uniform float positionUnit;
+// Quantized, see render.VertexFormat.
 in vec4 line;
 in float height;
 out vec2 start, end;
 out float height1;
 void main() {
-    start = line.xy;
-    end = line.zw;
+    start = origin + line.xy * positionUnit;
+    end = origin + line.zw * positionUnit;
     height1 = height;
 }
@@ -0,0 +1,6 @@
+# version 330 core
+in vec4 color1;
+out vec4 fragColor;
+void main() {
+    fragColor = color1;
+}
@@ -0,0 +1,27 @@
+# version 330 core
+layout(points) in;
+// 4 vertices for each of at most 8 ledger lines, see sprite.Ledger.MAX_COUNT.
+layout(triangle_strip, max_vertices=32) out;
+uniform mat3 matrix;
+// (width, thick) of a ledger line.
+uniform vec2 size;
+in vec2 pos1[];
+in float count[], step1[];
+
+void emit(vec2 p) {
+    gl_Position = vec4(matrix * vec3(p, 1), 1); EmitVertex();
+}
+
+void main() {
+    vec2 w = vec2(size.x / 2, 0);
+    vec2 t = vec2(0, size.y / 2);
+    int n = min(int(count[0] + .5), 8);
+    for (int i = 0; i < n; i++) {
+        vec2 c = pos1[0] + vec2(0, step1[0] * i);
+        emit(c - w - t);
+        emit(c - w + t);
+        emit(c + w - t);
+        emit(c + w + t);
+        EndPrimitive();
+    }
+}
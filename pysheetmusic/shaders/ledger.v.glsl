@@ -0,0 +1,14 @@
+# version 330 core
+uniform vec2 origin;
+uniform float positionUnit;
+// Quantized, see render.VertexFormat.
+in vec2 pos;
+in vec2 countStep;
+out vec2 pos1;
+out float count, step1;
+
+void main() {
+    pos1 = origin + pos * positionUnit;
+    count = countStep.x;
+    step1 = countStep.y;
+}
@@ -2,8 +2,12 @@
 layout(points) in;
 layout(triangle_strip, max_vertices=4) out;
 uniform mat3 matrix;
+uniform float time;
+uniform vec4 color, highlightColor;
 in vec2 start[], end[];
 in float width1[];
+in vec2 playTime1[];
+out vec4 color1;
 
 void main() {
     vec2 v1 = start[0];
@@ -11,6 +15,8 @@ void main() {
     float width = width1[0];
     vec2 p = normalize(v2 - v1);
     p = vec2(-p.y, p.x) * (width / 2);
+    vec2 t = playTime1[0];
+    color1 = t.x <= time && time < t.y ? highlightColor : color;
     gl_Position = vec4(matrix * vec3(v1 - p, 1), 1); EmitVertex();
     gl_Position = vec4(matrix * vec3(v1 + p, 1), 1); EmitVertex();
     gl_Position = vec4(matrix * vec3(v2 - p, 1), 1); EmitVertex();
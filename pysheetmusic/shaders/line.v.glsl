@@ -1,12 +1,19 @@
 # version 330 core
 uniform mat3 matrix;
+uniform vec2 origin;
+uniform float positionUnit;
+// Quantized, see render.VertexFormat.
 in vec4 line;
 in float width;
+// (onset, offset) in score time.
+in vec2 playTime;
 out vec2 start, end;
 out float width1;
+out vec2 playTime1;
 
 void main() {
-    start = line.xy;
-    end = line.zw;
+    start = origin + line.xy * positionUnit;
+    end = origin + line.zw * positionUnit;
     width1 = width;
+    playTime1 = playTime;
 }
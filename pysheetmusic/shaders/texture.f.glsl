@@ -1,9 +1,12 @@
 # version 330 core
 uniform sampler2D textureSampler;
 uniform vec4 color;
+uniform vec4 highlightColor;
 in vec2 uv;
+in float active;
 out vec4 fragColor;
 
 void main() {
-    fragColor = texture(textureSampler, uv) * color;
+    vec4 c = texture(textureSampler, uv);
+    fragColor = active > .5 ? vec4(highlightColor.rgb, c.a * highlightColor.a) : c * color;
 }
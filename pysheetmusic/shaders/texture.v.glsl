@@ -1,10 +1,19 @@
 # version 330 core
-in vec4 xyuv;
+// Quantized, see render.VertexFormat.
+in vec2 xy;
+in vec2 texCoord;
+// (onset, offset) in score time.
+in vec2 playTime;
 uniform mat3 matrix;
+uniform vec2 origin;
+uniform float positionUnit;
+uniform float time;
 
 out vec2 uv;
+out float active;
 
 void main() {
-    gl_Position = vec4(matrix * vec3(xyuv.xy, 1), 1);
-    uv = xyuv.zw;
+    gl_Position = vec4(matrix * vec3(origin + xy * positionUnit, 1), 1);
+    uv = texCoord;
+    active = float(playTime.x <= time && time < playTime.y);
 }
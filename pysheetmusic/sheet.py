@@ -1,10 +1,9 @@
 from fractions import Fraction
 from collections import defaultdict
+from bisect import bisect_right
 import numpy as np
 import re
 
-from raygllib import ui
-
 from . import sprite
 from .utils import monad
 
@@ -154,6 +153,30 @@ class Sheet:
                 yield timeStart, timeEnd, note
             currentTime += A(measure.timeLength)
 
+    def set_score_times(self):
+        """
+        Set `scoreTime` of each measure, the time it starts when all measures
+        are played once in written order. Unlike the time of the performance,
+        a note has only one score time even if it is repeated.
+        """
+        time = Fraction(0)
+        for measure in self.iter_measures():
+            measure.scoreTime = time
+            time += measure.get_actual_time(measure.timeLength)
+        # The performance time when each measure of measureSeq starts.
+        self._seqTimes = seqTimes = []
+        time = Fraction(0)
+        for measure in self.measureSeq:
+            seqTimes.append(time)
+            time += measure.get_actual_time(measure.timeLength)
+
+    def to_score_time(self, time):
+        " Convert a time of the performance, see `iter_note_sequence`. "
+        i = bisect_right(self._seqTimes, time) - 1
+        if i < 0:
+            return float(time)
+        return float(self.measureSeq[i].scoreTime + time - self._seqTimes[i])
+
     def find_ending_from(self, measure, number):
         measure0 = measure
         while measure and (not measure.ending or measure.ending.number != number):
@@ -293,6 +316,8 @@ class Measure:
         self.barlines = {}
         self.width = float(xmlnode.attrib['width'])  # TODO: Handle no width situation.
         self.number = int(xmlnode.attrib['number'])
+        # See `Sheet.set_score_times`.
+        self.scoreTime = Fraction(0)
         self.isNewSystem = False
         self.isNewPage = False
         self.topSystemDistance = 0
@@ -410,15 +435,30 @@ class Measure:
         self.layout_barlines()
         # Display measure number
         if self.isNewSystem:
-            self.add_sprite(sprite.Text(
-                text=str(self.number),
-                fontSize=14,
-                color=ui.Color(0., 0., 0., 1.),
-                x=10,
-                y=-(-22),
-            ))
+            self.add_sprite(self.make_number_text())
         self.layout_ending()
 
+    def make_number_text(self):
+        return sprite.Text(
+            text=str(self.number),
+            fontSize=14,
+            color=sprite.BLACK,
+            x=10,
+            y=-(-22),
+        )
+
+    def make_header(self):
+        """
+        Make the sprites that start a system: clef, key signature and measure
+        number. They are not added to the measure.
+        return: (sprites, width)
+        """
+        sprites = []
+        x = self.put_clef(sprites.append, 0)
+        x = self.put_key(sprites.append, x)
+        sprites.append(self.make_number_text())
+        return sprites, x
+
     def layout_ending(self):
         ending = self.ending
         if not ending:
@@ -432,7 +472,7 @@ class Measure:
             fontSize=Ending.FONT_SIZE,
             text='{}.'.format(ending.number),
             x=10, y=-(y0 + 10),
-            color=ui.Color(0., 0., 0., 1.),
+            color=sprite.BLACK,
         ))
         add_sprite(sprite.Line(
             (- Ending.THICK / 2, y1),
@@ -445,26 +485,33 @@ class Measure:
         add_sprite = self.add_sprite
         y = 0
         for i in range(self.nLines):
-            add_sprite(sprite.Line(start=(x1, y), end=(x2, y), width=self.LINE_THICK))
+            add_sprite(sprite.StaffLine(
+                start=(x1, y), end=(x2, y), width=self.LINE_THICK))
             y += self.staffSpacing
 
     def layout_clef(self):
         if self.isNewSystem:
-            clef = self.clef
-            cx, cy = clef.sprite.center
-            clef.sprite.pos = (self._beginX + cx + 5, self.get_line_y(clef.line))
-            self.add_sprite(clef.sprite)
-            self._beginX = \
-                clef.sprite.pos[0] + clef.sprite.size[0] - clef.sprite.center[0] + 5
+            self._beginX = self.put_clef(self.add_sprite, self._beginX)
+
+    def put_clef(self, add_sprite, x):
+        " Put the clef after `x`. return: The x after the clef. "
+        clef = self.clef
+        cx, cy = clef.sprite.center
+        clef.sprite.pos = (x + cx + 5, self.get_line_y(clef.line))
+        add_sprite(clef.sprite)
+        return clef.sprite.pos[0] + clef.sprite.size[0] - clef.sprite.center[0] + 5
 
     def layout_key(self):
         if not self.isNewSystem:
             return
-        add_sprite = self.add_sprite
+        self.put_key(self.add_sprite, self._beginX)
+
+    def put_key(self, add_sprite, x):
+        " Put the key signature after `x`. return: The x after the key signature. "
         key = self.key
         type = 'sharp' if key.fifths >= 0 else 'flat'
         sp = sprite.Texture(None, type)
-        x = self._beginX + sp.center[0]
+        x += sp.center[0]
         dx = sp.size[0]
         for name in key.names:
             if self.clef.sign == 'G':
@@ -475,9 +522,7 @@ class Measure:
             y = self.get_pitch_y(name, octave)
             add_sprite(sprite.Texture((x, y), type))
             x += dx
-
-    ADD_LINE_WIDTH = 18
-    ADD_LINE_THICK = 2
+        return x - sp.center[0]
 
     def layout_notes(self):
         if not self.notes:
@@ -527,24 +572,29 @@ class Measure:
                     y = self.get_line_y(3)
             note.pos = (note.pos[0], y)
 
-        add_sprite = self.add_sprite
-        w = self.ADD_LINE_WIDTH
-        h = self.ADD_LINE_THICK
         dy = self.staffSpacing
         for note in self.notes:
             x, y = note.pos
-            y1 = - dy
-            while y1 >= y - dy / 4:
-                add_sprite(sprite.Line((x - w / 2, y1), (x + w / 2, y1), h))
-                y1 -= dy
-            y1 = self.height + dy
-            while y1 <= y + dy / 4:
-                add_sprite(sprite.Line((x - w / 2, y1), (x + w / 2, y1), h))
-                y1 += dy
+            n = 0
+            while - (n + 1) * dy >= y - dy / 4:
+                n += 1
+            self.add_ledgers((x, - dy), n, - dy)
+            n = 0
+            while self.height + (n + 1) * dy <= y + dy / 4:
+                n += 1
+            self.add_ledgers((x, self.height + dy), n, dy)
         for note in self.iter_pitched_notes():
             if note.stem:
                 note.stem.set_geometry()
 
+    def add_ledgers(self, pos, count, step):
+        x, y = pos
+        while count > 0:
+            n = min(count, sprite.Ledger.MAX_COUNT)
+            self.add_sprite(sprite.Ledger((x, y), n, step))
+            y += n * step
+            count -= n
+
     def iter_pitched_notes(self):
         for note in self.notes:
             if isinstance(note, PitchedNote):
@@ -893,11 +943,22 @@ class PitchedNote(Note):
         x, y = self.pos
         w, h = sp.size
         add_sprite = self.measure.add_sprite
+        sp.playTime = playTime = self.get_play_time()
         if self.stem:
-            add_sprite(sprite.Line(self.stem.head, self.stem.tail, Stem.THICK))
+            stemSp = sprite.Line(self.stem.head, self.stem.tail, Stem.THICK)
+            stemSp.playTime = playTime
+            add_sprite(stemSp)
         self.put_dots()
         add_sprite(self.sprite)
 
+    def get_play_time(self):
+        " return: (onset, offset) in score time, see `Sheet.set_score_times`. "
+        measure = self.measure
+        A = measure.get_actual_time
+        t0 = measure.scoreTime
+        return (float(t0 + A(self.timeStart)),
+            float(t0 + A(self.timeStart + self.duration)))
+
 
 class Rest(Note):
     TYPE_TO_NAME = {
@@ -0,0 +1,106 @@
+from collections import defaultdict
+from math import floor
+
+
+class PickKind:
+    MEASURE = 'measure'
+    NOTE = 'note'
+    FINGERING = 'fingering'
+    # A glyph of a display list, see `display.DisplayList.make_index`.
+    GLYPH = 'glyph'
+
+
+def texture_box(sp):
+    " return: The box (x1, y1, x2, y2) covered by a placed Texture sprite. "
+    x, y = sp.pos
+    cx, cy = sp.center
+    w, h = sp.size
+    return x - cx, y - (h - cy), x - cx + w, y + cy
+
+
+class SpatialIndex:
+    """
+    A uniform grid over axis-aligned boxes, used to find the objects under a
+    point without scanning all of them.
+
+    Each box is registered in every cell it overlaps, so a query only looks at
+    the boxes of one cell.
+    """
+    # The cell size is this many times of the median box size.
+    CELL_SCALE = 4
+
+    def __init__(self):
+        self.boxes = []
+        self.items = []
+        self.cellSize = 1
+        self._cells = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, box, item):
+        x1, y1, x2, y2 = box
+        self.boxes.append((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+        self.items.append(item)
+
+    def build(self):
+        boxes = self.boxes
+        if not boxes:
+            self._cells = {}
+            return
+        sizes = sorted(max(x2 - x1, y2 - y1) for x1, y1, x2, y2 in boxes)
+        self.cellSize = max(1, self.CELL_SCALE * sizes[len(sizes) // 2])
+        cells = defaultdict(list)
+        for i, (x1, y1, x2, y2) in enumerate(boxes):
+            i1, j1 = self._cell_of(x1, y1)
+            i2, j2 = self._cell_of(x2, y2)
+            for ci in range(i1, i2 + 1):
+                for cj in range(j1, j2 + 1):
+                    cells[ci, cj].append(i)
+        # Sort each cell by area, so that the query results come in the order
+        # of the smallest box first.
+        area = lambda i: (boxes[i][2] - boxes[i][0]) * (boxes[i][3] - boxes[i][1])
+        for ids in cells.values():
+            ids.sort(key=area)
+        self._cells = dict(cells)
+
+    def _cell_of(self, x, y):
+        k = self.cellSize
+        return floor(x / k), floor(y / k)
+
+    def query(self, x, y):
+        """
+        return: A list of the items whose boxes contain (x, y), the one with
+            smallest box first.
+        """
+        boxes = self.boxes
+        result = []
+        for i in self._cells.get(self._cell_of(x, y), ()):
+            x1, y1, x2, y2 = boxes[i]
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                result.append(self.items[i])
+        return result
+
+
+def make_measures_index(measures):
+    """
+    Index the placed measures, their note heads and, if the measures have tabs,
+    the tab fingerings.
+    """
+    index = SpatialIndex()
+    for measure in measures:
+        x, y = measure.x, measure.y
+        index.add(
+            (x, y + measure.bottomY, x + measure.width, y + measure.topY),
+            (PickKind.MEASURE, measure))
+        for note in measure.notes:
+            index.add(texture_box(note.sprite), (PickKind.NOTE, note))
+        tab = getattr(measure, 'tab', None)
+        if tab is not None and tab.sprites:
+            index.add(
+                (tab.x, tab.y, tab.x + tab.width, tab.y + tab.height),
+                (PickKind.MEASURE, measure))
+            for sp, note in tab.fingeringSprites:
+                index.add(texture_box(sp), (PickKind.FINGERING, note))
+    index.build()
+    return index
@@ -1,8 +1,13 @@
-import os
-import json
-import raygllib.ui as ui
+from .atlas import get_template_atlas
+
+# The color of text, as (r, g, b, a).
+BLACK = (0., 0., 0., 1.)
 
 class Sprite:
+    # (onset, offset) in score time if the sprite shows a sounding note, see
+    # `sheet.Sheet.set_score_times`. It is highlighted during playback.
+    playTime = None
+
     def put(self, pos):
         pass
 
@@ -38,10 +43,48 @@ class Line(Sprite):
         self.end = vec_minus(self.end, pos)
 
 
+class StaffLine(Line):
+    """
+    A staff line of a measure. Layouts merge the staff lines of the measures in
+    a system into long lines, see `layout.merge_staff_lines`.
+    """
+
+
+class Ledger(Sprite):
+    """
+    `count` ledger lines of a note. The first one is centered at `pos`, and each
+    next one is `step` above the previous. It is drawn as one primitive.
+    """
+    renderType = 'ledger'
+
+    WIDTH = 18
+    THICK = 2
+    MAX_COUNT = 8
+
+    def __init__(self, pos, count, step):
+        assert 0 < count <= self.MAX_COUNT
+        self.pos = pos
+        self.count = count
+        self.step = step
+
+    def put(self, pos):
+        self.pos = vec_add(self.pos, pos)
+
+    def unput(self, pos):
+        self.pos = vec_minus(self.pos, pos)
+
+    def iter_lines(self):
+        " Yield (start, end) of each ledger line. "
+        x, y = self.pos
+        w = self.WIDTH / 2
+        for i in range(self.count):
+            y1 = y + i * self.step
+            yield (x - w, y1), (x + w, y1)
+
+
 class Texture(Sprite):
     renderType = 'texture'
 
-    _config = None
     TEMPLATE_DPI = 500
     MARGIN = 10
     TEXTURE_TO_TENTHS = 950 / (7 * TEMPLATE_DPI)
@@ -55,12 +98,9 @@ class Texture(Sprite):
 
     @staticmethod
     def get_config(name):
-        if Texture._config is None:
-            config = json.load(open(
-                os.path.join(os.path.dirname(__file__), 'templates.json')))
-            Texture._config = config
-        _, _, w, h = Texture._config['rects'][name]
-        cx, cy = Texture._config['centers'][name]
+        atlas = get_template_atlas()
+        _, _, w, h = atlas.rects[name]
+        cx, cy = atlas.centers[name]
         m = Texture.MARGIN
         k = Texture.TEXTURE_TO_TENTHS
         w = (w - 2 * m) * k
@@ -72,7 +112,7 @@ class Texture(Sprite):
     def put(self, pos):
         self.pos = vec_add(self.pos, pos)
 
-    def upput(self, pos):
+    def unput(self, pos):
         self.pos = vec_minus(self.pos, pos)
 
 
@@ -93,12 +133,26 @@ class Beam(Sprite):
         self.end = vec_minus(self.end, pos)
 
 
-class Text(Sprite, ui.TextBox):
+class Text(Sprite):
+    """
+    A box of text, with y pointing down. The keyword arguments other than the
+    ones below, e.g. halign, are kept as attributes.
+
+    width: Default to the width of the text, else it is aligned in the box.
+    """
     renderType = 'text'
 
-    def __init__(self, **kwargs):
-        ui.TextBox.__init__(self, **kwargs)
-        Sprite.__init__(self)
+    def __init__(self, text='', fontSize=12, x=0., y=0., width=0, height=0,
+            align='left', color=BLACK, **kwargs):
+        self.text = text
+        self.fontSize = fontSize
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.align = align
+        self.color = color
+        self.__dict__.update(kwargs)
 
     def put(self, pos):
         x0, y0 = pos
@@ -123,7 +177,7 @@ class CreditWords(Text):
             text=xmlnode.text,
             align='center',
             halign=xmlnode.attrib.get('valign', 'center'),
-            color=ui.Color(0., 0., 0., 1.),
+            color=BLACK,
             x=float(xmlnode.attrib['default-x']),
             y=-float(xmlnode.attrib['default-y']),
             # autoResize=True,
@@ -146,7 +200,7 @@ class TabFingering(Text):
             fontSize=self.FONT_SIZE,
             text=str(int(number)),
             align='center',
-            color=ui.Color(0., 0., 0., 1.),
+            color=BLACK,
             x=pos[0],
             y=-pos[1],
         )
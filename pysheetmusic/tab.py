@@ -1,4 +1,6 @@
-from .sprite import Line, Texture, TabFingering
+from collections import defaultdict
+from .sprite import Line, StaffLine, Texture, TabFingering
+from .fingering import FingeringEngine, STANDARD_TUNING
 
 class TabMeasure:
     TOP_MARGIN = 20
@@ -16,6 +18,8 @@ class TabMeasure:
         self.nLines = 6
         self.measure = measure
         self.sprites = []
+        # (sprite, note) pairs of the fingering numbers.
+        self.fingeringSprites = []
 
     @property
     def height(self):
@@ -38,18 +42,35 @@ class TabMeasure:
                 y = self.get_line_y(self.nLines + 1 - f.string)
                 numText = str(f.fret)
                 if len(numText) == 1:
-                    self.add_sprite(Texture((x, y), 'tabnum-' + numText))
+                    sps = [Texture((x, y), 'tabnum-' + numText)]
                 else:
                     spLeft = Texture(None, 'tabnum-' + numText[0])
                     spLeft.pos = (x - (spLeft.size[0] - spLeft.center[0]), y)
-                    self.add_sprite(spLeft)
                     spRight = Texture(None, 'tabnum-' + numText[1])
                     spRight.pos = (x + spRight.center[0], y)
-                    self.add_sprite(spRight)
+                    sps = [spLeft, spRight]
+                playTime = note.get_play_time()
+                for sp in sps:
+                    sp.playTime = playTime
+                    self.add_sprite(sp)
+                    self.fingeringSprites.append((sp, note))
                 # if f.finger > 0:
                 #     spFinger = Texture((x + 8, y - 8), 'tabnum-' + str(f.finger))
                 #     self.add_sprite(spFinger)
 
+    def relayout_fingerings(self):
+        """
+        Make the fingering sprites of the placed tab again, e.g. after the
+        fingerings of its notes are changed.
+        """
+        old = {id(sp) for sp, _ in self.fingeringSprites}
+        self.sprites = [sp for sp in self.sprites if id(sp) not in old]
+        self.fingeringSprites = []
+        n = len(self.sprites)
+        self.layout_fingerings()
+        for sprite in self.sprites[n:]:
+            sprite.put((self.x, self.y))
+
     def layout_barlines(self):
         x = self.width
         self.add_sprite(Line(
@@ -70,7 +91,7 @@ class TabMeasure:
         add_sprite = self.add_sprite
         y = 0
         for i in range(self.nLines):
-            add_sprite(Line(start=(x1, y), end=(x2, y), width=self.LINE_THICK))
+            add_sprite(StaffLine(start=(x1, y), end=(x2, y), width=self.LINE_THICK))
             y += self.STAFF_SPACING
 
 
@@ -92,7 +113,69 @@ class Fingering:
         self.fret = fret
 
 
-def attach_fingerings(sheet):
-    for measure in sheet.iter_measures():
-        for note in measure.iter_pitched_notes():
-            note.fingering = Fingering(0, 0, 0)
+class SheetFingerings:
+    """
+    Fingerings of all the pitched notes of a sheet, chosen by a FingeringEngine.
+    The notes starting at the same time in a measure form a chord. Notes of the
+    same pitch in a chord share one fingering.
+    """
+    def __init__(self, sheet, tuning=STANDARD_TUNING):
+        self.chordNotes = []
+        chords = []
+        # id(note) -> (chordId, slot)
+        self.slots = {}
+        for measure in sheet.iter_measures():
+            groups = defaultdict(list)
+            for note in measure.iter_pitched_notes():
+                groups[note.timeStart].append(note)
+            for time in sorted(groups):
+                notes = groups[time]
+                pitches = sorted(set(note.pitchLevel for note in notes))
+                for note in notes:
+                    self.slots[id(note)] = (len(chords), pitches.index(note.pitchLevel))
+                chords.append(pitches)
+                self.chordNotes.append(notes)
+        self.engine = FingeringEngine(chords, tuning)
+        # Called with the notes whose fingerings are changed by `pin`, e.g.
+        # `SheetCanvas.update_fingerings`.
+        self.onChange = None
+
+    def attach(self, chordIds=None):
+        " Set `note.fingering` of the notes in `chordIds`, default to all. "
+        engine = self.engine
+        if chordIds is None:
+            chordIds = range(len(self.chordNotes))
+        for i in chordIds:
+            strings, frets, fingers = engine.get(i)
+            for note in self.chordNotes[i]:
+                _, slot = self.slots[id(note)]
+                note.fingering = Fingering(
+                    int(fingers[slot]), int(strings[slot]), int(frets[slot]))
+
+    def solve(self):
+        self.attach(self.engine.solve())
+
+    def pin(self, note, string):
+        """
+        Keep `note` on `string` and update the fingerings of other notes.
+        `string` None releases the note.
+        return: The notes whose fingerings changed.
+        """
+        chordId, slot = self.slots[id(note)]
+        self.engine.pin(chordId, slot, string)
+        changed = self.engine.solve()
+        self.attach(changed)
+        notes = [note for i in changed for note in self.chordNotes[i]]
+        if self.onChange and notes:
+            self.onChange(notes)
+        return notes
+
+
+def attach_fingerings(sheet, tuning=STANDARD_TUNING):
+    """
+    Choose fingerings for all the pitched notes in `sheet`.
+    return: The SheetFingerings, which can be used to pin notes later.
+    """
+    fingerings = SheetFingerings(sheet, tuning)
+    fingerings.solve()
+    return fingerings
@@ -1,5 +1,6 @@
 from collections import deque
-from time import time as get_time
+from functools import wraps
+from time import time as get_time, perf_counter
 
 def monad(node, func, default):
     return func(node) if node is not None else default
@@ -7,6 +8,17 @@ def monad(node, func, default):
 def debug(*args, **kwargs):
     print(*args, **kwargs)
 
+def timeit(func):
+    " Print how long each call of `func` takes. "
+    @wraps(func)
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            print('{}: {:.3f}s'.format(func.__name__, perf_counter() - start))
+    return timed
+
 def gcd(*nums):
     if not nums:
         return 1
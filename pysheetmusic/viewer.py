@@ -3,6 +3,8 @@ import numpy as np
 import raygllib.ui as ui
 from . import render
 from . import sprite
+from .player import PlayerState
+from .spatial import PickKind
 
 FPS = 30
 
@@ -12,15 +14,30 @@ class SheetCanvas(ui.Canvas):
         super().__init__(*args, **kwargs)
         self._renders = {
             sprite.Line.renderType: render.LineRender(),
+            sprite.Ledger.renderType: render.LedgerRender(),
             sprite.Texture.renderType: render.TextureRender(),
             sprite.Beam.renderType: render.BeamRender(),
-            sprite.Text.renderType: render.TextRender(),
+            sprite.Text.renderType: render.TextGlyphRender(),
+            render.BlobRender.renderType: render.BlobRender(),
             'indicator': render.IndicatorRender()
         }
         self.color = ui.Color(0xffffcf4)
         self._scale = 1
         self._viewPoint = (0, 0)
+        self._playTime = None
+        self._detailTier = 0
         self.layout = None
+        # Frames are only drawn when something changed, see `invalidate`.
+        # Otherwise the last frame is copied from the cache.
+        self.frameCache = render.FrameCache()
+        self._dirty = True
+        # Called with the result of `pick` when clicked without dragging.
+        self.onClick = None
+        self._dragged = False
+
+    def invalidate(self):
+        " Draw the canvas again on the next frame. "
+        self._dirty = True
 
     def set_sheet_layout(self, layout):
         self.layout = layout
@@ -29,19 +46,93 @@ class SheetCanvas(ui.Canvas):
             for render in self._renders.values():
                 render.free_buffers()
             self._viewPoint = (0, 0)
+            self.invalidate()
             return
 
         self._viewPoint = layout.defaultViewPoint
+        if layout.reflowable:
+            # Keep the scale at which the layout fills the canvas, so that later
+            # resizing reflows the layout instead of zooming it.
+            self._fit_scale()
+        self.update_sheet_layout()
+        self.on_relayout()
+
+    def _split_sprites(self, sprites):
+        " return: A dict from render type to the sprites in `sprites`. "
         sps = {type: [] for type in self._renders}
-        for sp in layout.sprites:
+        blobs = sps[render.BlobRender.renderType]
+        for sp in sprites:
             sps[sp.renderType].append(sp)
-        for renderType, sps1 in sps.items():
-            self._renders[renderType].make_buffer(sps1)
-        self.on_relayout()
+            # Note heads and tab digits.
+            if sp.playTime is not None and isinstance(sp, sprite.Texture):
+                blobs.append(sp)
+        return sps
+
+    def update_sheet_layout(self):
+        " Rebuild the render buffers from the display list of the layout. "
+        displayList = self.layout.make_display_list()
+        for r in self._renders.values():
+            r.make_buffer_display(displayList)
+        self.invalidate()
+
+    def update_measure(self, measure, oldSprites=()):
+        """
+        Update the buffers after `measure` is edited in place, that is its
+        sprites are made again and put without changing the measure's place or
+        width. Only the buffer ranges of the measure are rewritten, unless they
+        have no room left, then all buffers are made again.
+        oldSprites: The sprites of the measure before the edit.
+        """
+        layout = self.layout
+        sprites = layout.get_measure_sprites(measure)
+        layout.replace_sprites(oldSprites, sprites)
+        layout.update_index()
+        ok = True
+        for renderType, sps in self._split_sprites(sprites).items():
+            ok = self._renders[renderType].update_group(measure, sps) and ok
+        if not ok:
+            self.update_sheet_layout()
+        self.invalidate()
+
+    def update_fingerings(self, notes):
+        """
+        Show the changed fingerings of `notes` by updating their measures, see
+        `tab.SheetFingerings.pin`.
+        """
+        if self.layout is None:
+            return
+        measures = {id(note.measure): note.measure for note in notes}
+        for measure in measures.values():
+            tab = getattr(measure, 'tab', None)
+            # Tabs are only laid out by the layouts that show them.
+            if tab is None or not tab.sprites:
+                continue
+            oldSprites = self.layout.get_measure_sprites(measure)
+            tab.relayout_fingerings()
+            self.update_measure(measure, oldSprites)
+
+    def set_fingerings(self, fingerings):
+        " Show the fingerings pinned through `fingerings` as they change. "
+        fingerings.onChange = self.update_fingerings
+
+    def set_play_time(self, time):
+        """
+        Highlight the notes sounding at `time`, in score time, see
+        `Sheet.to_score_time`. None clears the highlight.
+        """
+        if time == self._playTime:
+            return
+        self._playTime = time
+        if time is None:
+            time = -1.
+        for r in self._renders.values():
+            r.time = time
+        self.invalidate()
 
     def __del__(self):
         for render in self._renders.values():
             render.free()
+        self.frameCache.free()
 
     def on_mouse_scroll(self, x, y, xs, ys):
         if not self.layout:
@@ -59,13 +150,33 @@ class SheetCanvas(ui.Canvas):
         self._update_matrix()
         return True
 
+    def on_mouse_press(self, x, y, buttons, modifiers):
+        self._dragged = False
+
+    def on_mouse_release(self, x, y, buttons, modifiers):
+        if not self._dragged and self.onClick:
+            return self.onClick(self.pick(x, y))
+
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+        self._dragged = True
         dvx, dvy, _ = self._matrixScreenToPage.dot([-dx, -dy, 0])
         vx, vy = self._viewPoint
         self._viewPoint = (vx + dvx, vy + dvy)
         self._update_matrix()
         return True
 
+    def pick(self, x, y):
+        """
+        Find the measures, notes and fingerings under the point (x, y) of the
+        canvas.
+        return: A list of (kind, object), the smallest one first. `kind` is one
+            of `spatial.PickKind`.
+        """
+        if self.layout is None or self.layout.index is None:
+            return []
+        px, py, _ = self._matrixScreenToPage.dot([x, y, 1])
+        return self.layout.index.query(px, py)
+
     def _update_matrix(self):
         layout = self.layout
         if layout is None:
@@ -79,27 +190,43 @@ class SheetCanvas(ui.Canvas):
             (vx, vy),
             self._scale,
         )
+        self._matrixSheetToGL = matrix
+        # The visible sheet area, from the corners of the GL view volume.
+        corners = np.linalg.inv(matrix).dot([[-1, 1], [-1, 1], [1, 1]])
+        viewRect = (corners[0, 0], corners[1, 0], corners[0, 1], corners[1, 1])
         for r in self._renders.values():
             r.matrix = matrix
-        self._matrixSheetToGL = matrix
+            r.viewRect = viewRect
 
         k = scaling.mm / scaling.tenths * self._scale
+        self._detailTier = self.choose_detail_tier(k)
         self._matrixScreenToPage = np.array([
             [1 / k, 0, vx - w / (2 * k)],
             [0, - 1 / k, vy + h / (2 * k)],
             [0, 0, 1],
         ], dtype=np.float32)
+        self.invalidate()
 
     def on_relayout(self):
         if self.layout is None:
             return
         layout = self.layout
-        scaling = layout.sheet.scaling
-        self._viewPoint = layout.defaultViewPoint
-        self._scale = scaling.tenths * self.width / (scaling.mm * layout.size[0])
+        if layout.reflowable:
+            scaling = layout.sheet.scaling
+            k = scaling.mm / scaling.tenths * self._scale
+            if layout.reflow(self.width / k):
+                self.update_sheet_layout()
+            self._viewPoint = (layout.size[0] / 2, self._viewPoint[1])
+        else:
+            self._viewPoint = layout.defaultViewPoint
+            self._fit_scale()
 
         self._update_matrix()
 
+    def _fit_scale(self):
+        scaling = self.layout.sheet.scaling
+        self._scale = scaling.tenths * self.width / (scaling.mm * self.layout.size[0])
+
     def track_measure(self, measure, interval=0.5):
         if not self.layout or not measure:
             return
@@ -133,19 +260,57 @@ class SheetCanvas(ui.Canvas):
     RENDER_ORDER = [
         'indicator',
         sprite.Line.renderType,
+        sprite.Ledger.renderType,
         sprite.Texture.renderType,
         sprite.Beam.renderType,
         sprite.Text.renderType,
     ]
 
+    # (minimal pixels per tenth, render types drawn), from the most detailed.
+    # A staff space is 10 tenths.
+    DETAIL_TIERS = [
+        (.35, RENDER_ORDER),
+        (.15, [
+            'indicator',
+            sprite.Line.renderType,
+            sprite.Texture.renderType,
+            sprite.Beam.renderType,
+        ]),
+        (0, ['indicator', sprite.Line.renderType, render.BlobRender.renderType]),
+    ]
+    # A tier is only left when the zoom goes this ratio beyond its range, so
+    # zooming around a boundary does not switch tiers back and forth.
+    DETAIL_HYSTERESIS = 1.15
+
+    def choose_detail_tier(self, k):
+        """
+        k: Pixels per tenth.
+        return: The index into DETAIL_TIERS to draw with.
+        """
+        tiers = self.DETAIL_TIERS
+        h = self.DETAIL_HYSTERESIS
+        tier = self._detailTier
+        while tier + 1 < len(tiers) and k < tiers[tier][0] / h:
+            tier += 1
+        while tier > 0 and k > tiers[tier - 1][0] * h:
+            tier -= 1
+        return tier
+
     def draw(self):
-        self.fill_background()
-        if self.layout is None:
+        cache = self.frameCache
+        if not self._dirty and cache.valid():
+            # Nothing changed since the last frame.
+            cache.blit()
             return
-        for renderType in self.RENDER_ORDER:
-            r = self._renders[renderType]
-            with r.batch_draw():
-                r.render()
+        self._dirty = False
+        cache.begin()
+        self.fill_background()
+        if self.layout is not None:
+            for renderType in self.DETAIL_TIERS[self._detailTier][1]:
+                r = self._renders[renderType]
+                with r.batch_draw():
+                    r.render()
+        cache.end()
 
 
 class SheetViewer(ui.Widget):
@@ -154,12 +319,22 @@ class SheetViewer(ui.Widget):
         super().__init__()
         self.canvas = SheetCanvas()
         self.children.append(self.canvas)
+        self.canvas.onClick = self.on_canvas_click
         self.player = None
         self.layout = None
 
     def set_player(self, player):
         self.player = player
 
+    def on_canvas_click(self, hits):
+        " Seek the player to the measure clicked. "
+        if self.player is None or self.player.sheet is None:
+            return
+        for kind, obj in hits:
+            if kind is PickKind.MEASURE:
+                self.player.seek_measure(obj)
+                return True
+
     def set_sheet_layout(self, layout):
         self.layout = layout
         self.canvas.layout = layout
@@ -168,8 +343,15 @@ class SheetViewer(ui.Widget):
     def update(self, dt):
         if self.layout is None or self.player is None:
             return
+        player = self.player
+        if player.state is PlayerState.STOPPED:
+            self.canvas.set_play_time(None)
+        else:
+            self.canvas.set_play_time(
+                player.sheet.to_score_time(player.get_current_time()))
         indicatorRender = self.canvas._renders['indicator']
         if self.player.currentMeasure is not indicatorRender.measure:
             measure = self.player.currentMeasure
             indicatorRender.set_measure(measure)
+            self.canvas.invalidate()
             self.canvas.track_measure(measure)
@@ -7,6 +7,7 @@ setup(
     author_email='ray040123@gmail.com',
     packages=['pysheetmusic'],
     package_data={
-        'pysheetmusic': ['shaders/*.glsl', 'schema/*.xsd', 'templates.png', 'templates.json'],
+        'pysheetmusic': ['shaders/*.glsl', 'schema/*.xsd', 'templates.png', 'templates.mip*.png',
+            'templates.json'],
     },
 )
@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import pyglet
 import raygllib.ui as ui
 import raygllib.ui.key as K
@@ -8,6 +9,7 @@ from pysheetmusic.player import Player
 from pysheetmusic.layout import PagesLayout, LinearLayout, LinearTabLayout
 from pysheetmusic.tab import attach_tab, attach_fingerings
 from os.path import join, dirname
+from tempfile import gettempdir
 
 def get_path(*subPaths):
     return join(dirname(__file__), *subPaths)
@@ -101,12 +103,6 @@ class TestViewer(unittest.TestCase):
             sheet = parser.parse(get_path('sheets', name))
             attach_tab(sheet)
             attach_fingerings(sheet)
-            import random
-            for measure in sheet.iter_measures():
-                for note in measure.iter_pitched_notes():
-                    note.fingering.finger = random.randint(0, 4)
-                    note.fingering.string = random.randint(1, 6)
-                    note.fingering.fret = random.randint(0, 15)
             # layout = PagesLayout(sheet)
             layout = LinearLayout(sheet)
             # layout = LinearTabLayout(sheet)
@@ -127,11 +123,39 @@ class TestViewer(unittest.TestCase):
 
     def test_renders(self):
         window = ui.Window()
-        for cls in (M.render.LineRender, M.render.BeamRender, M.render.TextureRender):
+        for cls in (M.render.LineRender, M.render.LedgerRender, M.render.BeamRender,
+                M.render.TextureRender, M.render.TextGlyphRender):
             render = cls()
             render.glId
             render.free()
 
+class StubGL:
+    """
+    Record the GL calls instead of making them, for tests of the GL code
+    without a context. Constants are their names, and the GL types are taken
+    from `base`.
+    """
+    def __init__(self, integers=None, base=None):
+        self.integers = integers or {}
+        self.base = base
+        self.calls = []
+        self._nextId = 1
+
+    def __getattr__(self, name):
+        if name.startswith('GL_'):
+            return name
+        if name.startswith('GL'):
+            return getattr(self.base, name)
+        def call(*args):
+            self.calls.append((name,) + args)
+            if name.startswith('glGen'):
+                self._nextId += 1
+                return self._nextId
+            if name == 'glGetIntegerv':
+                return self.integers[args[0]]
+        return call
+
+
 class TestParser(unittest.TestCase):
     def test_parser(self):
         parser = M.parse.MusicXMLParser()
@@ -141,6 +165,478 @@ class TestParser(unittest.TestCase):
             layout = LinearTabLayout(sheet)
             layout.layout()
 
+    def test_reflow(self):
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        breaks = [(m.isNewSystem, m.isNewPage) for m in sheet.iter_measures()]
+        layout = LinearLayout(sheet, width=1500)
+        layout.layout()
+        assert breaks == [(m.isNewSystem, m.isNewPage) for m in sheet.iter_measures()]
+        for width in (1500, 800, 2500):
+            layout.reflow(width)
+            systems = []
+            for measure in sheet.iter_measures():
+                if measure in layout.systemStarts:
+                    systems.append([])
+                systems[-1].append(measure)
+            for system in systems:
+                last = system[-1]
+                if len(system) > 1:
+                    assert last.x + last.width <= width - layout.right + 1e-6
+                for m1, m2 in zip(system, system[1:]):
+                    assert m1.y == m2.y and m1.x < m2.x
+            sprites = set(map(id, layout.sprites))
+            for measure in layout.measures:
+                for sp in measure.sprites:
+                    assert isinstance(sp, M.sprite.StaffLine) or id(sp) in sprites
+
+    def test_sprite_groups(self):
+        parser = M.parse.MusicXMLParser()
+        for cls in (PagesLayout, LinearLayout, LinearTabLayout):
+            sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+            attach_tab(sheet)
+            attach_fingerings(sheet)
+            layout = cls(sheet)
+            layout.layout()
+            groups, loose = layout.get_sprite_groups()
+            grouped = [id(sp) for _, sps in groups for sp in sps]
+            assert sorted(grouped + list(map(id, loose))) \
+                == sorted(map(id, layout.sprites))
+        tiles = M.render.Tiles([(0, 1000, 1, 1001), (0, 0, 1, 1)], [3, 2])
+        assert list(tiles.firsts) == [2, 0]
+        assert list(tiles.get_slot_order()) == [3, 4, 0, 1, 2]
+        tiles = M.render.Tiles([(100000, 0, 100001, 1), (0, 0, 1, 1)])
+        assert tiles.origins.tolist() == [[0, 0], [100000, 0]]
+
+    def test_play_times(self):
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        layout = LinearLayout(sheet)
+        layout.layout()
+        assert len(sheet.measureSeq) > len(list(sheet.iter_measures()))
+        for timeStart, timeEnd, note in sheet.iter_note_sequence():
+            onset, offset = note.sprite.playTime
+            time = sheet.to_score_time((timeStart + timeEnd) / 2)
+            assert onset <= time < offset
+
+    def test_vertex_format(self):
+        K = M.render.VertexKind
+        fmt = M.render.VertexFormat(
+            [('xy', 2, K.POSITION), ('uv', 2, K.UNORM), ('width', 1, K.HALF)])
+        rows = np.array([[1000.3, -20010.6, .25, 1., 1.5], [-3., -19000., 0, .5, 2.]])
+        origins = np.array([[0., -20000.], [0., -19500.]])
+        unit = fmt.fit_unit(rows, origins, 1 / 8)
+        data = fmt.encode(rows, origins, unit)
+        assert data.itemsize == 12
+        assert np.allclose(data['xy'] * unit + origins, rows[:, 0:2], atol=unit / 2)
+        assert np.allclose(data['uv'] / 65535, rows[:, 2:4], atol=1e-4)
+        assert (data['width'][:, 0] == rows[:, 4]).all()
+        assert fmt.encode(rows, origins, unit / 64) is None
+        units = np.array([[1 / 8], [1 / 2]])
+        data = fmt.encode(rows, origins, units[:, 0])
+        assert np.allclose(data['xy'] * units + origins, rows[:, 0:2], atol=1 / 4)
+
+    def test_text_atlas(self):
+        atlas = M.atlas.TextAtlas('Measure 12.')
+        shared = M.atlas.get_text_atlas('\u00e9')
+        assert M.atlas.get_text_atlas('e\u00e9') is shared
+        assert shared.has_chars('Measure 12.\u00e9')
+        assert atlas.has_chars('12 sure') and not atlas.has_chars('3')
+        x, y, w, h = atlas.rects.T
+        assert (x + w <= atlas.image.size[0]).all() and (y + h <= atlas.image.size[1]).all()
+        alpha = np.asarray(atlas.image)[:, :, 3]
+        i = atlas.charIds['M']
+        assert alpha[y[i]:y[i] + h[i], x[i]:x[i] + w[i]].any()
+
+    def test_template_atlas(self):
+        import os, shutil, tempfile
+        from unittest import mock
+        atlas = M.atlas.get_template_atlas()
+        assert M.atlas.get_template_atlas() is atlas
+        with tempfile.TemporaryDirectory() as dir, \
+                mock.patch.dict(os.environ, {'XDG_CACHE_HOME': join(dir, 'cache')}):
+            path = join(dir, 'templates.png')
+            shutil.copy(atlas.path, path)
+            pixels = M.atlas.load_pixels(path)
+            cachePath = M.atlas.get_cache_path(path)
+            assert os.path.dirname(cachePath) == join(dir, 'cache', 'pysheetmusic')
+            assert os.listdir(os.path.dirname(cachePath)) == [os.path.basename(cachePath)]
+            assert not os.path.exists(join(dir, 'templates.npy'))
+            cached = M.atlas.load_pixels(path)
+            assert isinstance(cached, np.memmap) and (cached == pixels).all()
+        w, h = atlas.size
+        assert pixels.shape == (h, w, 4)
+        for level in range(1, atlas.mipLevels):
+            assert atlas.get_mip_pixels(level).shape == (h >> level, w >> level, 4)
+
+    def test_display_list(self):
+        import tempfile
+        from pysheetmusic.spatial import PickKind
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        attach_tab(sheet)
+        attach_fingerings(sheet)
+        layout = LinearTabLayout(sheet)
+        layout.layout()
+        dl = layout.make_display_list()
+        groups, loose = layout.get_sprite_groups()
+        assert dl.groupKeys == [measure for measure, _ in groups]
+        textures = [sp for _, sps in groups for sp in sps
+            if isinstance(sp, M.sprite.Texture)]
+        assert (dl.glyphs['group'] >= 0).sum() == len(textures)
+        with tempfile.TemporaryDirectory() as dir:
+            path = join(dir, 'sheet.dl')
+            dl.save(path)
+            loaded = M.display.DisplayList.load(path)
+            for name in dl.SECTIONS:
+                assert (getattr(loaded, name) == getattr(dl, name)).all()
+            assert loaded.glyphNames == dl.glyphNames
+            assert loaded.get_text_runs() == dl.get_text_runs()
+            assert loaded.groupKeys == [m.number for m in dl.groupKeys]
+            del loaded
+        index = dl.make_index()
+        measure, sps = groups[3]
+        note = measure.notes[0]
+        assert (PickKind.MEASURE, measure) in index.query(*note.sprite.pos)
+
+    def test_export(self):
+        import tempfile
+        import xml.etree.ElementTree as ET
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        layout = PagesLayout(sheet)
+        layout.layout()
+        textures = [sp for page in sheet.pages for sp in page.sprites
+            if isinstance(sp, M.sprite.Texture)]
+        with tempfile.TemporaryDirectory() as dir:
+            paths = M.export.export_svg(layout, join(dir, 'page-{page}.svg'), 2)
+            assert len(paths) == len(sheet.pages)
+            ns = '{http://www.w3.org/2000/svg}'
+            roots = [ET.parse(path).getroot() for path in paths]
+            uses = sum(len(root.findall(ns + 'g/' + ns + 'use')) for root in roots)
+            assert uses == len(textures)
+            for root in roots:
+                ids = [e.get('id') for e in root.find(ns + 'defs')]
+                assert len(ids) == len(set(ids))
+            path = M.export.export_pdf(layout, join(dir, 'sheet.pdf'), 2)
+            with open(path, 'rb') as file:
+                data = file.read()
+            assert data.startswith(b'%PDF')
+            assert '/Count {}'.format(len(sheet.pages)).encode() in data
+            assert data.count(b'/Subtype /Image') \
+                == 2 * len({sp.name for sp in textures})
+
+    def test_raster(self):
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        layout = PagesLayout(sheet, nPages=1)
+        layout.layout()
+        items = M.export.get_pages(layout)[0]
+        mm = M.export.get_millimeters(layout)
+        dpi = 100
+        image = M.raster.rasterize(items, dpi, mm)
+        k = dpi * mm / 25.4
+        w, h = sheet.pages[0].size
+        assert image.size == (round(w * k), round(h * k))
+        pixels = np.asarray(image)
+        for note in sheet.pages[0].measures[0].notes:
+            x1, y1, x2, y2 = M.spatial.texture_box(note.sprite)
+            assert pixels[int((h - y2) * k):int((h - y1) * k),
+                int(x1 * k):int(x2 * k)].min() < 128
+        assert pixels.mean() > 200
+        import os, shutil, tempfile
+        with tempfile.TemporaryDirectory() as dir:
+            shutil.copy(get_path('sheets', 'Minuet_in_G.mxl'), dir)
+            with open(join(dir, 'broken.xml'), 'w') as file:
+                file.write('<score-partwise')
+            results = M.raster.make_thumbnails(dir, join(dir, 'out'), processes=1)
+            (sheet, output, ok), (broken, none, error) = results
+            assert none is None and error.startswith('FormatError')
+            assert ok is None and os.path.exists(output)
+
+    def test_lazy_imports(self):
+        import subprocess, sys
+        # Export and raster work without raygllib, e.g. on a server.
+        code = (
+            'import sys; sys.modules["raygllib"] = None; '
+            'import pysheetmusic.export, pysheetmusic.raster, pysheetmusic.parse; '
+            'print(sorted(m for m in ("viewer", "render", "player") '
+            'if "pysheetmusic." + m in sys.modules))')
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert out.strip() == b'[]'
+        assert M.viewer is sys.modules['pysheetmusic.viewer']
+
+    def test_timeline(self):
+        from pysheetmusic.player import make_timeline, sleep_until, get_system_time
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        timeline = make_timeline(sheet)
+        expected = []
+        for timeStart, timeEnd, note in sheet.iter_note_sequence():
+            expected.append((float(timeStart), 1, note.pitchLevel))
+            expected.append((float(timeEnd), 0, note.pitchLevel))
+        events = timeline.events
+        assert timeline.count == len(events) == len(expected)
+        assert sorted(expected) == sorted(zip(*(events[k].tolist()
+            for k in ('time', 'type', 'pitch'))))
+        keys = list(zip(events['time'].tolist(), events['type'].tolist()))
+        assert keys == sorted(keys)
+        for i in range(0, len(events), 50):
+            assert timeline.wait(i)
+        assert not timeline.wait(len(events))
+        notes = list(sheet.iter_note_sequence())
+        for time in np.linspace(0, float(sheet.totalTime), 37):
+            p = timeline.find(time)
+            assert (events['time'][:p] < time).all()
+            assert (events['time'][p:] >= time).all()
+            sounding = sorted(n.pitchLevel for start, end, n in notes if start < time < end)
+            assert sorted(events['pitch'][timeline.get_sounding(time)]) == sounding
+        measure = sheet.measureSeq[-1]
+        i = timeline.find_measure(measure)[-1]
+        assert timeline.get_measure_index(timeline.measureTimes[i]) == i
+        stats = M.player.TimingStats()
+        start = get_system_time()
+        for i in range(20):
+            deadline = start + i * .001
+            sleep_until(deadline)
+            stats.add(get_system_time() - deadline)
+        assert stats.count == 20
+        assert 0 <= stats.mean <= stats.max
+        assert stats.p99Jitter >= 0
+
+    def test_player_output(self):
+        import time
+        from pysheetmusic.output import RecordingOutput, MidiFileOutput
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        nNotes = sum(1 for _ in sheet.iter_note_sequence())
+        for output in (RecordingOutput(), RecordingOutput(latency=20)):
+            player = Player(output)
+            player.set_sheet(sheet)
+            player.set_speed_scale(float(sheet.totalTime) / .2)
+            player.play()
+            while player.state is not M.player.PlayerState.STOPPED:
+                time.sleep(.01)
+            player.thread.join()
+            assert not output.isOpen
+            statuses = [data[0] & 0xf0 for _, data in output.messages]
+            assert statuses[0] == 0xc0
+            assert statuses.count(0x90) == nNotes
+            assert output.writes < len(output.messages)
+            notes = output.get_notes()
+            assert all(start <= end for start, end, _, _ in notes)
+            assert player.stats.count >= nNotes
+        output = MidiFileOutput(join(gettempdir(), 'pysheetmusic.mid'))
+        output.open()
+        output.write([([0x90, 60, 100], 1.), ([0x80, 60, 100], 1.5)], 0.)
+        output.close()
+        with open(output.path, 'rb') as file:
+            data = file.read()
+        assert data.startswith(b'MThd')
+        assert data.endswith(b'\x00\x90\x3c\x64\x83\x60\x80\x3c\x64\x00\xff\x2f\x00')
+
+    def test_virtual_clock(self):
+        from pysheetmusic.output import RecordingOutput
+        from pysheetmusic.clock import VirtualClock
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+
+        def play():
+            clock = VirtualClock()
+            output = RecordingOutput()
+            player = Player(output, clock)
+            player.set_sheet(sheet)
+            clock.advance(10)
+            player.play()
+            clock.advance(1)
+            assert player.get_current_time() == 1
+            assert player.currentMeasure is sheet.measureSeq[0]
+            player.pause()
+            clock.advance(5)
+            assert player.get_current_time() == 1
+            assert player.currentNotes == set()
+            player.seek_measure(sheet.measureSeq[5])
+            player.set_speed_scale(2)
+            player.play()
+            clock.advance(1)
+            assert player.currentMeasure is sheet.measureSeq[6]
+            clock.run()
+            assert player.state is M.player.PlayerState.STOPPED
+            assert player.stats.max == 0
+            messages = list(output.messages)
+            # Play again after a while, from the start.
+            player.set_speed_scale(1)
+            player.play()
+            player.stop()
+            clock.advance(10)
+            output.messages = []
+            start = clock.time()
+            player.play()
+            clock.advance(.5)
+            assert player.get_current_time() == .5
+            assert [t - start for t, data in output.messages if data[0] & 0xf0 == 0x90] \
+                == [0, 0, .5]
+            player.stop()
+            return messages
+
+        messages = play()
+        assert messages == play()
+        timeline = M.player.make_timeline(sheet)
+        nNotes = (timeline.events['type'] == M.player.EventType.NOTE_ON).sum()
+        start = timeline.measureTimes[5]
+        nSkipped = ((timeline.events['time'] > 1) & (timeline.events['time'] < start)
+            & (timeline.events['type'] == M.player.EventType.NOTE_ON)).sum()
+        ons = [time for time, data in messages if data[0] & 0xf0 == 0x90]
+        assert len(ons) == nNotes - nSkipped
+        assert ons == sorted(ons)
+
+    def test_timeline_seek_while_building(self):
+        from threading import Thread
+        from pysheetmusic.output import RecordingOutput
+        from pysheetmusic.clock import VirtualClock
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        clock = VirtualClock()
+        player = Player(RecordingOutput(), clock)
+        player.set_sheet(sheet)
+        # Not built yet, so the player waits for it.
+        player.timeline = timeline = M.player.Timeline(sheet)
+        player.play()
+        blocked = []
+        for call, arg in ((player.set_speed_scale, 2), (player.seek, 3)):
+            thread = Thread(target=call, args=(arg,))
+            thread.start()
+            thread.join(5)
+            blocked.append(thread.is_alive())
+        timeline.build()
+        assert blocked == [False, False]
+        clock.advance(1)
+        assert player.get_current_time() == 5
+        player.stop()
+
+    def test_display_frame_cache_msaa(self):
+        from unittest import mock
+        gl = StubGL({'GL_SAMPLES': 4, 'GL_VIEWPORT': (10, 20, 300, 200),
+            'GL_DRAW_FRAMEBUFFER_BINDING': 0})
+        with mock.patch.object(M.render, 'gl', gl):
+            cache = M.render.FrameCache()
+            cache.begin()
+            # Drawn into the multisampled framebuffer.
+            assert gl.calls[-1] == ('glBindFramebuffer', 'GL_DRAW_FRAMEBUFFER', cache.msaaFbo)
+            assert ('glRenderbufferStorageMultisample',
+                'GL_RENDERBUFFER', 4, 'GL_RGBA8', 310, 220) in gl.calls
+            del gl.calls[:]
+            cache.end()
+            blits = [c for c in gl.calls if c[0] == 'glBlitFramebuffer']
+            # Resolved into the cache, then copied to the window.
+            assert len(blits) == 2
+            assert gl.calls.index(('glBindFramebuffer', 'GL_DRAW_FRAMEBUFFER', cache.fbo)) \
+                < gl.calls.index(blits[0])
+            assert cache.valid()
+            del gl.calls[:]
+            cache.blit()
+            assert [c[0] for c in gl.calls].count('glBlitFramebuffer') == 1
+
+    def test_display_update_measure(self):
+        from unittest import mock
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        attach_tab(sheet)
+        fingerings = attach_fingerings(sheet)
+        layout = LinearTabLayout(sheet)
+        layout.layout()
+        from types import SimpleNamespace
+        gl = StubGL(base=M.render.gl)
+        textures = SimpleNamespace(get=lambda key, make: SimpleNamespace(glId=0))
+        with mock.patch.object(M.render, 'gl', gl), \
+                mock.patch.object(M.render, 'TEXTURES', textures):
+            canvas = M.viewer.SheetCanvas()
+            canvas.layout = layout
+            canvas.update_sheet_layout()
+            canvas.set_fingerings(fingerings)
+            r = canvas._renders[M.sprite.Texture.renderType]
+            tiles = r.tiles
+
+            def writes():
+                " return: The (buffer, offset, nbytes) of the sub data writes. "
+                bound = None
+                result = []
+                for call in gl.calls:
+                    if call[:2] == ('glBindBuffer', 'GL_ARRAY_BUFFER'):
+                        bound = call[2]
+                    elif call[0] == 'glBufferSubData':
+                        result.append((bound, call[2], call[3]))
+                    assert call[0] != 'glBufferData'
+                return result
+
+            # Moved to another string, inside the slack of its measure.
+            note = next(n for n in fingerings.chordNotes[3] if n.fingering.string < 6)
+            measure = note.measure
+            i = r.groupIds[measure]
+            del gl.calls[:]
+            fingerings.pin(note, note.fingering.string + 1)
+            assert r.tiles is tiles
+            itemBytes = r.VERTICES_PER_ITEM * r.vertexFormat.dtype.itemsize
+            assert (r.buffer.glId, int(tiles.firsts[i]) * itemBytes,
+                int(tiles.sizes[i]) * itemBytes) in writes()
+            sp = next(sp for sp, n in measure.tab.fingeringSprites if n is note)
+            assert (M.spatial.PickKind.FINGERING, note) in layout.index.query(*sp.pos)
+
+            # More sprites than the slack, so the buffers are made again.
+            oldSprites = layout.get_measure_sprites(measure)
+            extra = [M.sprite.Texture(sp.pos, sp.name) for _ in range(int(tiles.sizes[i]))]
+            measure.tab.sprites.extend(extra)
+            del gl.calls[:]
+            canvas.update_measure(measure, oldSprites)
+            assert r.tiles is not tiles
+            assert any(c[:2] == ('glBufferData', 'GL_ARRAY_BUFFER') for c in gl.calls)
+            n = len([sp for sp in layout.get_measure_sprites(measure)
+                if isinstance(sp, M.sprite.Texture)])
+            assert r.tiles.sizes[r.groupIds[measure]] >= n > tiles.sizes[i]
+            del canvas
+
+    def test_pick(self):
+        from pysheetmusic.spatial import PickKind
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        attach_tab(sheet)
+        attach_fingerings(sheet)
+        layout = LinearTabLayout(sheet)
+        layout.layout()
+        for measure in sheet.iter_measures():
+            for note in measure.notes:
+                hits = layout.index.query(*note.sprite.pos)
+                assert (PickKind.NOTE, note) in hits
+                assert (PickKind.MEASURE, measure) in hits
+        assert layout.index.query(1e6, 1e6) == []
+
+    def test_fingerings(self):
+        from pysheetmusic.fingering import STANDARD_TUNING
+        parser = M.parse.MusicXMLParser()
+        sheet = parser.parse(get_path('sheets', 'Minuet_in_G.mxl'))
+        fingerings = attach_fingerings(sheet)
+        for notes in fingerings.chordNotes:
+            pitches = {}
+            for note in notes:
+                f = note.fingering
+                assert 1 <= f.string <= 6
+                assert STANDARD_TUNING[f.string - 1] + f.fret == note.pitchLevel
+                assert (f.finger == 0) == (f.fret == 0)
+                assert pitches.setdefault(f.string, note.pitchLevel) == note.pitchLevel
+        note = next(n for n in fingerings.chordNotes[0] if n.fingering.string < 6)
+        string = note.fingering.string + 1
+        fingerings.pin(note, string)
+        assert note.fingering.string == string
+        with self.assertRaises(ValueError):
+            fingerings.pin(note, 0)
+        # Frets 1, 4 and 5 would put the fourth finger on two frets.
+        states = fingerings.engine.make_states((41, 49, 55))
+        for frets, fingers in zip(states.frets, states.fingers):
+            used = {}
+            for fret, finger in zip(frets, fingers):
+                if finger:
+                    assert used.setdefault(finger, fret) == fret
+
     def test_key_signagure(self):
         for mode in ('major', 'minor'):
             assert M.sheet.KeySignature(0, mode).names == ''
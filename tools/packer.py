@@ -109,18 +109,20 @@ class ImagePack:
             )
         else:
             self.size, self.positions, self.rate = self._calculate(1)
+        self._cut_images(images)
 
+    def _cut_images(self, images):
+        " Make self.image and make self.images its subsurfaces. "
         self.image = self._make_image()
         self.images = [
             self.image.subsurface((p, img.get_size())) 
             for p, img in zip(self.positions, images)
         ]
-        print(
-            'Packed {} images. Final size {}. Memory: {:.2f}MB. Rate: {:.3f}'.
-            format(
-                len(self.images), self.size,
-                self.size[0] * self.size[1] * 4 / 2 ** 20, self.rate
-            )
+
+    def summary(self):
+        return 'Packed {} images. Final size {}. Memory: {:.2f}MB. Rate: {:.3f}'.format(
+            len(self.images), self.size,
+            self.size[0] * self.size[1] * 4 / 2 ** 20, self.rate
         )
 
     def _make_image(self):
@@ -131,7 +133,201 @@ class ImagePack:
         return surface
 
 
-def pack_dir(dirPath, output, margin=10):
+class MaxRects:
+    """
+    Pack rectangles into a bin of a fixed size with the MaxRects algorithm:
+    the free space is kept as the list of all maximal free rectangles, which
+    may overlap, and each rectangle goes into the free one that scores best.
+
+    Heuristics, the lower score wins:
+        'short-side': The shorter leftover side of the free rectangle.
+        'long-side': The longer leftover side.
+        'area': The leftover area.
+        'bottom-left': The lowest top edge, then the leftmost.
+    """
+    HEURISTICS = ('short-side', 'long-side', 'area', 'bottom-left')
+
+    def __init__(self, width, height, heuristic='short-side'):
+        if heuristic not in self.HEURISTICS:
+            raise ValueError('Unknown heuristic {}'.format(heuristic))
+        self.size = (width, height)
+        self.heuristic = heuristic
+        self.freeRects = [(0, 0, width, height)]
+
+    def score(self, free, w, h):
+        fx, fy, fw, fh = free
+        dw = fw - w
+        dh = fh - h
+        heuristic = self.heuristic
+        if heuristic == 'short-side':
+            return (min(dw, dh), max(dw, dh))
+        elif heuristic == 'long-side':
+            return (max(dw, dh), min(dw, dh))
+        elif heuristic == 'area':
+            return (fw * fh - w * h, min(dw, dh))
+        else:
+            return (fy + h, fx)
+
+    def insert(self, w, h):
+        " return: The position of a w x h rectangle, None if it does not fit. "
+        best = bestScore = None
+        for free in self.freeRects:
+            if free[2] >= w and free[3] >= h:
+                score = self.score(free, w, h)
+                if bestScore is None or score < bestScore:
+                    best, bestScore = free, score
+        if best is None:
+            return None
+        x, y = best[0], best[1]
+        self._split((x, y, w, h))
+        return x, y
+
+    def _split(self, used):
+        ux, uy, uw, uh = used
+        ux2 = ux + uw
+        uy2 = uy + uh
+        rects = []
+        for free in self.freeRects:
+            fx, fy, fw, fh = free
+            fx2 = fx + fw
+            fy2 = fy + fh
+            if ux >= fx2 or ux2 <= fx or uy >= fy2 or uy2 <= fy:
+                rects.append(free)
+                continue
+            # The parts of `free` left, right, above and below `used`.
+            if ux > fx:
+                rects.append((fx, fy, ux - fx, fh))
+            if ux2 < fx2:
+                rects.append((ux2, fy, fx2 - ux2, fh))
+            if uy > fy:
+                rects.append((fx, fy, fw, uy - fy))
+            if uy2 < fy2:
+                rects.append((fx, uy2, fw, fy2 - uy2))
+        self.freeRects = self._prune(rects)
+
+    @staticmethod
+    def _prune(rects):
+        " Remove the rectangles contained in another one. "
+        rects = sorted(set(rects), key=lambda r: -r[2] * r[3])
+        kept = []
+        for r in rects:
+            x, y, w, h = r
+            if not any(
+                    k[0] <= x and k[1] <= y and
+                    x + w <= k[0] + k[2] and y + h <= k[1] + k[3]
+                    for k in kept):
+                kept.append(r)
+        return kept
+
+
+class MaxRectsPack(ImagePack):
+    """
+    Pack the images into the smallest power of two image that MaxRects can
+    fill, see `MaxRects` for the heuristics.
+
+    align: Images are put at multiples of `align` and take a multiple of
+        `align` of space, so that each image covers whole texels of the mip
+        levels up to log2(align).
+    """
+    MAX_SIZE = 2 ** 12
+
+    def __init__(self, images, heuristic='short-side', align=1):
+        self.heuristic = heuristic
+        self.align = align
+        super().__init__(images)
+
+    def _calculate(self, transpose):
+        if transpose:
+            swap = lambda a: (a[1], a[0])
+        else:
+            swap = lambda a: a
+        align = self.align
+        sizes = [swap(img.get_size()) for img in self.images]
+        sizes = [(-(-w // align) * align, -(-h // align) * align) for w, h in sizes]
+        area = sum(w * h for w, h in sizes)
+        # Long sides first.
+        order = sorted(range(len(sizes)),
+            key=lambda i: (-max(sizes[i]), -sizes[i][0] * sizes[i][1]))
+        maxW = max(w for w, h in sizes)
+        maxH = max(h for w, h in sizes)
+        exps = range(self.MAX_SIZE.bit_length())
+        candidates = sorted(
+            ((2 ** i, 2 ** j) for i in exps for j in exps
+                if 2 ** i >= maxW and 2 ** j >= maxH and 2 ** (i + j) >= area),
+            key=lambda s: (s[0] * s[1], abs(s[0] - s[1])))
+        for gw, gh in candidates:
+            bin = MaxRects(gw, gh, self.heuristic)
+            pos = [None] * len(sizes)
+            for i in order:
+                pos[i] = bin.insert(*sizes[i])
+                if pos[i] is None:
+                    break
+            else:
+                rate = area / (gw * gh)
+                return swap((gw, gh)), list(map(swap, pos)), rate
+        raise ValueError('The images do not fit in {0}x{0}'.format(self.MAX_SIZE))
+
+    def pack(self):
+        """
+        Calculate self.size, self.positions, self.rate. The candidate sizes
+        have both orientations, so the images are not transposed.
+        """
+        if self._packed:
+            return
+        self._packed = True
+        images = self.images
+        self.size, self.positions, self.rate = self._calculate(0)
+        self._cut_images(images)
+
+    def _make_image(self):
+        surface = pg.Surface(self.size, pg.SRCALPHA, 32)
+        surface.fill((0, 0, 0, 0))
+        for image, pos in zip(self.images, self.positions):
+            surface.blit(image, pos)
+        return surface
+
+
+def make_mip_levels(image, nLevels):
+    """
+    return: `nLevels` surfaces, `image` and each next one half the size of the
+        last, filtered with a 2x2 box on premultiplied alpha, so that the
+        transparent pixels do not darken or lighten the edges.
+    """
+    import numpy as np
+    import pygame.surfarray as surfarray
+    levels = [image]
+    rgb = surfarray.array3d(image).astype(float)
+    alpha = surfarray.array_alpha(image).astype(float)
+    for _ in range(1, nLevels):
+        w, h = alpha.shape
+        if w % 2 or h % 2:
+            raise ValueError('Size {}x{} can not be halved'.format(w, h))
+        box = lambda a: a.reshape(w // 2, 2, h // 2, 2, *a.shape[2:]).mean(axis=(1, 3))
+        premul = box(rgb * alpha[:, :, None])
+        alpha = box(alpha)
+        rgb = premul / np.maximum(alpha, 1e-9)[:, :, None]
+        level = pg.Surface((w // 2, h // 2), pg.SRCALPHA, 32)
+        surfarray.pixels3d(level)[:] = np.clip(rgb.round(), 0, 255)
+        surfarray.pixels_alpha(level)[:] = alpha.round()
+        levels.append(level)
+    return levels
+
+
+def get_mip_path(output, level):
+    return '{}.mip{}.png'.format(output, level)
+
+
+def pack_dir(dirPath, output, margin=10, heuristic='short-side', mipLevels=4):
+    """
+    Pack the png images in `dirPath` into `output`.png and write the rects
+    and centers to `output`.json.
+
+    heuristic: A heuristic of `MaxRects`, or 'shelf' for `ImagePack`.
+    mipLevels: The number of levels, the full size one included, saved as
+        `output`.mip{level}.png. The margin must cover one texel of the
+        smallest level, so that sampling a glyph does not bleed into its
+        neighbours.
+    """
     import os
     import json
     pg.display.init()
@@ -143,9 +339,22 @@ def pack_dir(dirPath, output, margin=10):
             path = os.path.join(dirPath, name)
             images.append(padded_image(pygame.image.load(path).convert_alpha(), margin))
             names.append(name[:-4])
-    imagePack = ImagePack(images)
+    align = 2 ** (mipLevels - 1)
+    if align > margin:
+        raise ValueError('Margin {} is too small for {} mip levels'.format(
+            margin, mipLevels))
+    if heuristic == 'shelf':
+        if mipLevels > 1:
+            raise ValueError('Mip levels need a MaxRects heuristic')
+        imagePack = ImagePack(images)
+    else:
+        imagePack = MaxRectsPack(images, heuristic, align)
+    print(imagePack.summary())
     resultImage = imagePack.image
     pygame.image.save(resultImage, output + '.png')
+    for level, image in enumerate(make_mip_levels(resultImage, mipLevels)):
+        if level > 0:
+            pygame.image.save(image, get_mip_path(output, level))
     rects = {}
     centers = {}
     try:
@@ -154,7 +363,7 @@ def pack_dir(dirPath, output, margin=10):
         pass
     except IsADirectoryError:
         pass
-    config = {'rects': rects, 'centers': centers}
+    config = {'rects': rects, 'centers': centers, 'mipLevels': mipLevels}
     for name, image, pos in zip(names, images, imagePack.positions):
         x, y = pos
         w, h = image.get_size()
@@ -181,8 +390,11 @@ def padded_image(image, margin):
 if __name__ == '__main__':
     import sys
     if len(sys.argv) == 1:
-        print('packer.py {input directory} {output base name}')
+        print('packer.py {input directory} {output base name} '
+            '[heuristic] [mip levels]')
     else:
         dir = sys.argv[1]
         output = sys.argv[2]
-        pack_dir(dir, output)
+        heuristic = sys.argv[3] if len(sys.argv) > 3 else 'short-side'
+        mipLevels = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+        pack_dir(dir, output, heuristic=heuristic, mipLevels=mipLevels)